@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import subprocess
+import h5py
+import numpy
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+from daxgen import RefinementWorkflow
+from fqtmerge import read_signal, align_qvectors
+from fqtstore import read_index
+
+# The state of the refinement is kept in this file in the work directory
+STATE_FILE = "adaptive.json"
+
+# Number of simulated epsilons around the best one that the surrogate is fitted to
+SURROGATE_WINDOW = 5
+
+def load_experiment(path):
+    """Load the experimental S(q,t) from the HDF5 file at 'path'. It has the
+    same layout as a sassena output file: 'qvectors' (q, 3) and 'fqt' (q, t)
+    or (q, t, 2), with an optional 'error' of the same shape as fqt. Returns
+    (qvectors, values, errors) with values and errors of shape (q, t)."""
+    f = h5py.File(path, "r")
+    try:
+        qvectors = f["qvectors"][...]
+        values = f["fqt"][...]
+        if "error" in f:
+            errors = f["error"][...]
+        else:
+            errors = numpy.ones(values.shape)
+    finally:
+        f.close()
+    if values.ndim == 3:
+        values = values[:, :, 0]
+    if errors.ndim == 3:
+        errors = errors[:, :, 0]
+    return qvectors, values, errors
+
+def model_curves(paths, qvectors):
+    """Return the real part of F(q,t) of the sassena outputs at 'paths' as a
+    (pipelines, q, t) array, with the q vectors in the order of 'qvectors'.
+    Runs shorter than the longest one are padded with NaN."""
+    signals = [read_signal(path) for path in paths]
+    length = max(s["fqt"].shape[1] for s in signals)
+    curves = numpy.empty((len(signals), len(qvectors), length))
+    curves.fill(numpy.nan)
+    for p, signal in enumerate(signals):
+        order = align_qvectors(qvectors, signal)
+        curves[p, :, :signal["fqt"].shape[1]] = signal["fqt"][order, :, 0]
+    return curves
+
+def chi_square(models, values, errors, normalize=True):
+    """Return the reduced chi-square of each model in 'models' (pipelines, q, t)
+    against the experimental 'values' with 'errors' (q, t). Both are assumed
+    to be sampled at the same times, and only the times they share are used.
+    If 'normalize' is set every curve is divided by its value at t = 0 first,
+    so that only the shape of the decay is compared."""
+    length = min(models.shape[2], values.shape[1])
+    models = models[:, :, :length]
+    values = values[:, :length]
+    errors = errors[:, :length]
+    if normalize:
+        errors = errors / values[:, :1]
+        values = values / values[:, :1]
+        models = models / models[:, :, :1]
+    residuals = (models - values[numpy.newaxis]) / errors[numpy.newaxis]
+    return numpy.nanmean(residuals ** 2, axis=(1, 2))
+
+def initial_epsilons(config):
+    "Return the epsilons of the first round from the [sweep] or [simulation] section"
+    if config.has_section("sweep") and config.has_option("sweep", "epsilon"):
+        values = config.get("sweep", "epsilon")
+    else:
+        values = config.get("simulation", "epsilons")
+    return [float(e) for e in values.split(",") if e.strip()]
+
+def fit_surrogate(epsilons, chi2, window=SURROGATE_WINDOW):
+    """Fit a parabola chi2(epsilon) to the 'window' simulated epsilons nearest
+    to the best one and return its coefficients, or None if there are not
+    enough distinct epsilons or it has no minimum"""
+    distinct = numpy.unique(epsilons)
+    if len(distinct) < 3:
+        return None
+    best = epsilons[numpy.argmin(chi2)]
+    nearest = distinct[numpy.argsort(numpy.abs(distinct - best))[:window]]
+    used = numpy.in1d(epsilons, nearest)
+    coefficients = numpy.polyfit(epsilons[used], chi2[used], 2)
+    if coefficients[0] <= 0:
+        return None
+    return coefficients
+
+def next_epsilons(epsilons, chi2, points, bounds, tolerance):
+    """Return the estimate of the best epsilon and the epsilons to simulate
+    next. The estimate is the minimum of the surrogate fit, or the best
+    simulated epsilon if there is no fit. The new points are placed around
+    the estimate, closer than any of the simulated neighbours, and points
+    within 'tolerance' of a simulated epsilon are left out."""
+    epsilons = numpy.asarray(epsilons, dtype=float)
+    chi2 = numpy.asarray(chi2, dtype=float)
+    low, high = bounds
+
+    coefficients = fit_surrogate(epsilons, chi2)
+    if coefficients is None:
+        best = epsilons[numpy.argmin(chi2)]
+    else:
+        best = -coefficients[1] / (2 * coefficients[0])
+    best = float(min(max(best, low), high))
+
+    # Half the distance to the nearest simulated neighbour on either side
+    distances = numpy.abs(epsilons - best)
+    distances = distances[distances > tolerance]
+    if len(distances):
+        step = max(distances.min() / 2, tolerance)
+    else:
+        step = tolerance
+
+    candidates = [best]
+    k = 1
+    while len(candidates) < points and k <= points:
+        candidates += [best - k * step, best + k * step]
+        k += 1
+
+    chosen = []
+    for x in candidates:
+        if x < low or x > high:
+            continue
+        if numpy.any(numpy.abs(epsilons - x) < tolerance):
+            continue
+        if any(abs(y - x) < tolerance for y in chosen):
+            continue
+        chosen.append(x)
+    return best, chosen[:points]
+
+class AdaptiveRefinement(object):
+    """Runs the refinement in rounds. Each round is a workflow generated by
+    RefinementWorkflow in WORKDIR/round_NNN for a few epsilon values. When a
+    round has finished, the chi-square of every pipeline against the
+    experimental data is computed, a surrogate is fitted over epsilon, and the
+    next round simulates the epsilons around its minimum. The [adaptive]
+    section of the config file has the options:
+
+        experiment = S(q,t) file (see load_experiment)
+        results = directory with the fqt files of a round, {round} is replaced
+                  by the round number (default: the round's workflow dir)
+        rounds = maximum number of rounds (default 5)
+        points = epsilons per round (default 3)
+        tolerance = stop when the estimate moves less than this (default 0.1)
+        epsilon_min, epsilon_max = bounds (default: the initial epsilons)
+        normalize = compare F(q,t)/F(q,0) (default true)
+
+    The first round uses the epsilons of the sweep."""
+
+    def __init__(self, configfile, workdir, **workflow_options):
+        "'workflow_options' are passed to RefinementWorkflow"
+        self.configfile = configfile
+        self.workdir = os.path.abspath(workdir)
+        self.workflow_options = workflow_options
+
+        config = ConfigParser()
+        config.read(configfile)
+        self.experiment = config.get("adaptive", "experiment")
+        self.results = None
+        if config.has_option("adaptive", "results"):
+            self.results = config.get("adaptive", "results")
+        self.rounds = 5
+        if config.has_option("adaptive", "rounds"):
+            self.rounds = config.getint("adaptive", "rounds")
+        self.points = 3
+        if config.has_option("adaptive", "points"):
+            self.points = config.getint("adaptive", "points")
+        self.tolerance = 0.1
+        if config.has_option("adaptive", "tolerance"):
+            self.tolerance = config.getfloat("adaptive", "tolerance")
+        self.normalize = True
+        if config.has_option("adaptive", "normalize"):
+            self.normalize = config.getboolean("adaptive", "normalize")
+
+        initial = initial_epsilons(config)
+        low, high = min(initial), max(initial)
+        if config.has_option("adaptive", "epsilon_min"):
+            low = config.getfloat("adaptive", "epsilon_min")
+        if config.has_option("adaptive", "epsilon_max"):
+            high = config.getfloat("adaptive", "epsilon_max")
+        self.bounds = (low, high)
+
+        self.state = {"rounds": [], "best": None, "converged": False, "stopped": None}
+        self.statefile = os.path.join(self.workdir, STATE_FILE)
+        if os.path.isfile(self.statefile):
+            f = open(self.statefile)
+            try:
+                self.state = json.load(f)
+            finally:
+                f.close()
+
+    def save_state(self):
+        "Write the state of the refinement to the work directory"
+        tmp = self.statefile + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.statefile)
+
+    def round_dir(self, n):
+        "The workflow directory of round 'n'"
+        return os.path.join(self.workdir, "round_%03d" % n)
+
+    def results_dir(self, n):
+        "The directory with the fqt files of round 'n'"
+        if self.results is None:
+            return self.round_dir(n)
+        return self.results.replace("{round}", "%03d" % n)
+
+    def generate_round(self, n, epsilons):
+        "Generate the workflow of round 'n' for 'epsilons'"
+        config = ConfigParser()
+        config.read(self.configfile)
+        values = ", ".join(["%g" % e for e in epsilons])
+        config.set("simulation", "epsilons", values)
+        if config.has_section("sweep") and config.has_option("sweep", "epsilon"):
+            config.set("sweep", "epsilon", values)
+
+        outdir = self.round_dir(n)
+        os.makedirs(outdir)
+        workflow = RefinementWorkflow(outdir, config, **self.workflow_options)
+        workflow.generate_workflow()
+        self.state["rounds"].append({"epsilons": [float("%g" % e) for e in epsilons], "chi2": {}})
+        self.save_state()
+        print "Generated round %d in %s for epsilons %s" % (n, outdir, values)
+        return outdir
+
+    def collect(self, n):
+        "Compute the chi-square of the pipelines of round 'n' and store it in the state"
+        ids, params = read_index(os.path.join(self.round_dir(n), "pipelines.txt"))
+        epsilons = dict(params)["epsilon"]
+        paths = [os.path.join(self.results_dir(n), "fqt_inc_%s.hd5" % id) for id in ids]
+        missing = [path for path in paths if not os.path.isfile(path)]
+        if missing:
+            raise Exception("Round %d is not finished, missing %s" % (n, ", ".join(missing)))
+
+        qvectors, values, errors = load_experiment(self.experiment)
+        chi2 = chi_square(model_curves(paths, qvectors), values, errors, self.normalize)
+        for id, epsilon, x in zip(ids, epsilons, chi2):
+            self.state["rounds"][n]["chi2"][id] = [float(epsilon), float(x)]
+        self.save_state()
+
+    def step(self):
+        """Collect the results of the last round and generate the next one.
+        Returns the directory of the new round, or None if the refinement has
+        converged or has stopped without converging. The state records why it
+        stopped: "max_rounds" when the rounds ran out, "no_new_epsilons" when
+        every candidate epsilon has been simulated already."""
+        if self.state["converged"] or self.state.get("stopped"):
+            return None
+
+        n = len(self.state["rounds"])
+        if n == 0:
+            config = ConfigParser()
+            config.read(self.configfile)
+            return self.generate_round(0, initial_epsilons(config))
+
+        self.collect(n - 1)
+        points = []
+        for r in self.state["rounds"]:
+            points += r["chi2"].values()
+        epsilons = [p[0] for p in points]
+        chi2 = [p[1] for p in points]
+
+        best, epsilons = next_epsilons(epsilons, chi2, self.points, self.bounds, self.tolerance)
+        previous = self.state["best"]
+        self.state["best"] = best
+        print "Round %d: best epsilon %g" % (n - 1, best)
+
+        if previous is not None and abs(best - previous) < self.tolerance:
+            self.state["converged"] = True
+            self.save_state()
+            print "Converged to epsilon %g" % best
+            return None
+
+        if not epsilons or n >= self.rounds:
+            self.state["stopped"] = "no_new_epsilons" if not epsilons else "max_rounds"
+            self.save_state()
+            print "Did not converge (%s), the best epsilon is %g" % (self.state["stopped"], best)
+            return None
+
+        return self.generate_round(n, epsilons)
+
+def main():
+    parser = OptionParser(usage="%prog [options] CONFIGFILE WORKDIR")
+    parser.add_option("-r", "--run", dest="run", default=None,
+                      help="Command that plans, runs and waits for a round, {workflow} is replaced by its directory. "
+                           "Without it only one round is generated per call")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Number of threads used to write the config files [default: %default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Wrong number of arguments")
+
+    configfile, workdir = args
+
+    if not os.path.isfile(configfile):
+        raise Exception("No such file: %s" % configfile)
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    refinement = AdaptiveRefinement(configfile, workdir, jobs=options.jobs)
+    while True:
+        outdir = refinement.step()
+        if outdir is None or options.run is None:
+            break
+        command = options.run.replace("{workflow}", outdir)
+        if subprocess.call(command, shell=True) != 0:
+            raise Exception("Round failed: %s" % command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import resource
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+from daxgen import RefinementWorkflow
+
+DAXGEN_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Number of epsilons of the single-axis cases, and of pipelines of the
+# epsilon x temperature x production_steps cases
+SIZES = "10,100,1000,10000"
+SWEEP_SIZES = "100,1000"
+
+# The metrics of each case that are compared with a baseline
+METRICS = ["wall_time", "peak_rss", "files", "bytes", "dax_bytes", "rc_bytes"]
+
+# A case is only a regression if its time grows by more than this many seconds
+TIME_NOISE = 0.1
+
+def epsilon_values(n):
+    "Return 'n' distinct epsilon values between 1 and 20"
+    return ["%.4f" % (1 + i * 19.0 / max(n - 1, 1)) for i in range(n)]
+
+def case_config(configfile, epsilons, temperatures=1, steps=1):
+    """Return the config in 'configfile' changed to sweep 'epsilons' epsilons, and
+    'temperatures' temperatures and 'steps' production step counts if either
+    is more than one"""
+    config = ConfigParser()
+    config.read(configfile)
+    if config.has_section("sweep"):
+        config.remove_section("sweep")
+    config.set("simulation", "epsilons", ", ".join(epsilon_values(epsilons)))
+    if temperatures > 1 or steps > 1:
+        config.add_section("sweep")
+        config.set("sweep", "axes", "epsilon, temperature, production_steps")
+        config.set("sweep", "mode", "product")
+        config.set("sweep", "temperature", ", ".join([str(280 + 5 * i) for i in range(temperatures)]))
+        production_steps = config.getint("simulation", "production_steps")
+        config.set("sweep", "production_steps", ", ".join([str(production_steps * (i + 1)) for i in range(steps)]))
+    return config
+
+def cases(sizes, sweep_sizes):
+    "Return (name, epsilons, temperatures, steps) of every benchmark case"
+    result = []
+    for n in sizes:
+        result.append(("epsilon-%d" % n, n, 1, 1))
+    for n in sweep_sizes:
+        # Split the pipelines between the three axes as evenly as possible
+        k = max(1, int(round(n ** (1.0 / 3))))
+        result.append(("sweep-%d" % n, max(1, n // (k * k)), k, k))
+    return result
+
+def generate(config, outdir, options, results):
+    "Generate the workflow of 'config' in 'outdir' and put its wall time and peak RSS in 'results'"
+    start = time.time()
+    try:
+        workflow = RefinementWorkflow(outdir, config, **options)
+        workflow.generate_workflow()
+    except Exception, e:
+        results.put(e)
+        raise
+    wall_time = time.time() - start
+    # ru_maxrss is in kB on Linux
+    results.put((wall_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, len(workflow.sweep)))
+
+def directory_size(path):
+    "Return the number of files in 'path' and their total size in bytes"
+    files = 0
+    size = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+def run_case(configfile, case, workdir, options):
+    """Generate the workflow of 'case' in a child process, so that its peak RSS
+    is measured on its own, and return its metrics"""
+    name, epsilons, temperatures, steps = case
+    config = case_config(configfile, epsilons, temperatures, steps)
+    outdir = os.path.join(workdir, name)
+    os.makedirs(outdir)
+
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=generate, args=(config, outdir, options, results))
+    child.start()
+    result = results.get()
+    child.join()
+    if isinstance(result, Exception):
+        raise Exception("Generating %s failed: %s" % (name, result))
+    wall_time, peak_rss, pipelines = result
+
+    files, size = directory_size(outdir)
+    return {
+        "name": name,
+        "pipelines": pipelines,
+        "wall_time": wall_time,
+        "peak_rss": peak_rss,
+        "files": files,
+        "bytes": size,
+        "dax_bytes": os.path.getsize(os.path.join(outdir, "dax.xml")),
+        "rc_bytes": os.path.getsize(os.path.join(outdir, "rc.txt"))
+    }
+
+def compare(results, baseline, threshold):
+    """Return the (case, metric, baseline value, value) of every metric of
+    'results' that is more than 'threshold' (a fraction) above the same case
+    in 'baseline'. Cases that are not in the baseline are not compared."""
+    reference = dict((case["name"], case) for case in baseline["cases"])
+    regressions = []
+    for case in results["cases"]:
+        if case["name"] not in reference:
+            continue
+        for metric in METRICS:
+            old = reference[case["name"]].get(metric)
+            new = case[metric]
+            if old is None or new <= old * (1 + threshold):
+                continue
+            if metric == "wall_time" and new - old <= TIME_NOISE:
+                continue
+            regressions.append((case["name"], metric, old, new))
+    return regressions
+
+def print_case(case):
+    print "%-14s %9d %10.2f %10.1f %9d %10.1f %10.1f %9.1f" % (
+        case["name"], case["pipelines"], case["wall_time"], case["peak_rss"] / 1048576.0, case["files"],
+        case["bytes"] / 1048576.0, case["dax_bytes"] / 1048576.0, case["rc_bytes"] / 1048576.0)
+
+def main():
+    parser = OptionParser(usage="%prog [options] [CONFIGFILE]")
+    parser.add_option("-s", "--sizes", dest="sizes", default=SIZES,
+                      help="Comma-separated numbers of epsilons to generate workflows for [default: %default]")
+    parser.add_option("-m", "--sweep-sizes", dest="sweep_sizes", default=SWEEP_SIZES,
+                      help="Comma-separated numbers of pipelines of the epsilon x temperature x production_steps sweeps [default: %default]")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Write the results to this JSON file")
+    parser.add_option("-c", "--compare", dest="baseline", default=None,
+                      help="Compare the results with this JSON file of earlier results and exit with 1 if any regressed")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float", default=0.25,
+                      help="Fraction by which a metric has to grow to be a regression [default: %default]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Number of threads used to write the config files [default: %default]")
+    parser.add_option("-b", "--block-size", dest="block_size", type="int", default=0,
+                      help="Split the workflows into sub-workflows of this many pipelines [default: no split]")
+    parser.add_option("-k", "--keep", dest="keep", default=None,
+                      help="Generate the workflows in this directory and keep them")
+    options, args = parser.parse_args()
+
+    if len(args) > 1:
+        parser.error("Wrong number of arguments")
+
+    configfile = os.path.join(DAXGEN_DIR, "test.cfg")
+    if args:
+        configfile = args[0]
+
+    if not os.path.isfile(configfile):
+        raise Exception("No such file: %s" % configfile)
+
+    sizes = [int(n) for n in options.sizes.split(",") if n.strip()]
+    sweep_sizes = [int(n) for n in options.sweep_sizes.split(",") if n.strip()]
+
+    baseline = None
+    if options.baseline is not None:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+    if options.keep is not None:
+        workdir = options.keep
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="benchgen-")
+
+    workflow_options = {"jobs": options.jobs, "block_size": options.block_size}
+    results = {"host": socket.gethostname(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "config": os.path.abspath(configfile), "options": workflow_options, "cases": []}
+
+    print "%-14s %9s %10s %10s %9s %10s %10s %9s" % ("case", "pipelines", "time (s)", "RSS (MB)", "files",
+                                                     "size (MB)", "DAX (MB)", "rc (MB)")
+    try:
+        for case in cases(sizes, sweep_sizes):
+            result = run_case(configfile, case, workdir, workflow_options)
+            results["cases"].append(result)
+            print_case(result)
+            sys.stdout.flush()
+            if options.keep is None:
+                shutil.rmtree(os.path.join(workdir, case[0]))
+    finally:
+        if options.keep is None:
+            shutil.rmtree(workdir)
+
+    if options.output is not None:
+        f = open(options.output, "w")
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.threshold)
+        for name, metric, old, new in regressions:
+            print "REGRESSION %s %s: %g -> %g (%+.0f%%)" % (name, metric, old, new, 100.0 * (new - old) / old)
+        if regressions:
+            sys.exit(1)
+        print "No regressions against %s" % options.baseline
+
+
+if __name__ == '__main__':
+    main()
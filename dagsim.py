@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+import os
+import json
+import math
+import heapq
+import numpy
+from collections import deque
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+from xml.etree import ElementTree
+from kegparametersfactory import KegParametersFactory, SIZE_UNITS
+from resourcemodel import label_stage, load_records, stage_models, job_work, CORES_PER_NODE
+
+# The values of the [simulator] section that are not in the config file
+NODES = 100
+QUEUE_WAIT = "{'distribution': 'exponential', 'dist_params': [600]}"
+RUNTIME_FRACTION = 0.5
+BANDWIDTH = 100.0
+FILE_SIZE = 1.0
+
+NS = "{http://pegasus.isi.edu/schema/DAX}"
+
+class SimJob(object):
+    "A job of the simulated DAG"
+
+    def __init__(self, id, label, jobtype="single", count=1, walltime=None):
+        self.id = id
+        self.label = label
+        self.transformation = None
+        self.arguments = ""
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.stage = label_stage(label) or label
+        self.jobtype = jobtype
+        self.count = count
+        self.walltime = walltime
+        # The (cores, units of work) of the job in the runtime history, see load_work()
+        self.work = None
+        self.inputs = []
+        self.outputs = []
+        self.parents = set()
+        self.children = set()
+        self.subdax = None
+
+def load_dax(path, prefix=""):
+    """Load the jobs of the DAX file at 'path' and return a dict of id -> SimJob.
+    The transformation and arguments, the stdin, stdout and stderr files,
+    the globus count, jobtype and maxwalltime (minutes) profiles, the files
+    each job uses (with their transfer flag, including stdin as an input and
+    stdout and stderr as outputs) and the dependencies are kept.
+    The sub-workflows of DAX jobs (--block-size) are loaded from the same
+    directory and spliced in: their first jobs depend on the DAX job and the
+    children of the DAX job depend on their last jobs. The ids of the jobs
+    of a sub-workflow are prefixed with the id of its DAX job."""
+    jobs = {}
+    for event, elem in ElementTree.iterparse(path):
+        tag = elem.tag[len(NS):]
+        if tag in ("job", "dax"):
+            profiles = {}
+            for p in elem.findall(NS + "profile"):
+                if p.get("namespace") == "globus":
+                    profiles[p.get("key")] = p.text
+            walltime = profiles.get("maxwalltime")
+            job = SimJob(prefix + elem.get("id"), elem.get("node-label") or elem.get("name") or elem.get("file"),
+                         profiles.get("jobtype", "single"), int(profiles.get("count", 1)),
+                         float(walltime) * 60 if walltime else None)
+            job.transformation = elem.get("name")
+            if elem.get("namespace"):
+                job.transformation = "%s::%s" % (elem.get("namespace"), job.transformation)
+            argument = elem.find(NS + "argument")
+            if argument is not None:
+                job.arguments = (argument.text or "") + "".join([f.get("name") + (f.tail or "") for f in argument])
+            for use in elem.findall(NS + "uses"):
+                transfer = use.get("transfer", "true") == "true"
+                if use.get("link") == "output":
+                    job.outputs.append((use.get("name"), transfer))
+                else:
+                    job.inputs.append((use.get("name"), transfer))
+            for stream in ["stdin", "stdout", "stderr"]:
+                f = elem.find(NS + stream)
+                if f is None:
+                    continue
+                setattr(job, stream, f.get("name"))
+                files = job.inputs if stream == "stdin" else job.outputs
+                if f.get("name") not in [name for name, transfer in files]:
+                    files.append((f.get("name"), f.get("transfer", "true") == "true"))
+            if tag == "dax":
+                job.count = 0
+                job.subdax = os.path.join(os.path.dirname(path), elem.get("file"))
+            jobs[job.id] = job
+            elem.clear()
+        elif tag == "child":
+            child = prefix + elem.get("ref")
+            for parent in elem.findall(NS + "parent"):
+                jobs[child].parents.add(prefix + parent.get("ref"))
+                jobs[prefix + parent.get("ref")].children.add(child)
+            elem.clear()
+
+    for daxjob in [job for job in jobs.values() if job.subdax]:
+        sub = load_dax(daxjob.subdax, daxjob.id + ":")
+        firsts = [job for job in sub.values() if not job.parents]
+        lasts = [job for job in sub.values() if not job.children]
+        for job in firsts:
+            job.parents.add(daxjob.id)
+        children = daxjob.children
+        daxjob.children = set(job.id for job in firsts)
+        for id in children:
+            jobs[id].parents.discard(daxjob.id)
+            for job in lasts:
+                jobs[id].parents.add(job.id)
+                job.children.add(id)
+        jobs.update(sub)
+    return jobs
+
+def load_work(jobs, path):
+    """Set the work of the 'jobs' loaded from the DAX file 'path' and its
+    sub-workflows from the config files generated next to them (see
+    resourcemodel.job_work)"""
+    daxes = [("", path)] + [(job.id + ":", job.subdax) for job in jobs.values() if job.subdax]
+    for prefix, dax in daxes:
+        for id, (stage, cores, work) in job_work(os.path.dirname(dax), os.path.basename(dax)).items():
+            if prefix + id in jobs:
+                jobs[prefix + id].work = (cores, work)
+
+class ClusterModel(object):
+    """The cluster and the runtimes of the jobs that the DAG is replayed
+    against, from the [simulator] section of the config file:
+
+        nodes = number of nodes (default 100)
+        cores_per_node = cores of each node (default 24)
+        queue_wait = distribution of the time in seconds a job waits in the
+                     batch queue after it is released, in the format of the
+                     keg sections (default exponential with a mean of 600)
+        history = runtimes of past runs that the runtimes of the jobs are
+                  predicted from (default: the history of [resources])
+        runtime_fraction = the runtime of a job that has neither a wall_time
+                           distribution nor a history, as a fraction of its
+                           maxwalltime (default 0.5)
+        bandwidth = MB/s of the transfers of files with transfer=True
+                    (default 100)
+        file_size = MB of each transferred file without a size
+                    distribution (default 1)
+
+    The runtime of each job is drawn from the wall_time distribution of its
+    keg-<label> section (see kegcalibrate.py), or else predicted for its
+    work and cores by the resourcemodel.StageModel of its stage fitted to
+    the history. The sizes of its output files are drawn from their size
+    distributions."""
+
+    def __init__(self, config, seed=0):
+        self.nodes = NODES
+        self.cores_per_node = CORES_PER_NODE
+        queue_wait = QUEUE_WAIT
+        self.runtime_fraction = RUNTIME_FRACTION
+        self.bandwidth = BANDWIDTH
+        self.file_size = FILE_SIZE
+        history = None
+        if config.has_option("resources", "history"):
+            history = config.get("resources", "history")
+        if config.has_section("simulator"):
+            if config.has_option("simulator", "nodes"):
+                self.nodes = config.getint("simulator", "nodes")
+            if config.has_option("simulator", "cores_per_node"):
+                self.cores_per_node = config.getint("simulator", "cores_per_node")
+            if config.has_option("simulator", "queue_wait"):
+                queue_wait = config.get("simulator", "queue_wait")
+            if config.has_option("simulator", "history"):
+                history = config.get("simulator", "history")
+            if config.has_option("simulator", "runtime_fraction"):
+                self.runtime_fraction = config.getfloat("simulator", "runtime_fraction")
+            if config.has_option("simulator", "bandwidth"):
+                self.bandwidth = config.getfloat("simulator", "bandwidth")
+            if config.has_option("simulator", "file_size"):
+                self.file_size = config.getfloat("simulator", "file_size")
+        # stage -> StageModel
+        self.models = {}
+        if history is not None:
+            self.models = stage_models(load_records(history))
+        self.keg = KegParametersFactory(config, seed)
+        self.queue_wait = self.keg.parse_spec("simulator", "queue_wait", queue_wait)
+
+    def cores(self, job):
+        "Return the number of cores allocated to 'job': whole nodes for MPI jobs"
+        if job.jobtype == "mpi":
+            return int(math.ceil(job.count / float(self.cores_per_node))) * self.cores_per_node
+        return job.count
+
+    def sample(self, jobs):
+        """Draw the queue wait, the runtime and the transfer time in seconds of
+        every job in 'jobs', with one draw per distribution. Each transferred
+        input file is only staged in for the first job that uses it."""
+        waits = self.keg.draw(self.queue_wait, len(jobs)).astype(float)
+        waits[[i for i, job in enumerate(jobs) if job.count == 0]] = 0.0
+
+        # The index in 'requests' of the runtime and of each output size of every job
+        requests = []
+        plans = []
+        for job in jobs:
+            section = self.keg.section(job.label)
+            runtime = None
+            if section is not None and "wall_time" in self.keg.specs[section]:
+                runtime = len(requests)
+                requests.append((section, "wall_time"))
+            outputs = []
+            for name, transfer in job.outputs:
+                if not transfer:
+                    continue
+                option = section and self.keg.file_spec(section, name)
+                if option:
+                    outputs.append((name, self.keg.specs[section][option], len(requests)))
+                    requests.append((section, option))
+                else:
+                    outputs.append((name, None, None))
+            plans.append((runtime, outputs))
+        drawn = self.keg.sample(requests)
+
+        runtimes = numpy.zeros(len(jobs))
+        transfers = numpy.zeros(len(jobs))
+        sizes = {}
+        staged = set()
+        for i, (job, (runtime, outputs)) in enumerate(zip(jobs, plans)):
+            if runtime is not None:
+                runtimes[i] = drawn[runtime]
+            elif job.work is not None and job.stage in self.models and job.count > 0:
+                cores, work = job.work
+                runtimes[i] = self.models[job.stage].seconds_per_unit(cores) * work
+            elif job.walltime and job.count > 0:
+                runtimes[i] = job.walltime * self.runtime_fraction
+            megabytes = 0.0
+            for name, spec, k in outputs:
+                size = self.file_size
+                if spec is not None:
+                    size = drawn[k] * SIZE_UNITS[spec.get("size_unit", "B")] / float(SIZE_UNITS["M"])
+                sizes[name] = size
+                megabytes += size
+            for name, transfer in job.inputs:
+                if transfer and name not in staged and job.count > 0:
+                    staged.add(name)
+                    megabytes += sizes.get(name, self.file_size)
+            transfers[i] = megabytes / self.bandwidth
+        return waits, runtimes, transfers
+
+def simulate(jobs, model):
+    """Replay the DAG 'jobs' against 'model'. A job is released to the queue
+    when its parents have finished, becomes eligible after its queue wait,
+    and starts as soon as enough cores are free, the earliest eligible job
+    first among those that fit (first-fit backfill). A job runs for its
+    transfer time plus its runtime, and is killed at its maxwalltime.
+    Returns a dict of id -> (released, started, finished, cores, killed)
+    and the id of the parent that released each job."""
+    order = sorted(jobs)
+    index = dict((id, i) for i, id in enumerate(order))
+    waits, runtimes, transfers = model.sample([jobs[id] for id in order])
+    capacity = model.nodes * model.cores_per_node
+
+    remaining = dict((id, len(jobs[id].parents)) for id in order)
+    released_by = {}
+    result = {}
+    events = []
+    # Eligible jobs waiting for cores, one FIFO per core count
+    waiting = {}
+    free = capacity
+    seq = 0
+
+    def release(id, time):
+        i = index[id]
+        cores = model.cores(jobs[id])
+        if cores > capacity:
+            raise Exception("%s needs %d cores, but the cluster only has %d" % (jobs[id].label, cores, capacity))
+        heapq.heappush(events, (time + waits[i], 1, id))
+
+    for id in order:
+        if remaining[id] == 0:
+            release(id, 0.0)
+            result[id] = [0.0, None, None, model.cores(jobs[id]), False]
+
+    now = 0.0
+    while events:
+        now, kind, id = heapq.heappop(events)
+        if kind == 0:
+            # A job finished
+            free += result[id][3]
+            for child in sorted(jobs[id].children):
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    released_by[child] = id
+                    result[child] = [now, None, None, model.cores(jobs[child]), False]
+                    release(child, now)
+        else:
+            # A job became eligible
+            seq += 1
+            waiting.setdefault(result[id][3], deque()).append((now, seq, id))
+
+        # Start the eligible jobs that fit, earliest first
+        while True:
+            heads = [(queue[0], cores) for cores, queue in waiting.items() if queue and cores <= free]
+            if not heads:
+                break
+            (eligible, s, next), cores = min(heads)
+            waiting[cores].popleft()
+            i = index[next]
+            duration = transfers[i] + runtimes[i]
+            killed = False
+            if jobs[next].walltime and jobs[next].count > 0 and duration > jobs[next].walltime:
+                duration = jobs[next].walltime
+                killed = True
+            free -= cores
+            result[next][1] = now
+            result[next][2] = now + duration
+            result[next][4] = killed
+            heapq.heappush(events, (now + duration, 0, next))
+
+    unfinished = [id for id in order if id not in result or result[id][2] is None]
+    if unfinished:
+        raise Exception("%d jobs never ran, the DAG has a cycle" % len(unfinished))
+    return result, released_by
+
+def critical_path(jobs, result, released_by):
+    "Return the ids of the chain of jobs that released each other up to the last one to finish"
+    id = max(result, key=lambda id: result[id][2])
+    path = [id]
+    while id in released_by:
+        id = released_by[id]
+        path.append(id)
+    path.reverse()
+    return path
+
+def report(jobs, model, result, released_by):
+    "Return the predicted makespan, core-hours, critical path and per-stage utilization as a dict"
+    makespan = max(r[2] for r in result.values())
+    capacity = model.nodes * model.cores_per_node
+    stages = {}
+    for id, (released, started, finished, cores, killed) in result.items():
+        if jobs[id].count == 0:
+            continue
+        s = stages.setdefault(jobs[id].stage, {"jobs": 0, "core_hours": 0.0, "runtime": 0.0,
+                                               "queue_wait": 0.0, "killed": 0})
+        s["jobs"] += 1
+        s["core_hours"] += cores * (finished - started) / 3600.0
+        s["runtime"] += finished - started
+        s["queue_wait"] += started - released
+        s["killed"] += killed
+    for s in stages.values():
+        s["runtime"] /= s["jobs"]
+        s["queue_wait"] /= s["jobs"]
+        s["utilization"] = s["core_hours"] * 3600.0 / (capacity * makespan) if makespan else 0.0
+
+    path = []
+    for id in critical_path(jobs, result, released_by):
+        released, started, finished, cores, killed = result[id]
+        path.append({"label": jobs[id].label, "queue_wait": started - released, "runtime": finished - started})
+
+    core_hours = sum(s["core_hours"] for s in stages.values())
+    return {
+        "jobs": sum(s["jobs"] for s in stages.values()),
+        "makespan": makespan,
+        "core_hours": core_hours,
+        "utilization": core_hours * 3600.0 / (capacity * makespan) if makespan else 0.0,
+        "critical_path": path,
+        "stages": stages
+    }
+
+def print_report(summary, makespans):
+    "Print the report of the first run and the spread of the makespan over all runs"
+    print "Jobs:        %d" % summary["jobs"]
+    print "Makespan:    %.2f hours" % (summary["makespan"] / 3600.0)
+    if len(makespans) > 1:
+        p = numpy.percentile(makespans, [5, 50, 95]) / 3600.0
+        print "             %.2f / %.2f / %.2f hours (5th / 50th / 95th percentile of %d runs)" % (p[0], p[1], p[2], len(makespans))
+    print "Core-hours:  %.1f" % summary["core_hours"]
+    print "Utilization: %.1f%%" % (100 * summary["utilization"])
+    print
+    print "%-14s %6s %12s %10s %12s %12s %7s" % ("stage", "jobs", "core-hours", "util", "runtime (s)", "queue (s)", "killed")
+    for stage, s in sorted(summary["stages"].items(), key=lambda item: -item[1]["core_hours"]):
+        print "%-14s %6d %12.1f %9.1f%% %12.0f %12.0f %7d" % (stage, s["jobs"], s["core_hours"], 100 * s["utilization"],
+                                                              s["runtime"], s["queue_wait"], s["killed"])
+    print
+    print "Critical path:"
+    for step in summary["critical_path"]:
+        print "  %-40s queue %8.0f s  run %8.0f s" % (step["label"], step["queue_wait"], step["runtime"])
+
+def main():
+    parser = OptionParser(usage="%prog [options] WORKFLOWDIR|DAXFILE")
+    parser.add_option("-c", "--config", dest="config", default=None,
+                      help="Config file with the [simulator] and keg-* sections")
+    parser.add_option("-N", "--nodes", dest="nodes", type="int", default=None,
+                      help="Number of nodes of the cluster [default: from the config file, or %d]" % NODES)
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=1,
+                      help="Number of runs with different random draws [default: %default]")
+    parser.add_option("-e", "--seed", dest="seed", type="int", default=0,
+                      help="Seed of the random draws [default: %default]")
+    parser.add_option("-o", "--json", dest="json", default=None,
+                      help="Also write the report of the first run to this JSON file")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Wrong number of arguments")
+
+    if options.runs < 1:
+        parser.error("--runs must be at least 1")
+
+    path = args[0]
+    if os.path.isdir(path):
+        path = os.path.join(path, "dax.xml")
+    if not os.path.isfile(path):
+        raise Exception("No such file: %s" % path)
+
+    config = ConfigParser()
+    if options.config is not None:
+        if not os.path.isfile(options.config):
+            raise Exception("No such file: %s" % options.config)
+        config.read(options.config)
+
+    jobs = load_dax(path)
+    model = ClusterModel(config, options.seed)
+    if model.models:
+        load_work(jobs, path)
+    if options.nodes is not None:
+        model.nodes = options.nodes
+
+    summary = None
+    makespans = []
+    for run in range(options.runs):
+        result, released_by = simulate(jobs, model)
+        if summary is None:
+            summary = report(jobs, model, result, released_by)
+        makespans.append(max(r[2] for r in result.values()))
+
+    print_report(summary, makespans)
+    if options.json is not None:
+        summary["makespans"] = makespans
+        f = open(options.json, "w")
+        try:
+            json.dump(summary, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,136 @@
 #!/usr/bin/env python
 import os
 import sys
-import string
+import math
+import time
+import itertools
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 from ConfigParser import ConfigParser
 from Pegasus.DAX3 import *
+import templateengine
+import dcdreduce
+import namdtune
+import namdbin
+from kegparametersfactory import KegParametersFactory
+from manifest import Manifest, digest_chunks
+from sweep import ParameterSweep, batches
+from sassenadb import SassenaDBCache
+from resourcemodel import ResourceModel, CORES_PER_NODE, DCD_FREQUENCY
 
 DAXGEN_DIR = os.path.dirname(os.path.realpath(__file__))
 TEMPLATE_DIR = os.path.join(DAXGEN_DIR, "templates")
+INPUT_DIR = os.path.join(DAXGEN_DIR, "inputs")
+
+# Number of hex digits of the content hash used to name deduplicated files
+DEDUP_LENGTH = 16
+
+# The default q scan of the sassena jobs: from, to and number of points
+SCAN = ("0.1", "2.1", "11")
+
+# The atoms that every frame of the production trajectory is fitted on,
+# unless align_mask is set in the config file
+ALIGN_MASK = "@1-92214"
+
+# The NAMD neighbour list options in the [namd] section, their default
+# values, and the names of the Tcl variables that the autotune job sets
+NAMD_KNOBS = [
+    ("margin", "10.0", "margin"),
+    ("pairlistdist", "18.0", "pairlistdist"),
+    ("stepspercycle", "1", "stepspercycle"),
+    ("pairlists_per_cycle", "1", "pairlistsPerCycle")
+]
+
+# The file with the neighbour list settings chosen by the autotune job
+TUNE_FILE = "namd_tune.tcl"
 
 def format_template(name, outfile, **kwargs):
     "This fills in the values for the template called 'name' and writes it to 'outfile'"
     templatefile = os.path.join(TEMPLATE_DIR, name)
-    template = open(templatefile).read()
-    formatter = string.Formatter()
-    data = formatter.format(template, **kwargs)
-    f = open(outfile, "w")
-    try:
-        f.write(data)
-    finally:
-        f.close()
+    template = templateengine.get_template(templatefile)
+    template.write(outfile, **kwargs)
+
+def uses_once(job, f, **kwargs):
+    "Add a use of 'f' to 'job' unless it already has one. Multi-copy jobs are shared by all pipelines."
+    name = f.name if isinstance(f, File) else f
+    if not job.hasUse(Use(name)):
+        job.uses(f, **kwargs)
+
+def depends_once(dax, child, parent):
+    "Make 'child' depend on 'parent' in 'dax' unless it already does"
+    if not dax.hasDependency(Dependency(parent, child)):
+        dax.depends(child, parent)
+
+def render_template(name, **kwargs):
+    "This fills in the values for the template called 'name' and returns the rendered chunks"
+    templatefile = os.path.join(TEMPLATE_DIR, name)
+    template = templateengine.get_template(templatefile)
+    return template.render(**kwargs)
 
 class RefinementWorkflow(object):
-    def __init__(self, outdir, config):
-        "'outdir' is the directory where the workflow is written, and 'config' is a ConfigParser object"
+    def __init__(self, outdir, config, jobs=1, block_size=0, incremental=False, dedup=False,
+                 cluster_size=0, cluster_aggregator="seqexec", stream=False, align="cpptraj",
+                 reduce=False, q_shards=1, coherent=False, store=False, warm_start=False,
+                 multicopy=False, autotune=False, synthetic=False, seed=0):
+        """The arguments are:
+
+            outdir = directory where the workflow is written
+            config = ConfigParser object
+            jobs = number of threads used to write the config files
+            block_size = pipelines per sub-workflow (0 means one flat workflow)
+            incremental = only rewrite the files in outdir whose content changed
+            dedup = name the generated files by their content, so identical files are shared
+            cluster_size = ptraj jobs per job cluster (0 means none, "auto" derives it
+                           from the number of pipelines)
+            cluster_aggregator = Pegasus job aggregator of the clusters (seqexec or mpiexec)
+            stream = analyse each production segment when it finishes and merge the results
+            align = tool that fits the trajectory (cpptraj, or builtin for dcdalign.py)
+            reduce = only stage the atoms of the fitted trajectory that sassena uses
+            q_shards = number of sassena jobs the q scan is split into
+            coherent = also run the coherent sassena calculation
+            store = add a final job that collects the results into one HDF5 file
+            warm_start = equilibrate each epsilon from the state of its neighbour
+            multicopy = run the NAMD jobs of a workflow as replicas of one multi-copy job
+            autotune = benchmark the [namd] autotune candidates and use the fastest
+                       neighbour list settings for the production runs
+            synthetic = replace every job with pegasus(-mpi)-keg using the keg-* sections
+                        and placeholder input files
+            seed = seed of the values sampled for the synthetic jobs"""
         self.outdir = outdir
         self.config = config
+        self.jobs = jobs
+        self.block_size = block_size
+        self.dedup = dedup
+        self.stream = stream
+        self.align = align
+        self.reduce = reduce
+        self.q_shards = q_shards
+        self.coherent = coherent
+        self.store = store
+        self.warm_start = warm_start
+        self.multicopy = multicopy
+        self.autotune = autotune
+        self.tunejob = None
+        if warm_start and multicopy:
+            raise Exception("Warm start chains cannot run inside a multi-copy job")
+        self.results = []
+        self.eqjobs = {}
+        self.replica_jobs = []
+        self.manifest = None
+        if incremental:
+            self.manifest = Manifest(outdir)
         self.daxfile = os.path.join(self.outdir, "dax.xml")
         self.replicas = {}
+        self.input_dir = INPUT_DIR
+        self.input_files = []
+        self.keg = None
+        if synthetic:
+            self.keg = KegParametersFactory(config, seed)
+            self.input_dir = os.path.join(outdir, "inputs")
 
         # Get all the values from the config file
-        self.epsilons = [x.strip() for x in config.get("simulation", "epsilons").split(",")]
-        self.temperature = config.get("simulation", "temperature")
-        self.equilibrate_steps = config.get("simulation", "equilibrate_steps")
-        self.production_steps = config.get("simulation", "production_steps")
+        self.sweep = ParameterSweep(config)
+        self.resources = ResourceModel(config)
         self.sassena_pdb = config.get("simulation", "sassena_pdb")
         self.coordinates = config.get("simulation", "coordinates")
         self.structure = config.get("simulation", "structure")
@@ -41,17 +139,80 @@ class RefinementWorkflow(object):
         self.bin_coordinates = config.get("simulation", "bin_coordinates")
         self.bin_velocities = config.get("simulation", "bin_velocities")
         self.sassena_db = config.get("simulation", "sassena_db")
+        self.segments = 1
+        if config.has_option("simulation", "production_segments"):
+            self.segments = config.getint("simulation", "production_segments")
+            if self.segments < 1:
+                raise Exception("production_segments must be at least 1")
+        self.warm_equilibrate_steps = None
+        if config.has_option("simulation", "warm_equilibrate_steps"):
+            self.warm_equilibrate_steps = config.getint("simulation", "warm_equilibrate_steps")
+            if self.warm_equilibrate_steps < 1:
+                raise Exception("warm_equilibrate_steps must be at least 1")
+        self.align_mask = ALIGN_MASK
+        if config.has_option("simulation", "align_mask"):
+            self.align_mask = config.get("simulation", "align_mask").strip()
+            if self.align_mask == "auto":
+                # Fit on every atom that is not water
+                self.align_mask = namdbin.solute_mask(os.path.join(INPUT_DIR, self.structure))
+        self.namd_knobs = {}
+        for option, default, variable in NAMD_KNOBS:
+            self.namd_knobs[option] = default
+            if config.has_option("namd", option):
+                self.namd_knobs[option] = config.get("namd", option).strip()
+        self.autotune_steps = None
+        if config.has_option("namd", "autotune_steps"):
+            self.autotune_steps = config.getint("namd", "autotune_steps")
+        self.autotune_candidates = None
+        if config.has_option("namd", "autotune_candidates"):
+            self.autotune_candidates = config.get("namd", "autotune_candidates")
+        self.q_from, self.q_to, self.q_points = SCAN
+        if config.has_option("simulation", "q_from"):
+            self.q_from = config.get("simulation", "q_from").strip()
+        if config.has_option("simulation", "q_to"):
+            self.q_to = config.get("simulation", "q_to").strip()
+        if config.has_option("simulation", "q_points"):
+            self.q_points = config.get("simulation", "q_points").strip()
+        if q_shards < 1 or (q_shards > 1 and q_shards > int(self.q_points) // 2):
+            raise Exception("The q scan of %s points cannot be split into %d shards" % (self.q_points, q_shards))
+        self.reduced_pdb = "%s_reduced.pdb" % os.path.splitext(self.sassena_pdb)[0]
         self.incoherent_db = "database/db-neutron-incoherent.xml"
         self.coherent_db = "database/db-neutron-coherent.xml"
 
+        # The single-core ptraj jobs can be clustered so that they don't all
+        # have to go through the queue individually
+        self.cluster_aggregator = cluster_aggregator
+        self.cluster_size = cluster_size
+        if cluster_size == "auto":
+            pipelines = block_size or len(self.sweep)
+            if cluster_aggregator == "mpiexec":
+                # pegasus-mpi-cluster runs the tasks in parallel, so one cluster is enough
+                self.cluster_size = pipelines
+            else:
+                # seqexec runs the tasks one after another, so balance the
+                # number of clusters against the length of each cluster
+                self.cluster_size = int(math.ceil(math.sqrt(pipelines)))
+
+        # If there is a shared cache of extracted sassena dbs, and the archive
+        # has already been extracted there, then the workflow uses the cached
+        # files instead of running the untar job
+        self.db_cache = None
+        self.db_files = []
+        if config.has_option("simulation", "sassena_db_cache"):
+            archive = os.path.join(INPUT_DIR, self.sassena_db)
+            self.db_cache = SassenaDBCache(config.get("simulation", "sassena_db_cache"), archive)
+            if self.db_cache.is_populated():
+                self.db_files = self.db_cache.files()
+
     def add_replica(self, name, path):
         "Add a replica entry to the replica catalog for the workflow"
         url = "file://%s" % path
         self.replicas[name] = url
 
-    def generate_replica_catalog(self):
+    def generate_replica_catalog(self, path=None):
         "Write the replica catalog for this workflow to a file"
-        path = os.path.join(self.outdir, "rc.txt")
+        if path is None:
+            path = os.path.join(self.outdir, "rc.txt")
         f = open(path, "w")
         try:
             for name, url in self.replicas.items():
@@ -59,104 +220,344 @@ class RefinementWorkflow(object):
         finally:
             f.close()
 
-    def generate_prm(self, epsilon):
-        "Generate an prm files for epsilon'"
-        name = "par%s.prm" % epsilon
-        path = os.path.join(self.outdir, name)
+    def write_artifact(self, pipeline, name, template, kw):
+        """Fill in 'template' with the values in 'kw' and write it to the file 'name' for 'pipeline'.
+        If self.dedup is set, the pipeline id in 'name' is replaced by the hash of the content so
+        that identical files are only written and staged once. Returns (name, path)"""
+        if self.manifest is None and not self.dedup:
+            path = os.path.join(self.outdir, name)
+            format_template(template, path, **kw)
+            return name, path
+
+        chunks = render_template(template, **kw)
+        digest = digest_chunks(chunks)
+        if self.dedup:
+            name = name.replace(pipeline.id, digest[:DEDUP_LENGTH])
+
+        if self.manifest is not None:
+            path = self.manifest.write_chunks(pipeline.id, name, chunks, digest)
+        else:
+            path = os.path.join(self.outdir, name)
+            if not os.path.isfile(path):
+                templateengine.write_chunks(path, chunks)
+        return name, path
+
+    def report_changes(self):
+        "Remove the files of pipelines that are no longer in the sweep, and report the pipelines that changed"
+        pruned = self.manifest.prune()
+        self.manifest.write()
+
+        new = self.manifest.new_pipelines()
+        stale = self.manifest.stale_pipelines()
+        removed = self.manifest.removed_pipelines()
+        print "New pipelines: %s" % ", ".join(sorted(new))
+        print "Stale pipelines: %s" % ", ".join(sorted(stale))
+        print "Removed pipelines: %s" % ", ".join(sorted(removed))
+        print "Rewrote %d files, removed %d files" % (len(self.manifest.changed), len(pruned))
+
+    def generate_prm(self, pipeline):
+        "Generate an prm file for 'pipeline'"
+        name = "par%s.prm" % pipeline.id
         kw = {
-            "epsilon": "%10.6f" % (-0.01 * float(epsilon)),
+            "epsilon": "%10.6f" % (-0.01 * float(pipeline.epsilon)),
         }
-        format_template("8ND_8RNA_epsilon.xml", path, **kw)
-        self.add_replica(name, path)
+        return self.write_artifact(pipeline, name, "epsilon.xml", kw)
+
+    def equilibrate_steps(self, pipeline):
+        """Return the number of equilibration steps of 'pipeline'. Warm started
+        pipelines run warm_equilibrate_steps, or a tenth of equilibrate_steps."""
+        steps = int(pipeline.equilibrate_steps)
+        if pipeline.seed is None:
+            return steps
+        if self.warm_equilibrate_steps is not None:
+            return self.warm_equilibrate_steps
+        return max(steps // 10, 1)
 
-    def generate_eq_conf(self, epsilon, parameters):
-        "Generate an equilibrate configuration file for 'epsilon'"
-        name = "equilibrate_%s.conf" % epsilon
-        path = os.path.join(self.outdir, name)
+    def generate_eq_conf(self, pipeline, parameters):
+        "Generate an equilibrate configuration file for 'pipeline'"
+        name = "equilibrate_%s.conf" % pipeline.id
+        extended_system = self.extended_system
+        bin_coordinates = self.bin_coordinates
+        bin_velocities = self.bin_velocities
+        if pipeline.seed is not None:
+            # Start from the final state of the neighbour's equilibration
+            extended_system = "equilibrate_%s.xsc" % pipeline.seed
+            bin_coordinates = "equilibrate_%s.coor" % pipeline.seed
+            bin_velocities = "equilibrate_%s.vel" % pipeline.seed
         kw = {
-            "temperature": self.temperature,
-            "epsilon": epsilon,
+            "temperature": pipeline.temperature,
+            "epsilon": pipeline.epsilon,
             "structure": self.structure,
             "coordinates": self.coordinates,
             "parameters": parameters,
             "fixed_pdb": self.fixed_pdb,
-            "outputname": "equilibrate_%s" % epsilon,
-            "extended_system": self.extended_system,
-            "bin_coordinates": self.bin_coordinates,
-            "bin_velocities": self.bin_velocities,
-            "timesteps": self.equilibrate_steps
+            "outputname": "equilibrate_%s" % pipeline.id,
+            "extended_system": extended_system,
+            "bin_coordinates": bin_coordinates,
+            "bin_velocities": bin_velocities,
+            "timesteps": self.equilibrate_steps(pipeline)
         }
-        format_template("equilibrate.conf", path, **kw)
-        self.add_replica(name, path)
+        kw.update(self.namd_knobs)
+        return self.write_artifact(pipeline, name, "equilibrate.conf", kw)
+
+    def production_segments(self, pipeline):
+        """Return a list of (outputname, inputname, firsttimestep, timesteps) for the
+        production segments of 'pipeline'. Each segment continues from the final
+        coordinates, velocities and cell of the one before it, and the first one
+        continues from the equilibration. The segments are split on DCD frames so
+        that the trajectory chunks add up to the same frames as a single run."""
+        steps = int(pipeline.production_steps)
+        if self.segments == 1:
+            return [("production_%s" % pipeline.id, "equilibrate_%s" % pipeline.id, 0, steps)]
+
+        frames, extra = divmod(steps, DCD_FREQUENCY)
+        if frames < self.segments:
+            raise Exception("Cannot split %d production steps into %d segments" % (steps, self.segments))
+
+        segments = []
+        inputname = "equilibrate_%s" % pipeline.id
+        firsttimestep = 0
+        for k in range(self.segments):
+            timesteps = (frames // self.segments + (k < frames % self.segments)) * DCD_FREQUENCY
+            if k == self.segments - 1:
+                timesteps += extra
+            outputname = "production_%s_%d" % (pipeline.id, k)
+            segments.append((outputname, inputname, firsttimestep, timesteps))
+            inputname = outputname
+            firsttimestep += timesteps
+        return segments
 
-    def generate_prod_conf(self, epsilon, parameters):
-        "Generate a production configuration file for 'epsilon'"
-        name = "production_%s.conf" % epsilon
-        path = os.path.join(self.outdir, name)
+    def generate_prod_conf(self, pipeline, parameters, segment):
+        "Generate the production configuration file for one 'segment' of 'pipeline'"
+        outputname, inputname, firsttimestep, timesteps = segment
+        name = "%s.conf" % outputname
         kw = {
-            "temperature": self.temperature,
-            "epsilon": epsilon,
+            "temperature": pipeline.temperature,
+            "epsilon": pipeline.epsilon,
             "structure": self.structure,
             "coordinates": self.coordinates,
             "parameters": parameters,
             "fixed_pdb": self.fixed_pdb,
-            "inputname": "equilibrate_%s" % epsilon,
-            "outputname": "production_%s" % epsilon,
-            "timesteps": self.production_steps
+            "inputname": inputname,
+            "outputname": outputname,
+            "firsttimestep": firsttimestep,
+            "timesteps": timesteps,
+            "tuning": ""
         }
-        format_template("production.conf", path, **kw)
-        self.add_replica(name, path)
+        kw.update(self.namd_knobs)
+        if self.autotune:
+            # The settings are read from the output of the autotune job
+            kw["tuning"] = "source %s\n" % TUNE_FILE
+            for option, default, variable in NAMD_KNOBS:
+                kw[option] = "$%s" % variable
+        return self.write_artifact(pipeline, name, "production.conf", kw)
 
-    def generate_ptraj_conf(self, epsilon):
-        "Generate a ptraj configuration file for 'epsilon'"
-        name = "ptraj_%s.conf" % epsilon
-        path = os.path.join(self.outdir, name)
-        kw = {
-            "trajectory_input": "production_%s.dcd" % epsilon,
-            "trajectory_output": "ptraj_%s.dcd" % epsilon
-        }
-        format_template("rms2first.ptraj", path, **kw)
-        self.add_replica(name, path)
+    def analysis_parts(self, pipeline):
+        """Return a list of (suffix, trajectories, frames) for the analysis of 'pipeline'.
+        Normally the whole production trajectory is analysed at once, but with
+        self.stream each production segment is analysed as soon as it is written.
+        'suffix' names the files and jobs of the part and 'trajectories' are the
+        production DCD files that it reads."""
+        segments = self.production_segments(pipeline)
+        if not self.stream or len(segments) == 1:
+            frames = int(pipeline.production_steps) // DCD_FREQUENCY
+            return [(pipeline.id, ["%s.dcd" % segment[0] for segment in segments], frames)]
 
-    def generate_incoherent_conf(self, epsilon):
-        "Generate a sassena incoherent config file for 'epsilon'"
-        name = "sassenaInc_%s.xml" % epsilon
-        path = os.path.join(self.outdir, name)
+        parts = []
+        for k, (outputname, inputname, firsttimestep, timesteps) in enumerate(segments):
+            parts.append(("%s_%d" % (pipeline.id, k), ["%s.dcd" % outputname], timesteps // DCD_FREQUENCY))
+        return parts
+
+    def generate_ptraj_conf(self, pipeline, part):
+        "Generate a ptraj configuration file for one analysis 'part' of 'pipeline'"
+        suffix, trajectories, frames = part
+        name = "ptraj_%s.conf" % suffix
         kw = {
-            "sassena_pdb": self.sassena_pdb,
-            "trajectory": "ptraj_%s.dcd" % epsilon,
-            "output": "fqt_inc_%s.hd5" % epsilon,
-            "database": self.incoherent_db
+            "trajin": "\n".join(["trajin %s" % trajectory for trajectory in trajectories]),
+            "trajectory_output": "ptraj_%s.dcd" % suffix,
+            "mask": self.align_mask
         }
-        format_template("sassenaInc.xml", path, **kw)
-        self.add_replica(name, path)
+        return self.write_artifact(pipeline, name, "rms2first.ptraj", kw)
 
-    def generate_coherent_conf(self, epsilon):
-        "Generate a sassena coherent config file for 'epsilon'"
-        name = "sassenaCoh_%s.xml" % epsilon
-        path = os.path.join(self.outdir, name)
+    def scan_shards(self):
+        """Return a list of (suffix, from, to, points, share) for the parts of the q scan
+        that are computed by separate sassena jobs. 'share' is the fraction of the
+        q points in the shard. Every shard gets at least two points."""
+        if self.q_shards == 1:
+            return [("", self.q_from, self.q_to, self.q_points, 1.0)]
+
+        q_from = float(self.q_from)
+        points = int(self.q_points)
+        step = (float(self.q_to) - q_from) / (points - 1)
+        shards = []
+        first = 0
+        for j in range(self.q_shards):
+            n = points // self.q_shards + (j < points % self.q_shards)
+            last = first + n - 1
+            shards.append(("_q%d" % j, "%g" % (q_from + first * step), "%g" % (q_from + last * step),
+                           str(n), n / float(points)))
+            first = last + 1
+        return shards
+
+    def generate_sassena_conf(self, pipeline, kind, part, shard):
+        """Generate a sassena config file for one analysis 'part' and q 'shard' of 'pipeline'.
+        'kind' is inc for the incoherent or coh for the coherent calculation"""
+        suffix, trajectories, frames = part
+        shard_suffix, q_from, q_to, points, share = shard
+        if kind == "inc":
+            name = "sassenaInc_%s%s.xml" % (suffix, shard_suffix)
+            template = "sassenaInc.xml"
+            database = self.incoherent_db
+        else:
+            name = "sassenaCoh_%s%s.xml" % (suffix, shard_suffix)
+            template = "sassenaCoh.xml"
+            database = self.coherent_db
         kw = {
             "sassena_pdb": self.sassena_pdb,
-            "trajectory": "ptraj_%s.dcd" % epsilon,
-            "output": "fqt_coh_%s.hd5" % epsilon,
-            "database": self.coherent_db
+            "trajectory": "ptraj_%s.dcd" % suffix,
+            "output": "fqt_%s_%s%s.hd5" % (kind, suffix, shard_suffix),
+            "database": database,
+            "scan_from": q_from,
+            "scan_to": q_to,
+            "scan_points": points
         }
-        format_template("sassenaCoh.xml", path, **kw)
-        self.add_replica(name, path)
+        if self.reduce:
+            kw["sassena_pdb"] = self.reduced_pdb
+            kw["trajectory"] = "reduced_%s.dcd" % suffix
+        return self.write_artifact(pipeline, name, template, kw)
 
-    def generate_workflow(self):
-        "Generate a workflow (DAX, config files, and replica catalog)"
-        dax = ADAG("refinement")
+    def generate_pipeline_files(self, pipeline):
+        """Generate all of the config files for 'pipeline' and return their (name, path) pairs.
+        The logical names of the files are also saved in pipeline.artifacts for add_pipeline"""
+        prm = self.generate_prm(pipeline)
+        files = [
+            ("parameters", prm),
+            ("eq_conf", self.generate_eq_conf(pipeline, prm[0])),
+        ]
+        for k, segment in enumerate(self.production_segments(pipeline)):
+            files.append(("prod_conf_%d" % k, self.generate_prod_conf(pipeline, prm[0], segment)))
+        for i, part in enumerate(self.analysis_parts(pipeline)):
+            if self.align == "cpptraj":
+                files.append(("ptraj_conf_%d" % i, self.generate_ptraj_conf(pipeline, part)))
+            for kind in ["inc", "coh"]:
+                for j, shard in enumerate(self.scan_shards()):
+                    conf = self.generate_sassena_conf(pipeline, kind, part, shard)
+                    files.append(("%s_conf_%d_%d" % (kind, i, j), conf))
+        for role, (name, path) in files:
+            pipeline.artifacts[role] = name
+        return [replica for role, replica in files]
+
+    def ordered_pipelines(self):
+        """Return the pipelines of the sweep. With warm start the pipelines that
+        only differ in epsilon are next to each other and sorted by epsilon, so
+        that they end up in the same block."""
+        if self.warm_start:
+            return self.sweep.ordered("epsilon")
+        return self.sweep
+
+    def warm_start_chains(self, pipelines):
+        """Set the seed of each pipeline in 'pipelines', which must come from
+        ordered_pipelines(), and return them in an order in which every seed
+        comes before the pipelines that start from it. Each run of pipelines
+        that only differ in epsilon is one chain: the middle epsilon is the
+        anchor, which runs the full equilibration, and the others start from
+        their neighbour towards the anchor, so the chain is only half as deep."""
+        if not self.warm_start:
+            return pipelines
+
+        def chain_key(pipeline):
+            return [(name, value) for name, value in pipeline.params.items() if name != "epsilon"]
+
+        ordered = []
+        for key, chain in itertools.groupby(pipelines, chain_key):
+            chain = list(chain)
+            anchor = len(chain) // 2
+            ordered.append(chain[anchor])
+            for distance in range(1, len(chain)):
+                for k, towards in ((anchor - distance, 1), (anchor + distance, -1)):
+                    if 0 <= k < len(chain):
+                        chain[k].seed = chain[k + towards].id
+                        ordered.append(chain[k])
+        return ordered
+
+    def generate_files(self, pipelines):
+        """Generate the config files for each pipeline in 'pipelines', add them
+        to the replica catalog, and yield the pipeline. If self.jobs > 1 the
+        files are written by a pool of worker threads, but the replicas are
+        always added in sweep order so that the output is the same as a serial
+        run. Only a few batches of pipelines are ever held in memory."""
+        if self.jobs > 1:
+            pool = ThreadPool(self.jobs)
+            try:
+                for batch in batches(pipelines, self.jobs * 4):
+                    results = pool.map(self.generate_pipeline_files, batch)
+                    for pipeline, replicas in zip(batch, results):
+                        for name, path in replicas:
+                            self.add_replica(name, path)
+                        self.add_to_index(pipeline)
+                        yield pipeline
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for pipeline in pipelines:
+                for name, path in self.generate_pipeline_files(pipeline):
+                    self.add_replica(name, path)
+                self.add_to_index(pipeline)
+                yield pipeline
+
+    def add_to_index(self, pipeline):
+        "Record the parameters of 'pipeline' in pipelines.txt"
+        self.index.write("%s %s\n" % (pipeline.id, pipeline.describe()))
+
+    def add_db_replicas(self):
+        "Add the files from the sassena db cache to the replica catalog"
+        for name, path in self.db_files:
+            self.add_replica(name, path)
+
+    def generate_input_files(self):
+        """Write the placeholder input files of a synthetic workflow, with the sizes
+        from the [keg-input-files] section, and add them to the replica catalog"""
+        if not os.path.isdir(self.input_dir):
+            os.makedirs(self.input_dir)
+        names = [self.sassena_pdb, self.coordinates, self.structure, self.fixed_pdb,
+                 self.extended_system, self.bin_coordinates, self.bin_velocities, self.sassena_db]
+        self.input_files = [(name, os.path.join(self.input_dir, name)) for name in sorted(set(names))]
+        self.keg.generate_input_files(self.input_files)
+        self.add_input_replicas()
+
+    def add_input_replicas(self):
+        "Add the placeholder input files of a synthetic workflow to the replica catalog"
+        for name, path in self.input_files:
+            self.add_replica(name, path)
+
+    def add_keg_jobs(self, dax):
+        "Replace the arguments of every job in 'dax' with pegasus(-mpi)-keg arguments"
+        jobs = [dax.jobs[id] for id in sorted(dax.jobs)]
+        self.keg.add_keg_params_bulk([job for job in jobs if isinstance(job, Job)])
+
+    def validate_inputs(self):
+        "Check that the NAMD input files agree with each other before any job is submitted"
+        start = time.time()
+        summary = namdbin.validate_inputs(self.config, self.input_dir, self.align_mask)
+        print "Checked the inputs in %.0f ms: %s" % ((time.time() - start) * 1000, summary)
+
+    def generate_reduced_pdb(self):
+        "Write the atoms of sassena_pdb that sassena uses to the reduced pdb file"
+        path = os.path.join(self.input_dir, self.sassena_pdb)
+        if not os.path.isfile(path):
+            raise Exception("No such file: %s" % path)
+        self.reduced_pdb_path = os.path.join(self.outdir, self.reduced_pdb)
+        dcdreduce.write_reduced_pdb(path, self.reduced_pdb_path)
+
+    def add_untar_job(self, dax):
+        """Add the job that untars the sassena db to 'dax' and return it. If the
+        db is in the cache, the cached files are added to the replica catalog
+        instead and None is returned."""
+        if self.db_files:
+            self.add_db_replicas()
+            return None
 
-        # These are all the global input files for the workflow
-        sassena_pdb = File(self.sassena_pdb)
-        coordinates = File(self.coordinates)
-        sassena_pdb = File(self.sassena_pdb)
-        structure = File(self.structure)
-        fixed_pdb = File(self.fixed_pdb)
-        extended_system = File(self.extended_system)
-        bin_coordinates = File(self.bin_coordinates)
-        bin_velocities = File(self.bin_velocities)
         sassena_db = File(self.sassena_db)
         incoherent_db = File(self.incoherent_db)
         coherent_db = File(self.coherent_db)
@@ -173,121 +574,489 @@ class RefinementWorkflow(object):
         untarjob.profile("globus", "count", "1")
         dax.addJob(untarjob)
 
-        # For each epsilon that was listed in the config file
-        for epsilon in self.epsilons:
-
-            parameters = "par%s.prm" % epsilon
-
-            # Equilibrate files
-            eq_conf = File("equilibrate_%s.conf" % epsilon)
-            eq_coord = File("equilibrate_%s.restart.coord" % epsilon)
-            eq_xsc = File("equilibrate_%s.restart.xsc" % epsilon)
-            eq_vel = File("equilibrate_%s.restart.vel" % epsilon)
-
-            # Production files
-            prod_conf = File("production_%s.conf" % epsilon)
-            prod_dcd = File("production_%s.dcd" % epsilon)
-
-            # Ptraj files
-            ptraj_conf = File("ptraj_%s.conf" % epsilon)
-            ptraj_dcd = File("ptraj_%s.dcd" % epsilon)
-
-            # Sassena incoherent files
-            incoherent_conf = File("sassenaInc_%s.xml" % epsilon)
-            fqt_incoherent = File("fqt_inc_%s.hd5" % epsilon)
-
-            # Sassena coherent files
-            coherent_conf = File("sassenaCoh_%s.xml" % epsilon)
-            fqt_coherent = File("fqt_coh_%s.hd5" % epsilon)
-
-            # Generate psf and configuration files for this epsilon pipeline
-            self.generate_prm(epsilon)
-            self.generate_eq_conf(epsilon, parameters)
-            self.generate_prod_conf(epsilon, parameters)
-            self.generate_ptraj_conf(epsilon)
-            self.generate_incoherent_conf(epsilon)
-            self.generate_coherent_conf(epsilon)
-
-            # Equilibrate job
-            eqjob = Job("namd", node_label="namd_eq_%s" % epsilon)
-            eqjob.addArguments(eq_conf)
-            eqjob.uses(eq_conf, link=Link.INPUT)
-            eqjob.uses(structure, link=Link.INPUT)
-            eqjob.uses(coordinates, link=Link.INPUT)
-            eqjob.uses(parameters, link=Link.INPUT)
-            eqjob.uses(fixed_pdb, link=Link.INPUT)
-            eqjob.uses(extended_system, link=Link.INPUT)
-            eqjob.uses(bin_coordinates, link=Link.INPUT)
-            eqjob.uses(bin_velocities, link=Link.INPUT)
-            eqjob.uses(eq_coord, link=Link.OUTPUT, transfer=False)
-            eqjob.uses(eq_xsc, link=Link.OUTPUT, transfer=False)
-            eqjob.uses(eq_vel, link=Link.OUTPUT, transfer=False)
-            eqjob.profile("globus", "jobtype", "mpi")
-            eqjob.profile("globus", "maxwalltime", "360")
-            eqjob.profile("globus", "count", "240")
-            dax.addJob(eqjob)
-
-            # Production job
-            prodjob = Job("namd", node_label="namd_prod_%s" % epsilon)
-            prodjob.addArguments(prod_conf)
-            prodjob.uses(prod_conf, link=Link.INPUT)
-            prodjob.uses(structure, link=Link.INPUT)
-            prodjob.uses(coordinates, link=Link.INPUT)
-            prodjob.uses(parameters, link=Link.INPUT)
-            prodjob.uses(fixed_pdb, link=Link.INPUT)
-            prodjob.uses(eq_coord, link=Link.INPUT)
-            prodjob.uses(eq_xsc, link=Link.INPUT)
-            prodjob.uses(eq_vel, link=Link.INPUT)
+        return untarjob
+
+    def cluster_job(self, job, label, position):
+        """Assign 'job' to a label cluster based on the 'position' of its pipeline in
+        the DAX. The workflow must be planned with --cluster label."""
+        job.profile("pegasus", "label", "%s_cluster_%d" % (label, position // self.cluster_size))
+        job.profile("pegasus", "job.aggregator", self.cluster_aggregator)
+        if self.cluster_aggregator == "mpiexec":
+            # One pegasus-mpi-cluster job runs all the tasks in parallel on one node
+            job.profile("pegasus", "cores", "1")
+            job.profile("globus", "jobtype", "mpi")
+            job.profile("globus", "count", str(min(self.cluster_size, CORES_PER_NODE)))
+
+    def add_pipeline(self, dax, pipeline, untarjob=None, position=0):
+        """Add the jobs for 'pipeline' to 'dax'. If 'untarjob' is None then the
+        sassena db is produced outside of 'dax'. 'position' is the index of the
+        pipeline in 'dax', which is used to assign jobs to clusters. Returns the
+        (job, fqt file) of the final result of each sassena calculation."""
+
+        # These are all the global input files for the workflow
+        sassena_pdb = File(self.sassena_pdb)
+        coordinates = File(self.coordinates)
+        structure = File(self.structure)
+        fixed_pdb = File(self.fixed_pdb)
+        extended_system = File(self.extended_system)
+        bin_coordinates = File(self.bin_coordinates)
+        bin_velocities = File(self.bin_velocities)
+
+        parameters = pipeline.artifacts["parameters"]
+
+        # Number of frames in the production trajectory
+        frames = int(pipeline.production_steps) // DCD_FREQUENCY
+
+        # Equilibrate files. These are the final coordinates, velocities and
+        # cell that NAMD writes to outputName.coor/.vel/.xsc
+        eq_conf = File(pipeline.artifacts["eq_conf"])
+        eq_coord = File("equilibrate_%s.coor" % pipeline.id)
+        eq_xsc = File("equilibrate_%s.xsc" % pipeline.id)
+        eq_vel = File("equilibrate_%s.vel" % pipeline.id)
+
+        # Equilibrate job. A warm started pipeline starts from the state
+        # written by the equilibration of its seed instead of the inputs
+        if pipeline.seed is None:
+            eq_inputs = [extended_system, bin_coordinates, bin_velocities]
+        else:
+            eq_inputs = [File("equilibrate_%s.xsc" % pipeline.seed), File("equilibrate_%s.coor" % pipeline.seed),
+                         File("equilibrate_%s.vel" % pipeline.seed)]
+        eqjob = self.namd_job(dax, "namd_eq", pipeline, eq_conf, self.equilibrate_steps(pipeline))
+        for f in [structure, coordinates, parameters, fixed_pdb] + eq_inputs:
+            uses_once(eqjob, f, link=Link.INPUT)
+        eqjob.uses(eq_coord, link=Link.OUTPUT, transfer=False)
+        eqjob.uses(eq_xsc, link=Link.OUTPUT, transfer=False)
+        eqjob.uses(eq_vel, link=Link.OUTPUT, transfer=False)
+        if pipeline.seed is not None:
+            dax.depends(eqjob, self.eqjobs[pipeline.seed])
+        if self.warm_start:
+            self.eqjobs[pipeline.id] = eqjob
+
+        # The settings of the production runs are tuned once per workflow
+        # on the equilibration config of its first pipeline
+        if self.autotune and self.tunejob is None:
+            self.tunejob = self.add_tune_job(dax, pipeline, eq_conf, eq_inputs)
+
+        # Production jobs. Each segment continues from the state written by
+        # the previous one and writes its own chunk of the trajectory
+        prev_job = eqjob
+        prev_state = [eq_coord, eq_xsc, eq_vel]
+        prodjobs = []
+        prod_dcds = []
+        segments = self.production_segments(pipeline)
+        for k, (outputname, inputname, firsttimestep, timesteps) in enumerate(segments):
+            prod_conf = File(pipeline.artifacts["prod_conf_%d" % k])
+            prod_dcd = File("%s.dcd" % outputname)
+            if len(segments) == 1:
+                prodjob = self.namd_job(dax, "namd_prod", pipeline, prod_conf, timesteps)
+            else:
+                prodjob = self.namd_job(dax, "namd_prod", pipeline, prod_conf, timesteps, k)
+            for f in [structure, coordinates, parameters, fixed_pdb] + prev_state:
+                uses_once(prodjob, f, link=Link.INPUT)
+            if self.tunejob is not None:
+                uses_once(prodjob, File(TUNE_FILE), link=Link.INPUT)
+                depends_once(dax, prodjob, self.tunejob)
             prodjob.uses(prod_dcd, link=Link.OUTPUT, transfer=True)
-            prodjob.profile("globus", "jobtype", "mpi")
-            prodjob.profile("globus", "maxwalltime", "5760")
-            prodjob.profile("globus", "count", "240")
-            dax.addJob(prodjob)
-            dax.depends(prodjob, eqjob)
-
-            # ptraj job
-            ptrajjob = Job(namespace="amber", name="ptraj", node_label="amber_ptraj_%s" % epsilon)
-            ptrajjob.addArguments(coordinates)
-            ptrajjob.setStdin(ptraj_conf)
-            ptrajjob.uses(coordinates, link=Link.INPUT)
-            ptrajjob.uses(ptraj_conf, link=Link.INPUT)
-            ptrajjob.uses(prod_dcd, link=Link.INPUT)
-            ptrajjob.uses(ptraj_dcd, link=Link.OUTPUT, transfer=True)
-            ptrajjob.profile("globus", "jobtype", "single")
-            ptrajjob.profile("globus", "maxwalltime", "60")
-            ptrajjob.profile("globus", "count", "1")
+            if k < len(segments) - 1:
+                prev_state = [File("%s.coor" % outputname), File("%s.xsc" % outputname),
+                              File("%s.vel" % outputname)]
+                for f in prev_state:
+                    prodjob.uses(f, link=Link.OUTPUT, transfer=False)
+            depends_once(dax, prodjob, prev_job)
+            prev_job = prodjob
+            prodjobs.append(prodjob)
+            prod_dcds.append(prod_dcd.name)
+
+        # Analysis jobs. There are ptraj and sassena jobs for each part of
+        # the trajectory, and the results of the parts are merged
+        parts = self.analysis_parts(pipeline)
+        kinds = ["inc"]
+        if self.coherent:
+            kinds.append("coh")
+        results = dict((kind, []) for kind in kinds)
+        for i, (suffix, trajectories, part_frames) in enumerate(parts):
+            ptraj_dcd = File("ptraj_%s.dcd" % suffix)
+
+            if self.align == "builtin":
+                # dcdalign job, which does the same fit as ptraj without AMBER
+                ptrajjob = Job(namespace="sns", name="dcd_align", node_label="dcd_align_%s" % suffix)
+                ptrajjob.addArguments("--mask", self.align_mask, ptraj_dcd)
+                for trajectory in trajectories:
+                    ptrajjob.addArguments(File(trajectory))
+                stage = "dcd_align"
+            else:
+                # ptraj job
+                ptraj_conf = File(pipeline.artifacts["ptraj_conf_%d" % i])
+                ptrajjob = Job(namespace="amber", name="ptraj", node_label="amber_ptraj_%s" % suffix)
+                ptrajjob.addArguments(coordinates)
+                ptrajjob.setStdin(ptraj_conf)
+                ptrajjob.uses(coordinates, link=Link.INPUT)
+                ptrajjob.uses(ptraj_conf, link=Link.INPUT)
+                stage = "ptraj"
+            for trajectory in trajectories:
+                ptrajjob.uses(File(trajectory), link=Link.INPUT)
+            ptrajjob.uses(ptraj_dcd, link=Link.OUTPUT, transfer=not self.reduce)
+            count, walltime = self.resources.request(stage, part_frames)
+            if self.cluster_size:
+                # Only the jobs of the same segment are clustered, so that a
+                # cluster does not wait for later segments
+                if len(parts) == 1:
+                    self.cluster_job(ptrajjob, stage, position)
+                else:
+                    self.cluster_job(ptrajjob, "%s_%d" % (stage, i), position)
+            if self.cluster_size == 0 or self.cluster_aggregator != "mpiexec":
+                ptrajjob.profile("globus", "jobtype", "single")
+                ptrajjob.profile("globus", "count", count)
+            ptrajjob.profile("globus", "maxwalltime", walltime)
             dax.addJob(ptrajjob)
-            dax.depends(ptrajjob, prodjob)
-
-            # sassena incoherent job
-            incojob = Job("sassena", node_label="sassena_inc_%s" % epsilon)
-            incojob.addArguments("--config", incoherent_conf)
-            incojob.uses(incoherent_conf, link=Link.INPUT)
-            incojob.uses(ptraj_dcd, link=Link.INPUT)
-            incojob.uses(incoherent_db, link=Link.INPUT)
-            incojob.uses(sassena_pdb, link=Link.INPUT)
-            incojob.uses(fqt_incoherent, link=Link.OUTPUT, transfer=True)
-            incojob.profile("globus", "jobtype", "mpi")
-            incojob.profile("globus", "maxwalltime", "360")
-            incojob.profile("globus", "count", "120")
-            dax.addJob(incojob)
-            dax.depends(incojob, ptrajjob)
-            dax.depends(incojob, untarjob)
-
-            # sassena coherent job
-#            cojob = Job("sassena", node_label="sassena_coh_%s" % epsilon)
-#            cojob.addArguments("--config", coherent_conf)
-#            cojob.uses(coherent_conf, link=Link.INPUT)
-#            cojob.uses(ptraj_dcd, link=Link.INPUT)
-#            cojob.uses(coherent_db, link=Link.INPUT)
-#            cojob.uses(sassena_pdb, link=Link.INPUT)
-#            cojob.uses(fqt_coherent, link=Link.OUTPUT, transfer=True)
-#            cojob.profile("globus", "jobtype", "mpi")
-#            cojob.profile("globus", "maxwalltime", "360")
-#            cojob.profile("globus", "count", "400")
-#            dax.addJob(cojob)
-#            dax.depends(cojob, prodjob)
-#            dax.depends(cojob, untarjob)
+            dax.depends(ptrajjob, prodjobs[prod_dcds.index(trajectories[-1])])
+
+            # dcdreduce job, which keeps only the atoms that sassena uses
+            if self.reduce:
+                reduced_dcd = File("reduced_%s.dcd" % suffix)
+                reducejob = Job(namespace="sns", name="dcd_reduce", node_label="dcd_reduce_%s" % suffix)
+                reducejob.addArguments(sassena_pdb, reduced_dcd, ptraj_dcd)
+                reducejob.uses(sassena_pdb, link=Link.INPUT)
+                reducejob.uses(ptraj_dcd, link=Link.INPUT)
+                reducejob.uses(reduced_dcd, link=Link.OUTPUT, transfer=True)
+                count, walltime = self.resources.request("dcd_reduce", part_frames)
+                if self.cluster_size:
+                    if len(parts) == 1:
+                        self.cluster_job(reducejob, "dcd_reduce", position)
+                    else:
+                        self.cluster_job(reducejob, "dcd_reduce_%d" % i, position)
+                if self.cluster_size == 0 or self.cluster_aggregator != "mpiexec":
+                    reducejob.profile("globus", "jobtype", "single")
+                    reducejob.profile("globus", "count", count)
+                reducejob.profile("globus", "maxwalltime", walltime)
+                dax.addJob(reducejob)
+                dax.depends(reducejob, ptrajjob)
+                sassena_dcd = reduced_dcd
+                sassena_structure = File(self.reduced_pdb)
+                sassena_parent = reducejob
+            else:
+                sassena_dcd = ptraj_dcd
+                sassena_structure = sassena_pdb
+                sassena_parent = ptrajjob
+
+            for kind in kinds:
+                results[kind].append(self.add_sassena_jobs(dax, pipeline, kind, i, suffix, part_frames,
+                                                           sassena_dcd, sassena_structure,
+                                                           sassena_parent, untarjob))
+
+        # fqt merge jobs, which combine the sassena results of the segments
+        final = []
+        for kind in kinds:
+            if len(parts) > 1:
+                final.append(self.add_merge_job(dax, pipeline, kind, frames, results[kind]))
+            else:
+                final.append(results[kind][0])
+        return final
+
+    def add_tune_job(self, dax, pipeline, eq_conf, eq_inputs):
+        """Add the job that benchmarks the neighbour list settings on the
+        equilibration config 'eq_conf' of 'pipeline', which reads 'eq_inputs'
+        as its starting state, and writes the fastest settings to TUNE_FILE"""
+        tunejob = Job(namespace="sns", name="namd_tune", node_label="namd_tune")
+        candidates = namdtune.parse_candidates(self.autotune_candidates or namdtune.CANDIDATES)
+        steps = self.autotune_steps or namdtune.STEPS
+        count, walltime = self.resources.request("namd_tune", steps * len(candidates))
+        tunejob.addArguments("--cores", count, "--steps", str(steps))
+        if self.autotune_candidates:
+            tunejob.addArguments("--candidates", ",".join([":".join(c) for c in candidates]))
+        tunejob.addArguments(eq_conf, File(TUNE_FILE))
+        tunejob.uses(eq_conf, link=Link.INPUT)
+        for f in [File(self.structure), File(self.coordinates), pipeline.artifacts["parameters"],
+                  File(self.fixed_pdb)] + eq_inputs:
+            tunejob.uses(f, link=Link.INPUT)
+        tunejob.uses(File(TUNE_FILE), link=Link.OUTPUT, transfer=False)
+        # The wrapper runs on the head node and launches NAMD on the cores itself
+        tunejob.profile("globus", "jobtype", "single")
+        tunejob.profile("globus", "maxwalltime", walltime)
+        tunejob.profile("globus", "count", count)
+        dax.addJob(tunejob)
+        return tunejob
+
+    def namd_job(self, dax, stage, pipeline, conf, timesteps, segment=None):
+        """Add a NAMD job of 'stage' (namd_eq or namd_prod) that runs the config
+        file 'conf' of 'pipeline' for 'timesteps' steps, and return it. 'segment'
+        is the number of the production segment, if it is segmented. In
+        multi-copy mode all the pipelines in 'dax' share one job for each stage
+        and segment, 'conf' becomes one of its replicas, and the job is
+        completed by finish_multicopy()."""
+        if self.multicopy:
+            label = "%s_multicopy" % stage
+            if segment is not None:
+                label += "_%d" % segment
+            for job, replica_stage, replicas in self.replica_jobs:
+                if job.node_label == label:
+                    break
+            else:
+                job = Job("namd", node_label=label)
+                dax.addJob(job)
+                replicas = []
+                self.replica_jobs.append((job, stage, replicas))
+            job.uses(conf, link=Link.INPUT)
+            replicas.append((pipeline.id, conf.name, timesteps))
+            return job
+
+        label = "%s_%s" % (stage, pipeline.id)
+        if segment is not None:
+            label += "_%d" % segment
+        job = Job("namd", node_label=label)
+        job.addArguments(conf)
+        job.uses(conf, link=Link.INPUT)
+        count, walltime = self.resources.request(stage, timesteps)
+        job.profile("globus", "jobtype", "mpi")
+        job.profile("globus", "maxwalltime", walltime)
+        job.profile("globus", "count", count)
+        dax.addJob(job)
+        return job
+
+    def finish_multicopy(self, suffix=""):
+        """Write the launcher config file of each multi-copy NAMD job and add
+        its arguments and resources. Each replica gets the cores that a single
+        job would have, and the job runs as long as the longest replica.
+        'suffix' is added to the names of the launcher files."""
+        for job, stage, replicas in self.replica_jobs:
+            name = "%s%s.conf" % (job.node_label, suffix)
+            kw = {
+                "replicas": len(replicas),
+                "configs": "\n".join(["    %s" % conf for id, conf, steps in replicas])
+            }
+            path = os.path.join(self.outdir, name)
+            if self.manifest is None:
+                format_template("multicopy.conf", path, **kw)
+            else:
+                # The launcher belongs to all of its replica pipelines
+                chunks = render_template("multicopy.conf", **kw)
+                digest = digest_chunks(chunks)
+                for id, conf, steps in replicas:
+                    path = self.manifest.write_chunks(id, name, chunks, digest)
+            self.add_replica(name, path)
+
+            launcher = File(name)
+            job.addArguments("+replicas", str(len(replicas)), launcher)
+            job.uses(launcher, link=Link.INPUT)
+            count, walltime = self.resources.request(stage, max(steps for id, conf, steps in replicas))
+            job.profile("globus", "jobtype", "mpi")
+            job.profile("globus", "maxwalltime", walltime)
+            job.profile("globus", "count", str(int(count) * len(replicas)))
+        self.replica_jobs = []
+
+    def add_sassena_jobs(self, dax, pipeline, kind, i, suffix, frames, trajectory, structure, parent, untarjob):
+        """Add the sassena jobs of 'kind' (inc or coh) for the analysis part 'i' of 'pipeline'
+        to 'dax'. There is one job for each shard of the q scan, and if there is more
+        than one shard a job that concatenates their outputs. Returns the last job and
+        the fqt file that it writes."""
+        stage = "sassena_%s" % kind
+        if kind == "inc":
+            database = File(self.incoherent_db)
+        else:
+            database = File(self.coherent_db)
+        fqt = File("fqt_%s_%s.hd5" % (kind, suffix))
+
+        shards = self.scan_shards()
+        cores = self.resources.cores(stage)
+        shard_cores = int(math.ceil(cores / float(len(shards)) / CORES_PER_NODE)) * CORES_PER_NODE
+
+        jobs = []
+        outputs = []
+        for j, (shard, q_from, q_to, points, share) in enumerate(shards):
+            conf = File(pipeline.artifacts["%s_conf_%d_%d" % (kind, i, j)])
+            output = File("fqt_%s_%s%s.hd5" % (kind, suffix, shard))
+            job = Job("sassena", node_label="%s_%s%s" % (stage, suffix, shard))
+            job.addArguments("--config", conf)
+            job.uses(conf, link=Link.INPUT)
+            job.uses(trajectory, link=Link.INPUT)
+            job.uses(database, link=Link.INPUT)
+            for name, path in self.db_files:
+                if name.startswith("database/definitions/"):
+                    job.uses(File(name), link=Link.INPUT)
+            job.uses(structure, link=Link.INPUT)
+            job.uses(output, link=Link.OUTPUT, transfer=len(shards) == 1)
+            if len(shards) == 1:
+                count, walltime = self.resources.request(stage, frames)
+            else:
+                count, walltime = self.resources.request(stage, frames * share, shard_cores)
+            job.profile("globus", "jobtype", "mpi")
+            job.profile("globus", "maxwalltime", walltime)
+            job.profile("globus", "count", count)
+            dax.addJob(job)
+            dax.depends(job, parent)
+            if untarjob is not None:
+                dax.depends(job, untarjob)
+            jobs.append(job)
+            outputs.append(output)
+
+        if len(shards) == 1:
+            return jobs[0], fqt
+
+        # fqt concat job, which joins the q vectors of the shards
+        if kind == "inc":
+            label = "fqt_concat_%s" % suffix
+        else:
+            label = "fqt_concat_coh_%s" % suffix
+        concatjob = Job(namespace="sns", name="fqt_merge", node_label=label)
+        concatjob.addArguments("--concat", fqt, *outputs)
+        for output in outputs:
+            concatjob.uses(output, link=Link.INPUT)
+        concatjob.uses(fqt, link=Link.OUTPUT, transfer=True)
+        count, walltime = self.resources.request("fqt_concat", frames)
+        concatjob.profile("globus", "jobtype", "single")
+        concatjob.profile("globus", "count", count)
+        concatjob.profile("globus", "maxwalltime", walltime)
+        dax.addJob(concatjob)
+        for job in jobs:
+            dax.depends(concatjob, job)
+        return concatjob, fqt
+
+    def add_merge_job(self, dax, pipeline, kind, frames, results):
+        """Add the job that combines the fqt files of the segments of 'pipeline' to 'dax'.
+        'results' are the (job, fqt file) of each segment. Returns the job and its fqt file"""
+        fqt = File("fqt_%s_%s.hd5" % (kind, pipeline.id))
+        if kind == "inc":
+            label = "fqt_merge_%s" % pipeline.id
+        else:
+            label = "fqt_merge_coh_%s" % pipeline.id
+        mergejob = Job(namespace="sns", name="fqt_merge", node_label=label)
+        mergejob.addArguments(fqt, *[part for job, part in results])
+        for job, part in results:
+            mergejob.uses(part, link=Link.INPUT)
+        mergejob.uses(fqt, link=Link.OUTPUT, transfer=True)
+        count, walltime = self.resources.request("fqt_merge", frames)
+        mergejob.profile("globus", "jobtype", "single")
+        mergejob.profile("globus", "count", count)
+        mergejob.profile("globus", "maxwalltime", walltime)
+        dax.addJob(mergejob)
+        for job, part in results:
+            dax.depends(mergejob, job)
+        return mergejob, fqt
+
+    def add_store_job(self, dax):
+        """Add the job that collects the fqt files of all the pipelines in
+        pipelines.txt into one HDF5 store (fqtstore.py) to 'dax'"""
+        index = File("pipelines.txt")
+        store = File("fqt_store.h5")
+        storejob = Job(namespace="sns", name="fqt_store", node_label="fqt_store")
+        if self.coherent:
+            storejob.addArguments("--coherent")
+        storejob.addArguments(index, store)
+        storejob.uses(index, link=Link.INPUT)
+        parents = []
+        seen = set()
+        for job, fqt in self.results:
+            storejob.uses(fqt, link=Link.INPUT)
+            if id(job) not in seen:
+                seen.add(id(job))
+                parents.append(job)
+        storejob.uses(store, link=Link.OUTPUT, transfer=True)
+        count, walltime = self.resources.request("fqt_store", len(self.sweep))
+        storejob.profile("globus", "jobtype", "single")
+        storejob.profile("globus", "count", count)
+        storejob.profile("globus", "maxwalltime", walltime)
+        dax.addJob(storejob)
+        for job in parents:
+            dax.depends(storejob, job)
+        self.add_replica("pipelines.txt", os.path.join(self.outdir, "pipelines.txt"))
+
+    def generate_block(self, dax, untarjob, index, pipelines):
+        """Generate a sub-workflow for 'pipelines' with its own DAX and replica
+        catalog, and add a DAX job for it to 'dax'. The block is planned by
+        Pegasus when the DAX job becomes ready."""
+        name = "block_%04d" % index
+        daxname = "%s.xml" % name
+        daxpath = os.path.join(self.outdir, daxname)
+        rcpath = os.path.join(self.outdir, "rc_%s.txt" % name)
+
+        self.replicas = {}
+        self.eqjobs = {}
+        self.tunejob = None
+        self.add_db_replicas()
+        self.add_input_replicas()
+        if self.reduce:
+            self.add_replica(self.reduced_pdb, self.reduced_pdb_path)
+
+        subdax = ADAG("refinement-%s" % name)
+        results = []
+        pipelines = self.warm_start_chains(pipelines)
+        for position, pipeline in enumerate(self.generate_files(pipelines)):
+            results += self.add_pipeline(subdax, pipeline, position=position)
+        if self.multicopy:
+            self.finish_multicopy("_%s" % name)
+        if self.keg is not None:
+            self.add_keg_jobs(subdax)
+        subdax.writeXMLFile(daxpath)
+        self.generate_replica_catalog(rcpath)
+
+        daxjob = DAX(daxname, node_label=name)
+        daxjob.addArguments("-Dpegasus.catalog.replica=File",
+                            "-Dpegasus.catalog.replica.file=%s" % rcpath,
+                            "--input-dir", INPUT_DIR,
+                            "--cluster", "label",
+                            "--cleanup", "leaf")
+        daxjob.uses(File(daxname), link=Link.INPUT)
+        dax.addDAX(daxjob)
+
+        # The sassena db produced by the untar job in the parent workflow is
+        # found by the sub-workflow planner through the parent's cache file
+        if untarjob is not None:
+            daxjob.uses(File(self.incoherent_db), link=Link.INPUT)
+            daxjob.uses(File(self.coherent_db), link=Link.INPUT)
+            dax.depends(daxjob, untarjob)
+
+        # The results of the block are used by the fqt store job
+        if self.store:
+            for job, fqt in results:
+                daxjob.uses(fqt, link=Link.OUTPUT, transfer=False)
+                self.results.append((daxjob, fqt))
+
+        return daxname, daxpath
+
+    def generate_workflow(self):
+        "Generate a workflow (DAX, config files, and replica catalog)"
+        dax = ADAG("refinement")
+
+        if self.keg is not None:
+            self.generate_input_files()
+
+        untarjob = self.add_untar_job(dax)
+
+        if self.reduce:
+            self.generate_reduced_pdb()
+            self.add_replica(self.reduced_pdb, self.reduced_pdb_path)
+
+        # The pipelines are named by a hash of their parameters, and this
+        # file maps the names back to the parameters
+        self.index = open(os.path.join(self.outdir, "pipelines.txt"), "w")
+        try:
+            if self.block_size:
+                # Each block of pipelines becomes a sub-workflow, and the top-level
+                # replica catalog only contains the sub-workflow DAXes
+                blocks = []
+                for pipelines in batches(self.ordered_pipelines(), self.block_size):
+                    blocks.append(self.generate_block(dax, untarjob, len(blocks), pipelines))
+                self.replicas = {}
+                self.add_input_replicas()
+                for name, path in blocks:
+                    self.add_replica(name, path)
+            else:
+                # For each pipeline in the sweep, generate the config files and add the jobs
+                pipelines = self.warm_start_chains(self.ordered_pipelines())
+                for position, pipeline in enumerate(self.generate_files(pipelines)):
+                    results = self.add_pipeline(dax, pipeline, untarjob, position)
+                    if self.store:
+                        self.results += results
+                if self.multicopy:
+                    self.finish_multicopy()
+        finally:
+            self.index.close()
+
+        if self.store:
+            self.add_store_job(dax)
+
+        if self.keg is not None:
+            self.add_keg_jobs(dax)
 
         # Write the DAX file
         dax.writeXMLFile(self.daxfile)
@@ -295,29 +1064,107 @@ class RefinementWorkflow(object):
         # Finally, generate the replica catalog
         self.generate_replica_catalog()
 
+        if self.manifest is not None:
+            self.report_changes()
+
 def main():
-    if len(sys.argv) != 3:
-        raise Exception("Usage: %s CONFIGFILE OUTDIR" % sys.argv[0])
+    parser = OptionParser(usage="%prog [options] CONFIGFILE OUTDIR")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Number of threads used to write the config files [default: %default]")
+    parser.add_option("-b", "--block-size", dest="block_size", type="int", default=0,
+                      help="Split the workflow into sub-workflows of this many pipelines [default: no split]")
+    parser.add_option("-i", "--incremental", dest="incremental", action="store_true", default=False,
+                      help="Update an existing OUTDIR, only rewriting the files that changed")
+    parser.add_option("-d", "--dedup", dest="dedup", action="store_true", default=False,
+                      help="Name generated files by their content so that identical files are only staged once")
+    parser.add_option("-c", "--cluster-size", dest="cluster_size", default="0",
+                      help="Cluster this many ptraj (or dcd_align) jobs into one job, or 'auto' to derive it from the number of pipelines [default: no clustering]")
+    parser.add_option("-a", "--cluster-aggregator", dest="cluster_aggregator", default="seqexec",
+                      choices=["seqexec", "mpiexec"],
+                      help="Run clustered jobs one after another (seqexec) or with pegasus-mpi-cluster (mpiexec) [default: %default]")
+    parser.add_option("-s", "--stream", dest="stream", action="store_true", default=False,
+                      help="Run ptraj and sassena on each production segment as soon as it is finished, and merge the results")
+    parser.add_option("-A", "--align", dest="align", default="cpptraj",
+                      choices=["cpptraj", "builtin"],
+                      help="Fit the trajectory with ptraj (cpptraj) or with dcdalign.py (builtin) [default: %default]")
+    parser.add_option("-r", "--reduce", dest="reduce", action="store_true", default=False,
+                      help="Stage only the atoms of the fitted trajectory that sassena selects from sassena_pdb")
+    parser.add_option("-q", "--q-shards", dest="q_shards", type="int", default=1,
+                      help="Split the q scan of each sassena calculation into this many jobs [default: %default]")
+    parser.add_option("-C", "--coherent", dest="coherent", action="store_true", default=False,
+                      help="Also run the coherent sassena calculation")
+    parser.add_option("-S", "--store", dest="store", action="store_true", default=False,
+                      help="Add a final job that collects the fqt results of all pipelines into fqt_store.h5")
+    parser.add_option("-m", "--multicopy", dest="multicopy", action="store_true", default=False,
+                      help="Run the NAMD jobs of all pipelines as the replicas of one multi-copy NAMD job per stage")
+    parser.add_option("-V", "--no-validate", dest="validate", action="store_false", default=True,
+                      help="Do not check that the NAMD input files agree with each other before writing the workflow")
+    parser.add_option("-t", "--autotune", dest="autotune", action="store_true", default=False,
+                      help="Benchmark the neighbour list settings in [namd] before the production runs and use the fastest")
+    parser.add_option("-w", "--warm-start", dest="warm_start", action="store_true", default=False,
+                      help="Start the equilibration of each epsilon from the equilibrated state of its neighbour")
+    parser.add_option("-k", "--synthetic", dest="synthetic", action="store_true", default=False,
+                      help="Generate a synthetic workflow of pegasus(-mpi)-keg jobs from the keg-* sections of the config file")
+    parser.add_option("-e", "--seed", dest="seed", type="int", default=0,
+                      help="Seed of the values sampled for a synthetic workflow [default: %default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Wrong number of arguments")
+
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if options.block_size < 0:
+        parser.error("--block-size cannot be negative")
+
+    if options.cluster_size != "auto":
+        try:
+            options.cluster_size = int(options.cluster_size)
+        except ValueError:
+            parser.error("--cluster-size must be a number or 'auto'")
+        if options.cluster_size < 0:
+            parser.error("--cluster-size cannot be negative")
 
-    configfile = sys.argv[1]
-    outdir = sys.argv[2]
+    configfile = args[0]
+    outdir = args[1]
 
     if not os.path.isfile(configfile):
         raise Exception("No such file: %s" % configfile)
 
-    if os.path.isdir(outdir):
+    if os.path.isdir(outdir) and not options.incremental:
         raise Exception("Directory exists: %s" % outdir)
 
     # Create the output directory
     outdir = os.path.abspath(outdir)
-    os.makedirs(outdir)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
 
     # Read the config file
     config = ConfigParser()
     config.read(configfile)
 
     # Generate the workflow in outdir based on the config file
-    workflow = RefinementWorkflow(outdir, config)
+    workflow = RefinementWorkflow(outdir, config, jobs=options.jobs,
+                                  block_size=options.block_size,
+                                  incremental=options.incremental,
+                                  dedup=options.dedup,
+                                  cluster_size=options.cluster_size,
+                                  cluster_aggregator=options.cluster_aggregator,
+                                  stream=options.stream,
+                                  align=options.align,
+                                  reduce=options.reduce,
+                                  q_shards=options.q_shards,
+                                  coherent=options.coherent,
+                                  store=options.store,
+                                  warm_start=options.warm_start,
+                                  multicopy=options.multicopy,
+                                  autotune=options.autotune,
+                                  synthetic=options.synthetic,
+                                  seed=options.seed)
+    # The inputs of a synthetic workflow are placeholders
+    if options.validate and not options.synthetic:
+        workflow.validate_inputs()
     workflow.generate_workflow()
 
 
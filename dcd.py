@@ -0,0 +1,163 @@
+import os
+import struct
+import numpy
+
+# The first record of a DCD file is 84 bytes long: "CORD" and 20 control integers
+HEADER_RECORD_SIZE = 84
+
+class DCDFile(object):
+    """A CHARMM/NAMD DCD trajectory that is read through numpy.memmap, so only
+    the frames that are used are read from disk. Each frame is stored as
+    three Fortran records of float32 (x, y and z of every atom), optionally
+    preceded by a record with the unit cell."""
+
+    def __init__(self, path, mode="r"):
+        "'path' is the DCD file and 'mode' is the numpy.memmap mode ('r' or 'r+')"
+        self.path = path
+
+        f = open(path, "rb")
+        try:
+            self.read_header(f)
+        finally:
+            f.close()
+
+        size = os.path.getsize(path) - self.header_size
+        self.nframes = size // self.frame_dtype.itemsize
+        if self.nframes:
+            self.frames = numpy.memmap(path, dtype=self.frame_dtype, mode=mode,
+                                       offset=self.header_size, shape=(self.nframes,))
+        else:
+            self.frames = numpy.zeros(0, dtype=self.frame_dtype)
+
+    def read_record(self, f):
+        "Read one Fortran unformatted record from 'f'"
+        size, = struct.unpack(self.endian + "i", f.read(4))
+        data = f.read(size)
+        end, = struct.unpack(self.endian + "i", f.read(4))
+        if len(data) != size or end != size:
+            raise Exception("Corrupt DCD record in %s" % self.path)
+        return data
+
+    def read_header(self, f):
+        "Read the header records and build the dtype of a frame"
+        marker = f.read(4)
+        if struct.unpack("<i", marker)[0] == HEADER_RECORD_SIZE:
+            self.endian = "<"
+        elif struct.unpack(">i", marker)[0] == HEADER_RECORD_SIZE:
+            self.endian = ">"
+        else:
+            raise Exception("Not a DCD file: %s" % self.path)
+        f.seek(0)
+
+        self.control = self.read_record(f)
+        if self.control[:4] != "CORD":
+            raise Exception("Not a coordinate DCD file: %s" % self.path)
+        icntrl = struct.unpack(self.endian + "20i", self.control[4:])
+        self.has_unit_cell = icntrl[10] != 0
+        self.fixed_atoms = icntrl[8]
+        if self.fixed_atoms:
+            raise Exception("DCD files with fixed atoms are not supported: %s" % self.path)
+
+        self.title = self.read_record(f)
+        self.natoms, = struct.unpack(self.endian + "i", self.read_record(f))
+        self.header_size = f.tell()
+
+        self.frame_dtype = frame_dtype(self.natoms, self.has_unit_cell, self.endian)
+
+    def header(self, nframes, natoms=None):
+        "Return the header bytes of a copy of this file that has 'nframes' frames of 'natoms' atoms"
+        if natoms is None:
+            natoms = self.natoms
+        control = self.control[:4] + struct.pack(self.endian + "i", nframes) + self.control[8:]
+        return "".join([record(self.endian, control), record(self.endian, self.title),
+                        record(self.endian, struct.pack(self.endian + "i", natoms))])
+
+    def __len__(self):
+        return self.nframes
+
+    def coordinates(self, start, stop):
+        "Return the coordinates of frames start..stop-1 as a (frames, atoms, 3) float32 array"
+        frames = self.frames[start:stop]
+        return numpy.dstack([frames["x"], frames["y"], frames["z"]])
+
+    def set_coordinates(self, start, xyz):
+        "Store the (frames, atoms, 3) array 'xyz' in the frames starting at 'start'"
+        frames = self.frames[start:start + len(xyz)]
+        frames["x"] = xyz[:, :, 0]
+        frames["y"] = xyz[:, :, 1]
+        frames["z"] = xyz[:, :, 2]
+
+    def close(self):
+        "Flush any changes and release the memory map"
+        if isinstance(self.frames, numpy.memmap):
+            self.frames.flush()
+        self.frames = None
+
+def record(endian, data):
+    "Return 'data' as a Fortran unformatted record"
+    marker = struct.pack(endian + "i", len(data))
+    return marker + data + marker
+
+def frame_dtype(natoms, has_unit_cell, endian="<"):
+    "Return the numpy dtype of one DCD frame with the Fortran record markers"
+    fields = []
+    if has_unit_cell:
+        fields += [("cell_begin", endian + "i4"), ("cell", endian + "f8", (6,)), ("cell_end", endian + "i4")]
+    for axis in "xyz":
+        fields += [(axis + "_begin", endian + "i4"), (axis, endian + "f4", (natoms,)), (axis + "_end", endian + "i4")]
+    return numpy.dtype(fields)
+
+def create_like(path, template, nframes, natoms=None):
+    """Create a DCD file at 'path' with the same header as the DCDFile
+    'template' and room for 'nframes' frames of 'natoms' atoms (by default
+    the atoms of the template), and return it opened for writing. The record
+    markers of all frames are filled in, and the unit cells and coordinates
+    are left to the caller."""
+    if natoms is None:
+        natoms = template.natoms
+    dtype = frame_dtype(natoms, template.has_unit_cell, template.endian)
+    f = open(path, "wb")
+    try:
+        f.write(template.header(nframes, natoms))
+        f.truncate(f.tell() + nframes * dtype.itemsize)
+    finally:
+        f.close()
+
+    dcdfile = DCDFile(path, mode="r+")
+    for name, size in record_sizes(dtype):
+        dcdfile.frames[name + "_begin"] = size
+        dcdfile.frames[name + "_end"] = size
+    return dcdfile
+
+def record_sizes(dtype):
+    "Return the (field, record size in bytes) of each record in the frame 'dtype'"
+    sizes = []
+    for name in dtype.names:
+        if name.endswith("_begin") or name.endswith("_end"):
+            continue
+        sizes.append((name, dtype.fields[name][0].itemsize))
+    return sizes
+
+def copy_frames(source, start, stop, dest, dest_start):
+    "Copy frames start..stop-1 of the DCDFile 'source' to 'dest' starting at frame 'dest_start'"
+    dest.frames[dest_start:dest_start + stop - start] = source.frames[start:stop]
+
+def parse_mask(mask, natoms=None):
+    """Return the 0-based atom indices selected by a ptraj atom number mask
+    such as '@1-92214' or '@1-10,20,30-40'"""
+    if not mask.startswith("@"):
+        raise Exception("Only atom number masks (@N-M,...) are supported: %s" % mask)
+    indices = []
+    for item in mask[1:].split(","):
+        item = item.strip()
+        if "-" in item:
+            first, last = item.split("-", 1)
+            indices.extend(range(int(first) - 1, int(last)))
+        elif item:
+            indices.append(int(item) - 1)
+    indices = numpy.unique(numpy.array(indices, dtype=int))
+    if len(indices) == 0:
+        raise Exception("Empty atom mask: %s" % mask)
+    if indices[0] < 0 or (natoms is not None and indices[-1] >= natoms):
+        raise Exception("Atom mask %s is out of range" % mask)
+    return indices
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import sys
+import numpy
+from optparse import OptionParser
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import dcd
+
+# Number of frames fitted at a time. With 132822 atoms one chunk of
+# float32 coordinates is about 100 MB.
+CHUNK_SIZE = 64
+
+def kabsch(mobile, reference):
+    """Return the rotations and centers that superpose each frame in 'mobile'
+    (frames, atoms, 3) onto 'reference' (atoms, 3), which must be centered.
+    A frame x is fitted by (x - center).dot(rotation)."""
+    centers = mobile.mean(axis=1)
+    mobile = mobile - centers[:, numpy.newaxis, :]
+
+    # The covariance of every frame with the reference, and its SVD
+    covariance = numpy.einsum("fai,aj->fij", mobile, reference)
+    u, s, vt = numpy.linalg.svd(covariance)
+
+    # Make sure the rotations are proper (no reflections)
+    d = numpy.sign(numpy.linalg.det(numpy.einsum("fij,fjk->fik", u, vt)))
+    u[:, :, 2] *= d[:, numpy.newaxis]
+
+    rotations = numpy.einsum("fij,fjk->fik", u, vt)
+    return rotations, centers
+
+def align_chunk(task):
+    """Fit frames start..stop-1 of 'source' and write them to 'output' starting
+    at frame 'out_start'. The files are opened here so that the chunks can be
+    processed by a pool of threads or processes."""
+    source, start, stop, output, out_start, reference, reference_center, indices = task
+    infile = dcd.DCDFile(source)
+    outfile = dcd.DCDFile(output, mode="r+")
+    try:
+        # Copy the frames first to get the unit cells and record markers
+        dcd.copy_frames(infile, start, stop, outfile, out_start)
+
+        xyz = infile.coordinates(start, stop)
+        rotations, centers = kabsch(xyz[:, indices, :].astype(numpy.float64), reference)
+
+        xyz -= centers[:, numpy.newaxis, :].astype(numpy.float32)
+        xyz = numpy.einsum("fai,fij->faj", xyz, rotations.astype(numpy.float32))
+        xyz += reference_center.astype(numpy.float32)
+        outfile.set_coordinates(out_start, xyz)
+    finally:
+        infile.close()
+        outfile.close()
+    return stop - start
+
+def align_trajectories(inputs, output, mask, chunk_size=CHUNK_SIZE, jobs=1, processes=False):
+    """RMS-fit every frame of the DCD files in 'inputs' to the first frame of
+    the first file, using the atoms selected by the ptraj atom number 'mask',
+    and write the fitted frames of all the inputs to the DCD file 'output'.
+    This does the same as 'rms first <mask>' in ptraj. If 'jobs' > 1 the
+    chunks are fitted by a pool of threads, or of processes if 'processes'
+    is set. Returns the number of frames written."""
+    files = [dcd.DCDFile(path) for path in inputs]
+    first = files[0]
+    for f in files[1:]:
+        if f.natoms != first.natoms or f.has_unit_cell != first.has_unit_cell:
+            raise Exception("%s does not have the same atoms as %s" % (f.path, first.path))
+    if len(first) == 0:
+        raise Exception("No frames in %s" % first.path)
+
+    indices = dcd.parse_mask(mask, first.natoms)
+    reference = first.coordinates(0, 1)[0, indices, :].astype(numpy.float64)
+    reference_center = reference.mean(axis=0)
+    reference = reference - reference_center
+
+    nframes = sum(len(f) for f in files)
+    dcd.create_like(output, first, nframes).close()
+
+    tasks = []
+    out_start = 0
+    for f in files:
+        for start in range(0, len(f), chunk_size):
+            stop = min(start + chunk_size, len(f))
+            tasks.append((f.path, start, stop, output, out_start, reference, reference_center, indices))
+            out_start += stop - start
+    for f in files:
+        f.close()
+
+    if jobs > 1:
+        if processes:
+            pool = Pool(jobs)
+        else:
+            pool = ThreadPool(jobs)
+        try:
+            written = sum(pool.map(align_chunk, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = sum(map(align_chunk, tasks))
+
+    return written
+
+def main():
+    parser = OptionParser(usage="%prog [options] OUTPUT INPUT...")
+    parser.add_option("-m", "--mask", dest="mask", default="@1-92214",
+                      help="Atoms used for the fit, as a ptraj atom number mask [default: %default]")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int", default=CHUNK_SIZE,
+                      help="Number of frames fitted at a time [default: %default]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Number of threads (or processes) that fit chunks in parallel [default: %default]")
+    parser.add_option("-p", "--processes", dest="processes", action="store_true", default=False,
+                      help="Use a pool of processes instead of threads")
+    options, args = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Wrong number of arguments")
+
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    output = args[0]
+    inputs = args[1:]
+
+    frames = align_trajectories(inputs, output, options.mask, options.chunk_size,
+                                options.jobs, options.processes)
+    print "Wrote %d frames to %s" % (frames, output)
+
+
+if __name__ == '__main__':
+    main()
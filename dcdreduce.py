@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import re
+import numpy
+from optparse import OptionParser
+import dcd
+
+# The selection of the atoms that sassena uses: the atoms whose beta column
+# in sassena_pdb matches this (see the <selection> in the sassena templates)
+SELECTION = r"1|1\.0|1\.00"
+
+# Number of frames copied at a time
+CHUNK_SIZE = 256
+
+def is_atom(line):
+    "Return True if 'line' is an atom record of a PDB file"
+    return line.startswith("ATOM") or line.startswith("HETATM")
+
+def read_selection(pdb, expression=SELECTION):
+    "Return the 0-based indices of the atoms in 'pdb' whose beta column matches 'expression'"
+    pattern = re.compile("(%s)$" % expression)
+    indices = []
+    f = open(pdb)
+    try:
+        index = 0
+        for line in f:
+            if not is_atom(line):
+                continue
+            if pattern.match(line[60:66].strip()):
+                indices.append(index)
+            index += 1
+    finally:
+        f.close()
+    if not indices:
+        raise Exception("No atoms in %s match the selection %s" % (pdb, expression))
+    return numpy.array(indices)
+
+def write_reduced_pdb(pdb, output, expression=SELECTION):
+    """Write a copy of 'pdb' to 'output' that only has the selected atoms.
+    CONECT records refer to the old atom numbers, so they are left out."""
+    pattern = re.compile("(%s)$" % expression)
+    f = open(pdb)
+    try:
+        out = open(output, "w")
+        try:
+            for line in f:
+                if line.startswith("CONECT"):
+                    continue
+                if is_atom(line) and not pattern.match(line[60:66].strip()):
+                    continue
+                out.write(line)
+        finally:
+            out.close()
+    finally:
+        f.close()
+
+def reduce_trajectory(source, output, indices, chunk_size=CHUNK_SIZE):
+    "Write the atoms 'indices' of every frame of the DCD file 'source' to 'output'. Returns the number of frames."
+    infile = dcd.DCDFile(source)
+    if indices[-1] >= infile.natoms:
+        raise Exception("%s has %d atoms, but the selection needs %d" % (source, infile.natoms, indices[-1] + 1))
+    nframes = len(infile)
+    outfile = dcd.create_like(output, infile, nframes, len(indices))
+    try:
+        for start in range(0, nframes, chunk_size):
+            stop = min(start + chunk_size, nframes)
+            frames = infile.frames[start:stop]
+            if infile.has_unit_cell:
+                outfile.frames["cell"][start:stop] = frames["cell"]
+            for axis in "xyz":
+                outfile.frames[axis][start:stop] = frames[axis][:, indices]
+    finally:
+        infile.close()
+        outfile.close()
+    return nframes
+
+def main():
+    parser = OptionParser(usage="%prog [options] PDB OUTPUT INPUT")
+    parser.add_option("-e", "--expression", dest="expression", default=SELECTION,
+                      help="Regular expression for the beta column of the selected atoms [default: %default]")
+    parser.add_option("-p", "--pdb-output", dest="pdb_output", default=None,
+                      help="Also write the selected atoms of PDB to this file")
+    options, args = parser.parse_args()
+
+    if len(args) != 3:
+        parser.error("Wrong number of arguments")
+
+    pdb, output, source = args
+
+    indices = read_selection(pdb, options.expression)
+    frames = reduce_trajectory(source, output, indices)
+    if options.pdb_output:
+        write_reduced_pdb(pdb, options.pdb_output, options.expression)
+    print "Wrote %d atoms of %d frames to %s" % (len(indices), frames, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import h5py
+import numpy
+from optparse import OptionParser
+
+# The per-q datasets in a sassena signal file that are averages over frames
+FRAME_AVERAGES = ["fq", "fq0", "fq2"]
+
+def read_signal(path):
+    "Return a dict with the qvectors and signal datasets of the sassena output file at 'path'"
+    f = h5py.File(path, "r")
+    try:
+        signal = {"attrs": dict(f.attrs.items())}
+        for name in ["qvectors", "fqt"] + FRAME_AVERAGES:
+            if name in f:
+                signal[name] = f[name][...]
+    finally:
+        f.close()
+    return signal
+
+def align_qvectors(reference, signal):
+    "Return the index of each reference q vector in 'signal'"
+    index = dict((tuple(q), i) for i, q in enumerate(signal["qvectors"]))
+    try:
+        return numpy.array([index[tuple(q)] for q in reference])
+    except KeyError:
+        raise Exception("The sassena outputs were computed for different q vectors")
+
+def merge_signals(signals):
+    """Combine the sassena outputs of consecutive trajectory segments into one.
+    F(q,t) of each segment is an autocorrelation averaged over the n - t time
+    origins of its n frames, so the segments are weighted by their number of
+    time origins at each lag t. The frame averages (fq, fq0, fq2) are
+    weighted by the number of frames. fq0 is the square of the mean amplitude,
+    which cannot be combined exactly from the segments, so the weighted mean
+    is an approximation for it."""
+    reference = signals[0]["qvectors"]
+    frames = [s["fqt"].shape[1] for s in signals]
+    length = max(frames)
+
+    fqt = numpy.zeros((len(reference), length, 2))
+    origins = numpy.zeros(length)
+    averages = dict((name, numpy.zeros(signals[0][name].shape)) for name in FRAME_AVERAGES if name in signals[0])
+
+    for signal, n in zip(signals, frames):
+        order = align_qvectors(reference, signal)
+        weights = n - numpy.arange(n, dtype=float)
+        fqt[:, :n, :] += signal["fqt"][order] * weights[numpy.newaxis, :, numpy.newaxis]
+        origins[:n] += weights
+        for name in averages:
+            averages[name] += signal[name][order] * n
+
+    merged = {"qvectors": reference, "fqt": fqt / origins[numpy.newaxis, :, numpy.newaxis]}
+    for name, total in averages.items():
+        merged[name] = total / sum(frames)
+    merged["attrs"] = signals[0]["attrs"]
+    return merged
+
+def concat_signals(signals):
+    """Join the sassena outputs of the shards of a q scan, which were computed
+    from the same trajectory for different q vectors"""
+    length = signals[0]["fqt"].shape[1]
+    for signal in signals:
+        if signal["fqt"].shape[1] != length:
+            raise Exception("The sassena outputs were computed from different trajectories")
+
+    merged = {"attrs": signals[0]["attrs"]}
+    for name in ["qvectors", "fqt"] + FRAME_AVERAGES:
+        if name in signals[0]:
+            merged[name] = numpy.concatenate([signal[name] for signal in signals])
+    return merged
+
+def write_signal(path, signal):
+    "Write 'signal' to a sassena style output file at 'path'"
+    f = h5py.File(path, "w")
+    try:
+        for name, value in signal["attrs"].items():
+            f.attrs[name] = value
+        for name in ["qvectors", "fqt"] + FRAME_AVERAGES:
+            if name in signal:
+                f.create_dataset(name, data=signal[name])
+    finally:
+        f.close()
+
+def main():
+    parser = OptionParser(usage="%prog [options] OUTPUT INPUT...")
+    parser.add_option("-c", "--concat", dest="concat", action="store_true", default=False,
+                      help="Join the q vectors of the shards of a q scan instead of averaging trajectory segments")
+    options, args = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Wrong number of arguments")
+
+    output = args[0]
+    inputs = args[1:]
+
+    signals = [read_signal(path) for path in inputs]
+    if options.concat:
+        write_signal(output, concat_signals(signals))
+        print "Joined %d shards into %s" % (len(inputs), output)
+    else:
+        write_signal(output, merge_signals(signals))
+        print "Merged %d segments into %s" % (len(inputs), output)
+
+
+if __name__ == '__main__':
+    main()
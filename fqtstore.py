@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import os
+import h5py
+import numpy
+from optparse import OptionParser
+from fqtmerge import FRAME_AVERAGES, read_signal, align_qvectors
+
+def read_index(path):
+    """Read pipelines.txt and return the list of pipeline ids and an ordered
+    list of (parameter, values) with one value per pipeline"""
+    ids = []
+    params = []
+    f = open(path)
+    try:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            ids.append(fields[0])
+            values = [field.split("=", 1) for field in fields[1:]]
+            if not params:
+                params = [(name, []) for name, value in values]
+            for (name, column), (key, value) in zip(params, values):
+                if name != key:
+                    raise Exception("Inconsistent parameters in %s: %s" % (path, line.strip()))
+                column.append(value)
+    finally:
+        f.close()
+    return ids, params
+
+def parameter_array(values):
+    "Return 'values' as a float array if they are all numbers, otherwise as strings"
+    try:
+        return numpy.array([float(v) for v in values])
+    except ValueError:
+        return numpy.array(values)
+
+def signal_shape(path):
+    "Return the number of q vectors and time steps in the sassena output file at 'path'"
+    f = h5py.File(path, "r")
+    try:
+        return f["fqt"].shape[:2]
+    finally:
+        f.close()
+
+def build_store(index, output, directory=".", kinds=("inc",), contiguous=False):
+    """Stream the fqt_<kind>_<id>.hd5 files of every pipeline in the 'index'
+    file (pipelines.txt) from 'directory' into one HDF5 store at 'output'. For
+    each kind there is a group with:
+
+        qvectors          (q, 3)
+        fqt               (pipelines, q, t, 2), NaN after the end of shorter runs
+        fq, fq0, fq2      (pipelines, q, 2)
+        frames            (pipelines,)
+
+    and the values of the sweep parameters are in parameters/<name>, in the
+    same order as 'pipelines'. By default each pipeline is one compressed
+    chunk, so it is compressed once as it is streamed in. If 'contiguous' is
+    set, the datasets are stored uncompressed and contiguous instead, so
+    that they can be read through numpy.memmap (see memmap()). Only one
+    pipeline is held in memory at a time. Returns the number of pipelines."""
+    ids, params = read_index(index)
+    if not ids:
+        raise Exception("No pipelines in %s" % index)
+
+    store = h5py.File(output + ".tmp", "w")
+    try:
+        store.create_dataset("pipelines", data=numpy.array(ids))
+        group = store.create_group("parameters")
+        for name, values in params:
+            group.create_dataset(name, data=parameter_array(values))
+
+        for kind in kinds:
+            paths = [os.path.join(directory, "fqt_%s_%s.hd5" % (kind, id)) for id in ids]
+            shapes = [signal_shape(path) for path in paths]
+            nq = shapes[0][0]
+            length = max(t for q, t in shapes)
+            if any(q != nq for q, t in shapes):
+                raise Exception("The %s outputs have different numbers of q vectors" % kind)
+
+            if contiguous:
+                options = {}
+            else:
+                options = {"compression": "gzip", "shuffle": True}
+
+            group = store.create_group(kind)
+            fqt = group.create_dataset("fqt", (len(ids), nq, length, 2), dtype="f8", fillvalue=numpy.nan,
+                                       chunks=None if contiguous else (1, nq, length, 2),
+                                       **options)
+            averages = {}
+            for name in FRAME_AVERAGES:
+                averages[name] = group.create_dataset(name, (len(ids), nq, 2), dtype="f8", fillvalue=numpy.nan,
+                                                      chunks=None if contiguous else (1, nq, 2),
+                                                      **options)
+            frames = numpy.array([t for q, t in shapes])
+            group.create_dataset("frames", data=frames)
+
+            reference = None
+            for p, path in enumerate(paths):
+                signal = read_signal(path)
+                if reference is None:
+                    reference = signal["qvectors"]
+                    group.create_dataset("qvectors", data=reference)
+                order = align_qvectors(reference, signal)
+                fqt[p, :, :frames[p], :] = signal["fqt"][order]
+                for name in FRAME_AVERAGES:
+                    if name in signal:
+                        averages[name][p] = signal[name][order]
+    finally:
+        store.close()
+
+    os.rename(output + ".tmp", output)
+    return len(ids)
+
+def load(path, name, kind="inc"):
+    "Read the whole dataset 'name' of 'kind' from the store at 'path' in one read"
+    store = h5py.File(path, "r")
+    try:
+        return store[kind][name][...]
+    finally:
+        store.close()
+
+def parameters(path):
+    "Return the pipeline ids and a dict of the parameter values from the store at 'path'"
+    store = h5py.File(path, "r")
+    try:
+        values = dict((name, dataset[...]) for name, dataset in store["parameters"].items())
+        return store["pipelines"][...], values
+    finally:
+        store.close()
+
+def memmap(path, name, kind="inc"):
+    "Return a read-only numpy.memmap of the dataset 'name' of 'kind' in a store built with contiguous=True"
+    store = h5py.File(path, "r")
+    try:
+        dataset = store[kind][name]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None:
+            raise Exception("%s/%s in %s is not stored contiguously" % (kind, name, path))
+        return numpy.memmap(path, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape)
+    finally:
+        store.close()
+
+def main():
+    parser = OptionParser(usage="%prog [options] INDEX OUTPUT")
+    parser.add_option("-d", "--dir", dest="directory", default=".",
+                      help="Directory that contains the fqt files [default: %default]")
+    parser.add_option("-C", "--coherent", dest="coherent", action="store_true", default=False,
+                      help="Also store the coherent results (fqt_coh_<id>.hd5)")
+    parser.add_option("-m", "--contiguous", dest="contiguous", action="store_true", default=False,
+                      help="Store the datasets uncompressed and contiguous so that they can be memory-mapped")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Wrong number of arguments")
+
+    index, output = args
+
+    if not os.path.isfile(index):
+        raise Exception("No such file: %s" % index)
+
+    kinds = ["inc"]
+    if options.coherent:
+        kinds.append("coh")
+
+    n = build_store(index, output, options.directory, kinds, options.contiguous)
+    print "Stored the results of %d pipelines in %s" % (n, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+import os
+import re
+import csv
+import json
+import math
+import numpy
+from optparse import OptionParser
+from resourcemodel import LABELS, dax_jobs, kickstart_files, kickstart_record
+
+# The distributions that are fitted, with the number of their parameters
+DISTRIBUTIONS = [("normal", 2), ("lognormal", 2), ("gamma", 2)]
+
+# The size units of the keg output sizes, largest first
+SIZE_UNITS = [("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024), ("B", 1)]
+
+# The pipeline id (and production segment) in node labels and file names
+PIPELINE_ID = re.compile(r"[0-9a-f]{10}(_\d+)?")
+
+def load_records(path):
+    """Load job records from a JSON or CSV file. Each record has the fields
+    label (the node label), wall_time and optionally cpu_time in seconds, and
+    outputs, which maps output file names to their sizes in bytes. In a CSV
+    file outputs is written as name=bytes;name=bytes."""
+    f = open(path)
+    try:
+        if path.endswith(".json"):
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+    finally:
+        f.close()
+
+    result = []
+    for r in records:
+        outputs = r.get("outputs") or {}
+        if not isinstance(outputs, dict):
+            outputs = dict(item.rsplit("=", 1) for item in outputs.split(";") if item.strip())
+        cpu_time = r.get("cpu_time")
+        result.append({
+            "label": r["label"],
+            "wall_time": float(r["wall_time"]),
+            "cpu_time": float(cpu_time) if cpu_time not in (None, "") else None,
+            "outputs": dict((name.strip(), float(size)) for name, size in outputs.items())
+        })
+    return result
+
+def save_records(path, records):
+    "Write 'records' to a JSON or CSV file"
+    f = open(path, "w")
+    try:
+        if path.endswith(".json"):
+            json.dump(records, f, indent=1, sort_keys=True)
+        else:
+            writer = csv.DictWriter(f, ["label", "wall_time", "cpu_time", "outputs"])
+            writer.writeheader()
+            for r in records:
+                row = dict(r)
+                row["outputs"] = ";".join(["%s=%d" % item for item in sorted(r["outputs"].items())])
+                writer.writerow(row)
+    finally:
+        f.close()
+
+def ingest_kickstart(workflowdir, submitdir):
+    """Create job records from the kickstart output of a finished run of a
+    flat (not --block-size) workflow, with the node labels from the DAX in
+    'workflowdir'"""
+    labels = dict((id, label) for id, label, elem in dax_jobs(workflowdir))
+    records = []
+    for id, path in kickstart_files(submitdir, labels):
+        record = kickstart_record(path)
+        if record is None:
+            continue
+        record["label"] = labels[id]
+        records.append(record)
+    return records
+
+def label_pattern(label):
+    """Return the keg section pattern of the node label 'label': the prefix of
+    its stage followed by *, or the label itself if it has no stage"""
+    for prefix, stage in LABELS:
+        if label.startswith(prefix):
+            if prefix.endswith("_"):
+                return prefix + "*"
+            return prefix
+    return label
+
+def file_pattern(name):
+    "Return the keg option pattern of the output file 'name', with the pipeline id replaced by *"
+    return PIPELINE_ID.sub("*", name).lower()
+
+def fit_distribution(values):
+    """Fit each of the DISTRIBUTIONS to 'values' by maximum likelihood (by
+    moments for gamma) and return the (name, parameters) of the one with the
+    lowest AIC. A constant is returned as a normal distribution with a scale
+    of 0."""
+    values = numpy.asarray(values, dtype=float)
+    n = len(values)
+    mean = values.mean()
+    std = values.std()
+    if n < 2 or std <= 1e-9 * max(abs(mean), 1):
+        return "normal", [mean, 0.0]
+
+    fits = []
+    ll = -n * (math.log(std) + 0.5 * math.log(2 * math.pi) + 0.5)
+    fits.append(("normal", [mean, std], ll))
+
+    if numpy.all(values > 0):
+        logs = numpy.log(values)
+        mu = logs.mean()
+        sigma = logs.std()
+        if sigma > 0:
+            ll = -n * (math.log(sigma) + 0.5 * math.log(2 * math.pi) + 0.5) - logs.sum()
+            fits.append(("lognormal", [mu, sigma], ll))
+
+        shape = mean ** 2 / std ** 2
+        scale = std ** 2 / mean
+        ll = ((shape - 1) * logs.sum() - values.sum() / scale -
+              n * (shape * math.log(scale) + math.lgamma(shape)))
+        fits.append(("gamma", [shape, scale], ll))
+
+    parameters = dict(DISTRIBUTIONS)
+    name, params, ll = min(fits, key=lambda fit: 2 * parameters[fit[0]] - 2 * fit[2])
+    return name, params
+
+def size_unit(sizes):
+    "Return the largest size unit and its number of bytes that the median of 'sizes' is at least one of"
+    median = numpy.median(sizes)
+    for unit, scale in SIZE_UNITS:
+        if median >= scale:
+            return unit, scale
+    return "B", 1
+
+def format_spec(name, params, unit=None):
+    "Return the keg option value of the distribution 'name' with 'params'"
+    spec = "{'distribution': '%s', 'dist_params': [%s]" % (name, ", ".join(["%.6g" % p for p in params]))
+    if unit is not None:
+        spec += ", 'size_unit': '%s'" % unit
+    return spec + "}"
+
+def calibrate(records, min_samples=1):
+    """Fit the distributions of the wall time, the CPU time and the output
+    sizes of the jobs in 'records', grouped by the pattern of their node
+    label. Returns an ordered list of (section, [(option, value)]) with the
+    sections in the order of the stages in resourcemodel.LABELS, so that
+    the more specific patterns come first. Groups with fewer than
+    'min_samples' values are left out."""
+    groups = {}
+    for r in records:
+        group = groups.setdefault(label_pattern(r["label"]), {"wall_time": [], "cpu_time": [], "outputs": {}})
+        group["wall_time"].append(r["wall_time"])
+        if r.get("cpu_time") is not None:
+            group["cpu_time"].append(r["cpu_time"])
+        for name, size in r.get("outputs", {}).items():
+            group["outputs"].setdefault(file_pattern(name), []).append(size)
+
+    order = [prefix + "*" if prefix.endswith("_") else prefix for prefix, stage in LABELS]
+    patterns = sorted(groups, key=lambda p: (order.index(p) if p in order else len(order), p))
+
+    sections = []
+    for pattern in patterns:
+        group = groups[pattern]
+        options = []
+        for param in ["cpu_time", "wall_time"]:
+            if len(group[param]) >= min_samples and group[param]:
+                options.append((param, format_spec(*fit_distribution(group[param]))))
+        for name in sorted(group["outputs"]):
+            sizes = group["outputs"][name]
+            if len(sizes) < min_samples:
+                continue
+            unit, scale = size_unit(sizes)
+            distribution, params = fit_distribution(numpy.asarray(sizes) / scale)
+            options.append((name, format_spec(distribution, params, unit)))
+        if options:
+            sections.append(("keg-%s" % pattern, options))
+    return sections
+
+def format_sections(sections):
+    "Return the text of the config file 'sections'"
+    text = ""
+    for section, options in sections:
+        text += "[%s]\n" % section
+        for option, value in options:
+            text += "%s = %s\n" % (option, value)
+        text += "\n"
+    return text
+
+def write_sections(path, sections):
+    """Write 'sections' to the config file at 'path'. Sections with the same
+    names are removed, and the rest of the file, including its comments, is
+    kept as it is. The new sections are added at the end."""
+    names = set(section for section, options in sections)
+    lines = []
+    if os.path.isfile(path):
+        f = open(path)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+
+    kept = []
+    skip = False
+    for line in lines:
+        m = re.match(r"^\[([^\]]+)\]", line)
+        if m:
+            skip = m.group(1) in names
+        if not skip:
+            kept.append(line)
+
+    text = "".join(kept)
+    if text and not text.endswith("\n\n"):
+        text = text.rstrip("\n") + "\n\n"
+
+    f = open(path + ".tmp", "w")
+    try:
+        f.write(text + format_sections(sections))
+    finally:
+        f.close()
+    os.rename(path + ".tmp", path)
+
+def main():
+    parser = OptionParser(usage="%prog [options] CONFIGFILE [RECORDS...]")
+    parser.add_option("-w", "--workflow-dir", dest="workflowdir", default=None,
+                      help="Directory of a finished workflow to read the node labels from, with --submit-dir")
+    parser.add_option("-s", "--submit-dir", dest="submitdir", default=None,
+                      help="Submit directory with the kickstart records of the finished workflow")
+    parser.add_option("-r", "--save-records", dest="save", default=None,
+                      help="Also write all the job records to this CSV or JSON file")
+    parser.add_option("-m", "--min-samples", dest="min_samples", type="int", default=1,
+                      help="Leave out the values measured for fewer than this many jobs [default: %default]")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="Print the keg sections instead of writing them to CONFIGFILE")
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error("Wrong number of arguments")
+
+    if (options.workflowdir is None) != (options.submitdir is None):
+        parser.error("--workflow-dir and --submit-dir must be given together")
+
+    configfile = args[0]
+    records = []
+    for path in args[1:]:
+        if not os.path.isfile(path):
+            raise Exception("No such file: %s" % path)
+        records += load_records(path)
+    if options.workflowdir is not None:
+        records += ingest_kickstart(options.workflowdir, options.submitdir)
+
+    if not records:
+        raise Exception("No job records to calibrate from")
+
+    if options.save is not None:
+        save_records(options.save, records)
+
+    sections = calibrate(records, options.min_samples)
+    if options.dry_run:
+        print format_sections(sections),
+    else:
+        write_sections(configfile, sections)
+        print "Wrote %d keg sections from %d jobs to %s" % (len(sections), len(records), configfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,206 @@
-import numpy
+import os
+import re
 import ast
+import fnmatch
+import numpy
 from Pegasus.DAX3 import *
 
+# Bytes in each size unit of the file size distributions
+SIZE_UNITS = {"B": 1, "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+# Size of the input files that have no distribution in [keg-input-files]
+DEFAULT_INPUT_SIZE = 1024
+
 class KegParametersFactory:
-	keg_parameters = {
-		"cpu_time": "-T",
-		"wall_time": "-t",
-		"memory": "-m"
-	}
-
-	def __init__(self, config):
-		self.config = config
-		numpy.random.seed()
-
-	def output_file(self, task, filename, file_real_path=""):
-		if not file_real_path:
-			file_real_path = filename
-
-		if not self.config.has_option("keg-%s" % task, filename):
-			# print "We have not found option ", "keg-%s" % task, filename
-			return "-o {0}".format(file_real_path)
-
-		output_params = ast.literal_eval(self.config.get("keg-%s" % task, filename))
-		distribution = getattr(numpy.random, output_params['distribution'])
-		random_value = int(round( distribution(*output_params['dist_params']) ))
-
-		return "-o {filename}={filesize}{size_unit}".format(filename=file_real_path, filesize=random_value, 
-			size_unit=output_params['size_unit'])
-
-	def generate_input_file(self, file_label, filepath):
-		if self.config.has_option("keg-input-files", file_label):
-			input_file_params = ast.literal_eval(self.config.get("keg-input-files", file_label))
-			distribution = getattr(numpy.random, input_file_params['distribution'])
-			random_size = int(round( distribution(*input_file_params['dist_params']) )) 
-			size_units = { "B": 1, "K": 1024, "M": 1024*1024, "G": 1024*1024*1024  }
-
-			print "Writing file with random size ", filepath
-
-			f = open(filepath,"wb")
-			f.seek(random_size * size_units[input_file_params['size_unit']] - 1)
-			f.write("\0")
-			f.close()
-		else:
-			print "Writing file with concrete size ", filepath
-
-			f = open(filepath,"wb")
-			f.seek(1024 - 1)
-			f.write("\0")
-			f.close()
-
-	def performance_attr(self, task, param):
-		if not self.config.has_option("keg-%s" % task, param):
-			return ""
-
-		param_dict = ast.literal_eval(self.config.get("keg-%s" % task, param))
-		param_value = int(round( getattr(numpy.random, param_dict['distribution'])(*param_dict['dist_params']) ))
-
-		return "{0} {1}".format(KegParametersFactory.keg_parameters[param], param_value)
-
-	def other_params(self, task):
-		if not self.config.has_option("keg-%s" % task, "other_params"):
-			return ""
-
-		return self.config.get("keg-%s" % task, "other_params")
-
-	def add_keg_params(self, job, job_label=""):
-	    """Generates pegasus(-mpi)-keg parameters based on the job object and config file:
-	    - output files: based on Job linking info
-	    - performance attributes: cpu_time, wall_time, memory
-	    - other parameters (anything you want)
-	    """
-
-	    if not job_label:
-	        job_label = job.node_label
-
-	    # Adding output files based on links defined in a job
-	    # for output_file in filter( (lambda x: x.link == Link.OUTPUT), job.used ):
-	    #     print "Job label:", job_label, "\t Output file name:", output_file.name
-	    #     job.addArguments(self.output_file( job_label, output_file.name ))
-
-	    for performance_parameter in [ "cpu_time", "wall_time" ]:
-	        job.addArguments(self.performance_attr( job_label, performance_parameter ))
-
-	    job.addArguments(self.other_params(job_label))		
+    """Generates the arguments of pegasus(-mpi)-keg for the jobs of a
+    synthetic workflow from the keg-* sections of the config file. The
+    section of a job is keg-<node label>, where the label can be a pattern
+    (e.g. [keg-namd_prod_*]). Each option is a distribution such as
+
+        cpu_time = {'distribution': 'normal', 'dist_params': [3600, 300]}
+        *.dcd = {'distribution': 'uniform', 'dist_params': [900, 1100], 'size_unit': 'M'}
+
+    where cpu_time and wall_time are in seconds, and the other options are
+    output file names (or patterns) with a size distribution. The sizes of
+    the input files are in [keg-input-files]. All the options are parsed
+    once, and the values are drawn from a numpy.random.RandomState seeded with
+    'seed', so the same config and seed give the same workflow."""
+
+    keg_parameters = {
+        "cpu_time": "-T",
+        "wall_time": "-t",
+        "memory": "-m"
+    }
+
+    def __init__(self, config, seed=0):
+        self.config = config
+        self.random = numpy.random.RandomState(seed)
+
+        # (pattern regex, section) in config order, and the parsed options of each section
+        self.sections = []
+        self.specs = {}
+        for section in config.sections():
+            if not section.startswith("keg-"):
+                continue
+            specs = {}
+            for option, value in config.items(section):
+                if option == "other_params":
+                    specs[option] = value
+                else:
+                    specs[option] = self.parse_spec(section, option, value)
+            self.specs[section] = specs
+            if section != "keg-input-files":
+                self.sections.append((re.compile(fnmatch.translate(section[4:])), section))
+
+    def parse_spec(self, section, option, value):
+        "Parse the distribution 'value' of 'option' in 'section'"
+        spec = ast.literal_eval(value)
+        if not hasattr(self.random, spec.get("distribution", "")):
+            raise Exception("Unknown distribution for %s in [%s]: %s" % (option, section, value))
+        spec["dist_params"] = list(spec.get("dist_params", []))
+        return spec
+
+    def section(self, label):
+        "Return the keg section of the job with node label 'label', or None"
+        if "keg-%s" % label in self.specs:
+            return "keg-%s" % label
+        for pattern, section in self.sections:
+            if pattern.match(label):
+                return section
+        return None
+
+    def file_spec(self, section, filename):
+        "Return the name of the option in 'section' that has the size of 'filename', or None"
+        specs = self.specs.get(section, {})
+        name = filename.lower()
+        if name in specs:
+            return name
+        for option in specs:
+            if option not in self.keg_parameters and option != "other_params" and fnmatch.fnmatch(name, option):
+                return option
+        return None
+
+    def draw(self, spec, n):
+        "Draw 'n' non-negative integer values from the distribution 'spec' in one call"
+        distribution = getattr(self.random, spec["distribution"])
+        values = distribution(*spec["dist_params"], size=n)
+        return numpy.maximum(numpy.rint(values), 0).astype(int)
+
+    def sample(self, requests):
+        """Draw one value for each (section, option) in 'requests' and return
+        them in the same order. Requests for the same option share a single
+        vectorized draw."""
+        groups = {}
+        for i, key in enumerate(requests):
+            groups.setdefault(key, []).append(i)
+        values = [None] * len(requests)
+        for key in sorted(groups):
+            section, option = key
+            indices = groups[key]
+            for i, value in zip(indices, self.draw(self.specs[section][option], len(indices))):
+                values[i] = value
+        return values
+
+    def file_size(self, spec, value):
+        "Return the size argument of keg for a file of 'value' units of 'spec'"
+        return "%d%s" % (value, spec.get("size_unit", "B"))
+
+    def output_file(self, task, filename, file_real_path=""):
+        "Return the keg argument for the output 'filename' of the job labelled 'task'"
+        if not file_real_path:
+            file_real_path = filename
+        section = self.section(task)
+        option = section and self.file_spec(section, filename)
+        if not option:
+            return "-o {0}".format(file_real_path)
+        spec = self.specs[section][option]
+        return "-o {0}={1}".format(file_real_path, self.file_size(spec, self.draw(spec, 1)[0]))
+
+    def generate_input_files(self, files):
+        """Write a placeholder file for each (label, path) in 'files'. The sizes
+        come from [keg-input-files], with one draw for each distribution, and
+        the files are sparse so that they are written without any data."""
+        requests = []
+        for label, path in files:
+            option = self.file_spec("keg-input-files", label)
+            requests.append(option and ("keg-input-files", option))
+        drawn = self.sample([r for r in requests if r])
+        drawn.reverse()
+
+        for (label, path), request in zip(files, requests):
+            size = DEFAULT_INPUT_SIZE
+            if request:
+                spec = self.specs["keg-input-files"][request[1]]
+                size = drawn.pop() * SIZE_UNITS[spec.get("size_unit", "B")]
+            f = open(path, "wb")
+            try:
+                f.truncate(max(size, 1))
+            finally:
+                f.close()
+
+    def generate_input_file(self, file_label, filepath):
+        "Write a placeholder file for the input 'file_label' at 'filepath'"
+        self.generate_input_files([(file_label, filepath)])
+
+    def performance_attr(self, task, param):
+        "Return the keg argument for 'param' (cpu_time or wall_time) of the job labelled 'task'"
+        section = self.section(task)
+        if section is None or param not in self.specs[section]:
+            return ""
+        value = self.draw(self.specs[section][param], 1)[0]
+        return "{0} {1}".format(KegParametersFactory.keg_parameters[param], value)
+
+    def other_params(self, task):
+        "Return the extra keg arguments of the job labelled 'task'"
+        section = self.section(task)
+        if section is None:
+            return ""
+        return self.specs[section].get("other_params", "")
+
+    def add_keg_params(self, job, job_label=""):
+        "Replace the arguments of 'job' with keg arguments"
+        self.add_keg_params_bulk([job], [job_label or job.node_label])
+
+    def add_keg_params_bulk(self, jobs, labels=None):
+        """Replace the arguments of every job in 'jobs' with pegasus(-mpi)-keg
+        arguments: its input files (-i), its output files with sampled sizes
+        (-o), the sampled cpu_time and wall_time, and other_params. 'labels'
+        are the labels the sections are looked up by (default: the node
+        labels). The values of all the jobs are drawn together."""
+        if labels is None:
+            labels = [job.node_label for job in jobs]
+
+        plans = []
+        requests = []
+        for job, label in zip(jobs, labels):
+            section = self.section(label)
+            inputs = sorted(use.name for use in job.used if use.link == Link.INPUT)
+            outputs = []
+            for name in sorted(use.name for use in job.used if use.link == Link.OUTPUT):
+                option = section and self.file_spec(section, name)
+                outputs.append((name, option))
+                if option:
+                    requests.append((section, option))
+            params = []
+            if section is not None:
+                for param in ["cpu_time", "wall_time"]:
+                    if param in self.specs[section]:
+                        params.append(param)
+                        requests.append((section, param))
+            plans.append((job, section, inputs, outputs, params))
+
+        drawn = self.sample(requests)
+        drawn.reverse()
+
+        for job, section, inputs, outputs, params in plans:
+            job.clearArguments()
+            if inputs:
+                job.addArguments("-i", *inputs)
+            for name, option in outputs:
+                if option:
+                    name = "%s=%s" % (name, self.file_size(self.specs[section][option], drawn.pop()))
+                job.addArguments("-o", name)
+            for param in params:
+                job.addArguments(KegParametersFactory.keg_parameters[param], str(drawn.pop()))
+            if section is not None and self.specs[section].get("other_params"):
+                job.addArguments(self.specs[section]["other_params"])
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shlex
+import Queue
+import subprocess
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from dagsim import load_dax
+
+DAXGEN_DIR = os.path.dirname(os.path.realpath(__file__))
+INPUT_DIR = os.path.join(DAXGEN_DIR, "inputs")
+
+# The site of the transformation catalog entries that are used by default
+SITE = "local"
+
+# The job records are written to this file in the workflow directory
+RECORDS_FILE = "localrun.json"
+
+def read_tc(path, site=SITE):
+    """Read the transformation catalog at 'path' (in the text format of tc.txt)
+    and return a dict of transformation -> (pfn, env, successmsg) for the
+    entries of 'site'. A pfn that starts with ./ is relative to the directory
+    of the catalog, and a pfn without a / is looked up on the PATH."""
+    f = open(path)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+
+    catalog = {}
+    for m in re.finditer(r"^tr\s+(\S+)\s*\{(.*?)^\}", text, re.MULTILINE | re.DOTALL):
+        for s in re.finditer(r"site\s+(\S+)\s*\{(.*?)\}", m.group(2), re.DOTALL):
+            if s.group(1) != site:
+                continue
+            body = s.group(2)
+            pfn = re.search(r'pfn\s+"([^"]*)"', body).group(1)
+            if pfn.startswith("./"):
+                pfn = os.path.join(os.path.dirname(os.path.abspath(path)), pfn[2:])
+            env = dict(re.findall(r'profile\s+env\s+"([^"]*)"\s+"([^"]*)"', body))
+            successmsg = re.search(r'profile\s+pegasus\s+"exitcode.successmsg"\s+"([^"]*)"', body)
+            catalog[m.group(1)] = (pfn, env, successmsg and successmsg.group(1))
+    return catalog
+
+def read_rc(paths):
+    "Return a dict of lfn -> local path from the file:// entries of the replica catalogs at 'paths'"
+    replicas = {}
+    for path in paths:
+        f = open(path)
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[1].startswith("file://"):
+                    replicas[fields[0]] = fields[1][len("file://"):]
+        finally:
+            f.close()
+    return replicas
+
+class LocalRun(object):
+    """Runs the jobs of a workflow generated by daxgen.py on this machine.
+    The jobs are run in the order of their dependencies by a pool of
+    'processes' workers, in the shared directory 'workdir', so that the jobs
+    of independent pipelines run at the same time. The executables come from
+    the transformation catalog 'tc', and transformations that it does not
+    have are run with 'stub' (e.g. pegasus-keg or /bin/true), if it is set.
+    The input files of the workflow are linked into 'workdir' from the
+    replica catalogs of the workflow or from 'input_dir'."""
+
+    def __init__(self, workflowdir, tc, workdir=None, processes=1, stub=None, retries=0,
+                 site=SITE, input_dir=INPUT_DIR):
+        self.workflowdir = os.path.abspath(workflowdir)
+        self.workdir = os.path.abspath(workdir or os.path.join(self.workflowdir, "scratch"))
+        self.logdir = os.path.join(self.workdir, "logs")
+        self.processes = processes
+        self.stub = stub
+        self.retries = retries
+        self.input_dir = input_dir
+        self.catalog = read_tc(tc, site)
+        self.replicas = read_rc(sorted(glob.glob(os.path.join(self.workflowdir, "rc*.txt"))))
+        self.jobs = load_dax(os.path.join(self.workflowdir, "dax.xml"))
+
+    def executable(self, job):
+        "Return the command, environment and success message of the transformation of 'job'"
+        if job.transformation in self.catalog:
+            pfn, env, successmsg = self.catalog[job.transformation]
+        elif self.stub is not None:
+            pfn, env, successmsg = self.stub, {}, None
+        else:
+            raise Exception("No entry for %s in the transformation catalog" % job.transformation)
+        return pfn, env, successmsg
+
+    def stage_in(self):
+        """Link the input files of the workflow into the work directory. Raises an
+        Exception that lists the files that cannot be found."""
+        produced = set()
+        for job in self.jobs.values():
+            produced.update(name for name, transfer in job.outputs)
+
+        missing = []
+        for job in self.jobs.values():
+            if job.subdax:
+                continue
+            for name, transfer in job.inputs:
+                if name in produced:
+                    continue
+                target = os.path.join(self.workdir, name)
+                if os.path.lexists(target):
+                    continue
+                source = self.replicas.get(name, os.path.join(self.input_dir, name))
+                if not os.path.exists(source):
+                    missing.append(name)
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.symlink(source, target)
+        if missing:
+            raise Exception("Input files not found: %s" % ", ".join(sorted(set(missing))))
+
+    def run_job(self, job):
+        """Run 'job' in the work directory and return its record: the wall time
+        and the CPU time (user + system) in seconds, the exit status and the
+        sizes of its output files. The stdin, stdout and stderr files of the
+        job are in the work directory, and its stdout and stderr go to logs/
+        if the DAX does not name them. The directories of its output files
+        are created first. A job that does not write all of its output files
+        has failed, as it would in the stage-out of Pegasus."""
+        record = {"id": job.id, "label": job.label, "transformation": job.transformation,
+                  "start": time.time(), "wall_time": 0.0, "cpu_time": 0.0, "outputs": {}}
+        if job.subdax:
+            # The jobs of the sub-workflow are part of the DAG
+            record["status"] = 0
+            return record
+
+        try:
+            pfn, env, successmsg = self.executable(job)
+            environment = os.environ.copy()
+            environment.update(env)
+            stdout = os.path.join(self.logdir, "%s.out" % job.label)
+            if job.stdout is not None:
+                stdout = os.path.join(self.workdir, job.stdout)
+            stderr = os.path.join(self.logdir, "%s.err" % job.label)
+            if job.stderr is not None:
+                stderr = os.path.join(self.workdir, job.stderr)
+            for name, transfer in job.outputs:
+                d = os.path.dirname(os.path.join(self.workdir, name))
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # Jobs running at the same time can share a directory
+                    if not os.path.isdir(d):
+                        raise
+            for attempt in range(self.retries + 1):
+                record.pop("error", None)
+                stdin = None
+                if job.stdin is not None:
+                    stdin = open(os.path.join(self.workdir, job.stdin))
+                out = open(stdout, "w")
+                err = open(stderr, "w")
+                try:
+                    start = time.time()
+                    process = subprocess.Popen([pfn] + shlex.split(job.arguments), cwd=self.workdir,
+                                               stdin=stdin, stdout=out, stderr=err, env=environment)
+                    pid, status, usage = os.wait4(process.pid, 0)
+                    process.returncode = status
+                    record["wall_time"] = time.time() - start
+                finally:
+                    if stdin is not None:
+                        stdin.close()
+                    out.close()
+                    err.close()
+                record["cpu_time"] = usage.ru_utime + usage.ru_stime
+                if os.WIFEXITED(status):
+                    record["status"] = os.WEXITSTATUS(status)
+                else:
+                    record["status"] = -os.WTERMSIG(status)
+                if record["status"] == 0 and successmsg is not None:
+                    f = open(stdout)
+                    try:
+                        if successmsg not in f.read():
+                            record["status"] = 1
+                    finally:
+                        f.close()
+                if record["status"] == 0:
+                    missing = [name for name, transfer in job.outputs
+                               if not os.path.isfile(os.path.join(self.workdir, name))]
+                    if missing:
+                        record["status"] = 1
+                        record["error"] = "output files not written: %s" % ", ".join(missing)
+                if record["status"] == 0:
+                    break
+        except Exception, e:
+            record["status"] = -1
+            record["error"] = str(e)
+            return record
+
+        for name, transfer in job.outputs:
+            path = os.path.join(self.workdir, name)
+            if os.path.isfile(path):
+                record["outputs"][name] = os.path.getsize(path)
+        return record
+
+    def run(self):
+        """Run the workflow and return the records of the jobs that ran. The jobs
+        that depend on a failed job are not run."""
+        for d in [self.workdir, self.logdir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        missing = set(job.transformation for job in self.jobs.values() if not job.subdax)
+        missing.difference_update(self.catalog)
+        if missing and self.stub is None:
+            raise Exception("No entries in the transformation catalog for %s" % ", ".join(sorted(missing)))
+        self.stage_in()
+
+        remaining = dict((id, len(job.parents)) for id, job in self.jobs.items())
+        done = Queue.Queue()
+        pool = ThreadPool(self.processes)
+        records = []
+        failed = set()
+        running = [0]
+
+        def submit(id):
+            running[0] += 1
+            pool.apply_async(self.run_job, (self.jobs[id],), callback=done.put)
+
+        def skip(id):
+            # Skip 'id' and everything below it
+            stack = [id]
+            while stack:
+                id = stack.pop()
+                if id not in failed:
+                    failed.add(id)
+                    stack.extend(self.jobs[id].children)
+
+        try:
+            for id in sorted(remaining):
+                if remaining[id] == 0:
+                    submit(id)
+
+            total = len([job for job in self.jobs.values() if not job.subdax])
+            while running[0]:
+                # A timeout keeps the wait interruptible
+                record = done.get(True, 365 * 24 * 3600)
+                running[0] -= 1
+                job = self.jobs[record["id"]]
+                if not job.subdax:
+                    records.append(record)
+                    state = "ok" if record["status"] == 0 else "FAILED (%s)" % record.get("error", "exit status %d" % record["status"])
+                    print "[%*d/%d] %-40s %9.1f s  %s" % (len(str(total)), len(records), total, job.label,
+                                                          record["wall_time"], state)
+                if record["status"] != 0:
+                    for child in job.children:
+                        skip(child)
+                    continue
+                for child in sorted(job.children):
+                    remaining[child] -= 1
+                    if remaining[child] == 0 and child not in failed:
+                        submit(child)
+        finally:
+            pool.close()
+            pool.join()
+        return records
+
+    def save_records(self, records):
+        "Write the job records to localrun.json in the workflow directory"
+        path = os.path.join(self.workflowdir, RECORDS_FILE)
+        f = open(path, "w")
+        try:
+            json.dump(records, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        return path
+
+def main():
+    parser = OptionParser(usage="%prog [options] WORKFLOWDIR TC")
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=1,
+                      help="Number of jobs to run at the same time [default: %default]")
+    parser.add_option("-d", "--work-dir", dest="workdir", default=None,
+                      help="Directory the jobs run in [default: WORKFLOWDIR/scratch]")
+    parser.add_option("-s", "--stub", dest="stub", default=None,
+                      help="Executable to run for the transformations that are not in TC (e.g. pegasus-keg)")
+    parser.add_option("-r", "--retries", dest="retries", type="int", default=0,
+                      help="Number of times a failed job is retried [default: %default]")
+    parser.add_option("-S", "--site", dest="site", default=SITE,
+                      help="Site of the entries of TC to use [default: %default]")
+    parser.add_option("-i", "--input-dir", dest="input_dir", default=INPUT_DIR,
+                      help="Directory with the input files that are not in the replica catalog [default: %default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Wrong number of arguments")
+
+    if options.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    workflowdir, tc = args
+
+    if not os.path.isfile(os.path.join(workflowdir, "dax.xml")):
+        raise Exception("No such file: %s" % os.path.join(workflowdir, "dax.xml"))
+
+    if not os.path.isfile(tc):
+        raise Exception("No such file: %s" % tc)
+
+    start = time.time()
+    run = LocalRun(workflowdir, tc, options.workdir, options.processes, options.stub,
+                   options.retries, options.site, options.input_dir)
+    records = run.run()
+    path = run.save_records(records)
+
+    failed = len([r for r in records if r["status"] != 0])
+    skipped = len([job for job in run.jobs.values() if not job.subdax]) - len(records)
+    print "Ran %d jobs in %.1f s, %d failed, %d not run; the job records are in %s" % (
+        len(records), time.time() - start, failed, skipped, path)
+    if failed or skipped:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+def digest_chunks(chunks):
+    "Return the SHA-1 hex digest of the rendered 'chunks'"
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest(object):
+    """Keeps track of the content hash of every file generated for a workflow
+    so that a later run into the same directory only rewrites the files that
+    changed. Each file belongs to the pipelines it was generated for."""
+
+    def __init__(self, outdir, filename="manifest.json"):
+        "'outdir' is the workflow directory that contains the manifest"
+        self.outdir = outdir
+        self.path = os.path.join(outdir, filename)
+        self.old = {}
+        self.new = {}
+        self.changed = set()
+
+        if os.path.isfile(self.path):
+            f = open(self.path)
+            try:
+                self.old = json.load(f)["artifacts"]
+            finally:
+                f.close()
+
+    def write_chunks(self, pipeline, name, chunks, digest=None):
+        """Write the rendered 'chunks' to the artifact 'name' that belongs to
+        'pipeline' unless the file already has the same content. 'digest' is
+        the hash of 'chunks' if it is already known. Returns the path of the
+        artifact."""
+        path = os.path.join(self.outdir, name)
+
+        if digest is None:
+            digest = digest_chunks(chunks)
+
+        old = self.old.get(name)
+        if name in self.new:
+            # A deduplicated file that was already written for another pipeline
+            pass
+        elif old is None or old["sha1"] != digest or not os.path.isfile(path):
+            f = open(path, "w")
+            try:
+                f.writelines(chunks)
+            finally:
+                f.close()
+            self.changed.add(name)
+
+        # Deduplicated files can be shared by several pipelines
+        entry = self.new.setdefault(name, {"sha1": digest, "pipelines": []})
+        entry["pipelines"].append(pipeline)
+
+        return path
+
+    def pipelines(self, artifacts):
+        "Return the set of pipelines in 'artifacts'"
+        pipelines = set()
+        for a in artifacts.values():
+            pipelines.update(a["pipelines"])
+        return pipelines
+
+    def new_pipelines(self):
+        "Pipelines that were not in the previous manifest"
+        return self.pipelines(self.new) - self.pipelines(self.old)
+
+    def stale_pipelines(self):
+        "Pipelines from the previous manifest that have at least one changed or new file"
+        changed = dict((name, self.new[name]) for name in self.changed)
+        return self.pipelines(changed) & self.pipelines(self.old)
+
+    def removed_pipelines(self):
+        "Pipelines that were in the previous manifest, but not in this one"
+        return self.pipelines(self.old) - self.pipelines(self.new)
+
+    def prune(self):
+        "Delete the files that were generated previously, but are no longer part of the workflow"
+        pruned = []
+        for name in sorted(set(self.old) - set(self.new)):
+            path = os.path.join(self.outdir, name)
+            if os.path.isfile(path):
+                os.unlink(path)
+            pruned.append(name)
+        return pruned
+
+    def write(self):
+        "Save the manifest for the next run"
+        tmp = self.path + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump({"artifacts": self.new}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
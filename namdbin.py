@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import numpy
+from ConfigParser import ConfigParser
+import dcd
+
+# Residue names of the solvent, which the automatic align mask leaves out
+WATER_RESIDUES = set(["TIP3", "TIP4", "TIP5", "HOH", "WAT", "SOL", "SPC"])
+
+class NAMDBinFile(object):
+    """A NAMD binary coordinate or velocity file (binCoordinates and
+    binVelocities) read through numpy.memmap. The file is the number of atoms
+    as an int32 followed by x, y and z of every atom as float64, in the byte
+    order of the machine that wrote it."""
+
+    def __init__(self, path):
+        "'path' is the binary file"
+        self.path = path
+        size = os.path.getsize(path)
+        if size < 4:
+            raise Exception("Not a NAMD binary file: %s" % path)
+
+        header = numpy.memmap(path, dtype="u1", mode="r", shape=(4,))
+        for endian in "<>":
+            natoms = int(header.view(endian + "i4")[0])
+            if natoms > 0 and size == 4 + 24 * natoms:
+                break
+        else:
+            raise Exception("Not a NAMD binary file (the size does not match the atom count): %s" % path)
+
+        self.natoms = natoms
+        self.values = numpy.memmap(path, dtype=endian + "f8", mode="r", offset=4, shape=(natoms, 3))
+
+    def __len__(self):
+        return self.natoms
+
+def read_xsc(path):
+    "Return a dict of the values in the last line of the NAMD extended system file at 'path'"
+    labels = None
+    values = None
+    f = open(path)
+    try:
+        for line in f:
+            if line.startswith("#$LABELS"):
+                labels = line.split()[1:]
+            elif line.strip() and not line.startswith("#"):
+                values = line.split()
+    finally:
+        f.close()
+    if labels is None or values is None or len(values) < len(labels):
+        raise Exception("Not a NAMD extended system file: %s" % path)
+    return dict(zip(labels, [float(v) for v in values]))
+
+def cell_volume(xsc):
+    "Return the volume of the periodic cell in the extended system values 'xsc'"
+    cell = numpy.array([[xsc["%s_%s" % (v, axis)] for axis in "xyz"] for v in "abc"])
+    return abs(numpy.linalg.det(cell))
+
+def pdb_atom_columns(path, start, stop):
+    """Return columns start..stop-1 of every ATOM/HETATM record of the PDB file
+    at 'path' as a (atoms, stop - start) uint8 array. The file is scanned
+    through a memory map without reading it line by line."""
+    data = numpy.memmap(path, dtype="u1", mode="r")
+    newlines = numpy.flatnonzero(data == ord("\n"))
+    starts = numpy.concatenate(([0], newlines + 1))
+    starts = starts[starts + 6 <= len(data)]
+    head = data[starts[:, numpy.newaxis] + numpy.arange(6)]
+    atoms = ((head[:, :4] == numpy.frombuffer("ATOM", dtype="u1")).all(axis=1) |
+             (head == numpy.frombuffer("HETATM", dtype="u1")).all(axis=1))
+    starts = starts[atoms]
+    if stop <= 6:
+        return head[atoms][:, start:stop]
+
+    ends = numpy.concatenate((newlines, [len(data)]))
+    ends = ends[numpy.searchsorted(ends, starts)]
+    if numpy.any(ends - starts < stop):
+        raise Exception("Atom records in %s are shorter than %d columns" % (path, stop))
+    return data[starts[:, numpy.newaxis] + numpy.arange(start, stop)]
+
+def pdb_atom_count(path):
+    "Return the number of ATOM/HETATM records in the PDB file at 'path'"
+    return len(pdb_atom_columns(path, 0, 1))
+
+def pdb_beta(path):
+    "Return the beta (B-factor) column of every atom in the PDB file at 'path'"
+    columns = numpy.ascontiguousarray(pdb_atom_columns(path, 60, 66))
+    text = columns.view("S6").ravel()
+    text = numpy.where(numpy.char.strip(text) == "", "0", text)
+    return text.astype(float)
+
+def psf_atom_count(path):
+    "Return the number of atoms in the !NATOM header of the PSF file at 'path'"
+    f = open(path)
+    try:
+        for line in f:
+            if "!NATOM" in line:
+                return int(line.split()[0])
+    finally:
+        f.close()
+    raise Exception("No !NATOM section in %s" % path)
+
+def psf_residues(path):
+    "Return the residue name of every atom in the PSF file at 'path'"
+    f = open(path)
+    try:
+        for line in f:
+            if "!NATOM" in line:
+                natoms = int(line.split()[0])
+                break
+        else:
+            raise Exception("No !NATOM section in %s" % path)
+        residues = [f.next().split()[3] for i in xrange(natoms)]
+    finally:
+        f.close()
+    return numpy.array(residues)
+
+def format_mask(indices):
+    "Return a ptraj atom number mask (e.g. '@1-10,20') for the 0-based 'indices'"
+    indices = numpy.asarray(indices)
+    if len(indices) == 0:
+        raise Exception("Empty atom selection")
+    breaks = numpy.flatnonzero(numpy.diff(indices) != 1)
+    firsts = numpy.concatenate(([indices[0]], indices[breaks + 1])) + 1
+    lasts = numpy.concatenate((indices[breaks], [indices[-1]])) + 1
+    ranges = []
+    for first, last in zip(firsts, lasts):
+        if first == last:
+            ranges.append("%d" % first)
+        else:
+            ranges.append("%d-%d" % (first, last))
+    return "@" + ",".join(ranges)
+
+def solute_mask(psf):
+    "Return the ptraj mask of the atoms in the PSF file 'psf' that are not water"
+    residues = psf_residues(psf)
+    solute = ~numpy.in1d(residues, list(WATER_RESIDUES))
+    return format_mask(numpy.flatnonzero(solute))
+
+def validate_inputs(config, input_dir, mask=None):
+    """Check that the NAMD inputs named in the [simulation] section of 'config'
+    and found in 'input_dir' agree with each other: the binary coordinates and
+    velocities have the same number of atoms as the PSF and PDB files, their
+    values are finite, the cell in the extended system file has a volume, the
+    fixed atom file fixes some atoms, and the ptraj 'mask' is in range. Files
+    that are not in 'input_dir' are skipped. Raises an Exception that lists
+    every problem, and otherwise returns a summary."""
+    def path(option):
+        p = os.path.join(input_dir, config.get("simulation", option))
+        if os.path.isfile(p):
+            return p
+        skipped.append(config.get("simulation", option))
+        return None
+
+    problems = []
+    skipped = []
+    counts = []
+
+    for option in ["bin_coordinates", "bin_velocities"]:
+        p = path(option)
+        if p is None:
+            continue
+        try:
+            binfile = NAMDBinFile(p)
+        except Exception, e:
+            problems.append(str(e))
+            continue
+        counts.append((os.path.basename(p), binfile.natoms))
+        if not numpy.isfinite(binfile.values).all():
+            problems.append("%s has values that are not finite" % os.path.basename(p))
+
+    p = path("structure")
+    if p is not None:
+        counts.append((os.path.basename(p), psf_atom_count(p)))
+
+    for option in ["coordinates", "fixed_pdb", "sassena_pdb"]:
+        p = path(option)
+        if p is not None:
+            counts.append((os.path.basename(p), pdb_atom_count(p)))
+
+    natoms = None
+    if counts:
+        natoms = counts[0][1]
+        if any(n != natoms for name, n in counts):
+            problems.append("The inputs have different numbers of atoms: " +
+                            ", ".join(["%s %d" % (name, n) for name, n in counts]))
+
+    fixed = None
+    p = path("fixed_pdb")
+    if p is not None:
+        fixed = int(numpy.count_nonzero(pdb_beta(p)))
+        if fixed == 0:
+            problems.append("%s does not fix any atoms (all of its beta values are 0)" % os.path.basename(p))
+
+    p = path("extended_system")
+    if p is not None:
+        try:
+            if cell_volume(read_xsc(p)) <= 0:
+                problems.append("The cell in %s has no volume" % os.path.basename(p))
+        except Exception, e:
+            problems.append(str(e))
+
+    if mask is not None and natoms is not None:
+        try:
+            dcd.parse_mask(mask, natoms)
+        except Exception, e:
+            problems.append("%s for %d atoms" % (e, natoms))
+
+    if problems:
+        raise Exception("Inconsistent inputs in %s:\n  %s" % (input_dir, "\n  ".join(problems)))
+
+    summary = "%s atoms" % (natoms if natoms is not None else "unknown")
+    if fixed is not None:
+        summary += ", %d fixed" % fixed
+    if skipped:
+        summary += "; not found, so not checked: %s" % ", ".join(sorted(set(skipped)))
+    return summary
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print "Usage: %s CONFIGFILE [INPUTDIR]" % sys.argv[0]
+        sys.exit(1)
+
+    config = ConfigParser()
+    config.read(sys.argv[1])
+    if len(sys.argv) == 3:
+        input_dir = sys.argv[2]
+    else:
+        input_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "inputs")
+
+    mask = None
+    if config.has_option("simulation", "align_mask"):
+        mask = config.get("simulation", "align_mask").strip()
+        if mask == "auto":
+            mask = solute_mask(os.path.join(input_dir, config.get("simulation", "structure")))
+            print "Align mask: %s" % mask
+
+    start = time.time()
+    summary = validate_inputs(config, input_dir, mask)
+    print "Checked the inputs in %.0f ms: %s" % ((time.time() - start) * 1000, summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import os
+import re
+import shlex
+import subprocess
+from optparse import OptionParser
+
+# The neighbour list options that are tuned, in the order of the values of a candidate
+KNOBS = ["margin", "pairlistdist", "stepspercycle", "pairlistsPerCycle"]
+
+# The candidate settings that are benchmarked by default. The first one is
+# the setting the templates have always used, which rebuilds the pairlist
+# every step. pairlistdist must stay above the 12 A cutoff.
+CANDIDATES = "10.0 18.0 1 1, 2.5 14.0 10 2, 1.0 13.5 20 2, 2.0 14.0 20 4"
+
+# Number of steps each candidate is run for
+STEPS = 2000
+
+# The command that runs NAMD on a config file. {cores} is replaced by the
+# number of cores.
+NAMD_COMMAND = "namd2"
+
+def parse_candidates(value):
+    """Parse a comma-separated list of candidates, each with one value for every
+    knob separated by spaces or colons (e.g. "2.5 14.0 10 2, 1.0:13.5:20:2")"""
+    candidates = []
+    for item in value.split(","):
+        values = re.split(r"[\s:]+", item.strip())
+        if values == [""]:
+            continue
+        if len(values) != len(KNOBS):
+            raise Exception("A candidate needs a value for each of %s: %s" % (", ".join(KNOBS), item.strip()))
+        candidates.append(values)
+    if not candidates:
+        raise Exception("No candidates to benchmark")
+    return candidates
+
+def benchmark_conf(conf, candidate, outputname, steps):
+    """Return the text of the NAMD config 'conf' changed to use the knob values
+    of 'candidate', to write its outputs to 'outputname' and to run 'steps'
+    steps, rounded up to a whole number of cycles"""
+    stepspercycle = int(candidate[KNOBS.index("stepspercycle")])
+    steps = -(-steps // stepspercycle) * stepspercycle
+    replacements = zip(KNOBS, candidate) + [("outputName", outputname), ("set timesteps", str(steps))]
+    for name, value in replacements:
+        pattern = re.compile(r"^(\s*%s\s+)\S+" % re.escape(name), re.MULTILINE | re.IGNORECASE)
+        conf, n = pattern.subn(lambda m: m.group(1) + value, conf)
+        if n == 0:
+            raise Exception("The config file does not set %s" % name)
+    return conf
+
+def parse_benchmark(log):
+    """Return the days/ns of the last 'Benchmark time' line that NAMD wrote to
+    the text 'log', or None if there is none"""
+    matches = re.findall(r"Benchmark time:.*?([0-9.eE+-]+) days/ns", log)
+    if not matches:
+        return None
+    return float(matches[-1])
+
+def run_candidate(conf, candidate, index, steps, command):
+    "Benchmark 'candidate' on the config text 'conf' and return its days/ns, or None if NAMD failed"
+    outputname = "namd_tune_%d" % index
+    path = outputname + ".conf"
+    f = open(path, "w")
+    try:
+        f.write(benchmark_conf(conf, candidate, outputname, steps))
+    finally:
+        f.close()
+
+    log = open(outputname + ".log", "w+")
+    try:
+        status = subprocess.call(shlex.split(command) + [path], stdout=log, stderr=subprocess.STDOUT)
+        log.seek(0)
+        days = parse_benchmark(log.read())
+    finally:
+        log.close()
+    if status != 0:
+        return None
+    return days
+
+def write_settings(path, candidate, days):
+    "Write the knob values of 'candidate' to 'path' as Tcl variables for the production config"
+    f = open(path, "w")
+    try:
+        f.write("# Written by namdtune.py: %.4f days/ns (%.3f ns/day)\n" % (days, 1.0 / days))
+        for name, value in zip(KNOBS, candidate):
+            f.write("set %-18s %s\n" % (name, value))
+    finally:
+        f.close()
+
+def tune(conf, output, candidates, steps=STEPS, command=NAMD_COMMAND):
+    """Run the NAMD config file 'conf' for 'steps' steps with each of the
+    'candidates', and write the fastest one to 'output'. Returns the winning
+    candidate and its days/ns."""
+    f = open(conf)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+
+    results = []
+    for i, candidate in enumerate(candidates):
+        days = run_candidate(text, candidate, i, steps, command)
+        if days is None:
+            print "%-30s failed, see namd_tune_%d.log" % (" ".join(candidate), i)
+            continue
+        print "%-30s %10.4f days/ns %10.3f ns/day" % (" ".join(candidate), days, 1.0 / days)
+        results.append((days, i))
+
+    if not results:
+        raise Exception("None of the candidates could be benchmarked")
+
+    days, best = min(results)
+    write_settings(output, candidates[best], days)
+    return candidates[best], days
+
+def main():
+    parser = OptionParser(usage="%prog [options] CONF OUTPUT")
+    parser.add_option("-s", "--steps", dest="steps", type="int", default=STEPS,
+                      help="Number of steps to run each candidate for [default: %default]")
+    parser.add_option("-c", "--candidates", dest="candidates", default=CANDIDATES,
+                      help="Comma-separated candidates, each with a value for " + ", ".join(KNOBS) + " [default: %default]")
+    parser.add_option("-n", "--namd", dest="namd", default=os.environ.get("NAMD_COMMAND", NAMD_COMMAND),
+                      help="Command that runs NAMD on a config file, {cores} is replaced by --cores [default: $NAMD_COMMAND or %default]")
+    parser.add_option("-p", "--cores", dest="cores", type="int", default=1,
+                      help="Number of cores to run NAMD on [default: %default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Wrong number of arguments")
+
+    conf, output = args
+
+    if not os.path.isfile(conf):
+        raise Exception("No such file: %s" % conf)
+
+    candidates = parse_candidates(options.candidates)
+    command = options.namd.replace("{cores}", str(options.cores))
+    candidate, days = tune(conf, output, candidates, options.steps, command)
+    print "Wrote %s to %s" % (" ".join(candidate), output)
+
+
+if __name__ == '__main__':
+    main()
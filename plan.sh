@@ -21,7 +21,7 @@ DIR=$(cd $(dirname $0) && pwd)
 INPUT_DIR=$DIR/inputs
 SUBMIT_DIR=$WORKFLOW_DIR/submit
 DAX=$WORKFLOW_DIR/dax.xml
-TC=$DIR/tc.txt
+TC=${TC:-$DIR/tc.txt}
 RC=$WORKFLOW_DIR/rc.txt
 SC=$DIR/sites.xml
 PP=$DIR/pegasus.properties
@@ -38,5 +38,6 @@ pegasus-plan \
     --input-dir $INPUT_DIR \
     --sites $SITE \
     --output-site $OUTPUT_SITE \
+    --cluster label \
     --cleanup leaf \
 
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import csv
+import json
+import glob
+import math
+import numpy
+from xml.etree import ElementTree
+
+# The resource requests that the workflow used before there was a model:
+# stage -> (cores, walltime in minutes, units of work the walltime is for).
+# Work is measured in timesteps for NAMD (summed over the candidates for
+# the autotune job), in trajectory frames for ptraj and sassena, and in
+# pipelines for the fqt store.
+DEFAULTS = {
+    "namd_eq": (240, 360, 1000000),
+    "namd_prod": (240, 5760, 10000000),
+    "namd_tune": (240, 30, 10000),
+    "ptraj": (1, 60, 10000),
+    "sassena_inc": (120, 360, 10000),
+    "sassena_coh": (400, 360, 10000),
+    "fqt_merge": (1, 10, 10000),
+    "dcd_align": (1, 60, 10000),
+    "dcd_reduce": (1, 30, 10000),
+    "fqt_concat": (1, 10, 10000),
+    "fqt_store": (1, 60, 1000)
+}
+
+# Node label prefixes of the jobs in each stage
+LABELS = [
+    ("namd_eq_", "namd_eq"),
+    ("namd_prod_", "namd_prod"),
+    ("namd_tune", "namd_tune"),
+    ("amber_ptraj_", "ptraj"),
+    ("sassena_inc_", "sassena_inc"),
+    ("sassena_coh_", "sassena_coh"),
+    ("fqt_merge_coh_", "fqt_merge"),
+    ("fqt_merge_", "fqt_merge"),
+    ("fqt_concat_coh_", "fqt_concat"),
+    ("fqt_concat_", "fqt_concat"),
+    ("fqt_store", "fqt_store"),
+    ("dcd_align_", "dcd_align"),
+    ("dcd_reduce_", "dcd_reduce")
+]
+
+# Stages that always run on a single core
+SERIAL_STAGES = set(["ptraj", "fqt_merge", "dcd_align", "dcd_reduce", "fqt_concat", "fqt_store"])
+
+# NAMD writes a frame to the DCD file every this many steps (dcdfreq)
+DCD_FREQUENCY = 1000
+
+CORES_PER_NODE = 24
+
+DAX_NS = "{http://pegasus.isi.edu/schema/DAX}"
+
+# The kickstart records of a job are named <transformation>_<job id>.out.<retry>
+KICKSTART_FILE = re.compile(r"_(ID\d+)\.out\.\d+$")
+
+def label_stage(label):
+    "Return the stage of the job with node label 'label', or None"
+    for prefix, stage in LABELS:
+        if label.startswith(prefix):
+            return stage
+    return None
+
+def label_part(label):
+    """Return the part of the workflow that the job with node label 'label'
+    works on: the pipeline id, or <id>_<segment> for the jobs of one production
+    segment (e.g. namd_prod_<id>_<segment> and amber_ptraj_<id>_<segment>)"""
+    for prefix, stage in LABELS:
+        if label.startswith(prefix):
+            return label[len(prefix):]
+    return None
+
+def load_records(path):
+    """Load runtime records from a JSON or CSV file. Each record has the
+    fields stage, cores, work and seconds."""
+    f = open(path)
+    try:
+        if path.endswith(".json"):
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+    finally:
+        f.close()
+
+    result = []
+    for r in records:
+        result.append({
+            "stage": r["stage"],
+            "cores": int(r["cores"]),
+            "work": float(r["work"]),
+            "seconds": float(r["seconds"])
+        })
+    return result
+
+def save_records(path, records):
+    "Write 'records' to a JSON or CSV file"
+    f = open(path, "w")
+    try:
+        if path.endswith(".json"):
+            json.dump(records, f, indent=1, sort_keys=True)
+        else:
+            writer = csv.DictWriter(f, ["stage", "cores", "work", "seconds"])
+            writer.writeheader()
+            writer.writerows(records)
+    finally:
+        f.close()
+
+class StageModel(object):
+    """Time per unit of work as a function of the number of cores, fitted to
+    past runs using Amdahl's law: t(p) = serial + parallel / p"""
+
+    def __init__(self, records):
+        cores = numpy.array([r["cores"] for r in records], dtype=float)
+        rate = numpy.array([r["seconds"] / r["work"] for r in records])
+        self.core_counts = sorted(set(int(c) for c in cores))
+
+        if len(set(cores)) > 1:
+            A = numpy.column_stack([numpy.ones_like(cores), 1.0 / cores])
+            (serial, parallel), _, _, _ = numpy.linalg.lstsq(A, rate, rcond=-1)
+        else:
+            serial, parallel = 0.0, numpy.mean(rate * cores)
+
+        # Negative coefficients come from noise; clip them and refit the other
+        if serial < 0:
+            serial, parallel = 0.0, numpy.mean(rate * cores)
+        if parallel < 0:
+            serial, parallel = numpy.mean(rate), 0.0
+
+        self.serial = float(serial)
+        self.parallel = float(parallel)
+
+    def seconds_per_unit(self, cores):
+        "Predicted time for one unit of work on 'cores' cores"
+        return self.serial + self.parallel / cores
+
+    def efficiency(self, cores, base):
+        "Parallel efficiency of 'cores' relative to 'base' cores"
+        return (self.seconds_per_unit(base) * base) / (self.seconds_per_unit(cores) * cores)
+
+def stage_models(records):
+    "Return a dict of stage -> StageModel fitted to the runtime 'records'"
+    stages = {}
+    for r in records:
+        stages.setdefault(r["stage"], []).append(r)
+    return dict((stage, StageModel(records)) for stage, records in stages.items())
+
+class ResourceModel(object):
+    """Chooses the globus count and maxwalltime for each job. Without any
+    history the defaults above are used, with the walltime scaled by the
+    amount of work. With a history of past runtimes (the 'history' option in
+    the [resources] section) a StageModel is fitted for each stage, and the
+    request uses the largest core count that is still efficient."""
+
+    def __init__(self, config):
+        "'config' is a ConfigParser object"
+        self.safety = 1.25
+        self.min_efficiency = 0.7
+        self.max_count = 960
+        self.models = {}
+
+        if not config.has_section("resources"):
+            return
+
+        if config.has_option("resources", "safety"):
+            self.safety = config.getfloat("resources", "safety")
+        if config.has_option("resources", "min_efficiency"):
+            self.min_efficiency = config.getfloat("resources", "min_efficiency")
+        if config.has_option("resources", "max_count"):
+            self.max_count = config.getint("resources", "max_count")
+
+        if config.has_option("resources", "history"):
+            self.models = stage_models(load_records(config.get("resources", "history")))
+
+    def choose_cores(self, stage, model):
+        "Return the largest core count (in whole nodes, up to max_count) that has at least min_efficiency"
+        if stage in SERIAL_STAGES:
+            return 1
+        if len(model.core_counts) == 1:
+            # The history says nothing about scaling, so don't extrapolate
+            return model.core_counts[0]
+        best = CORES_PER_NODE
+        cores = CORES_PER_NODE
+        while cores <= self.max_count:
+            if model.efficiency(cores, CORES_PER_NODE) >= self.min_efficiency:
+                best = cores
+            cores += CORES_PER_NODE
+        return best
+
+    def cores(self, stage):
+        "Return the number of cores that a 'stage' job uses"
+        if stage in self.models:
+            return self.choose_cores(stage, self.models[stage])
+        return DEFAULTS[stage][0]
+
+    def request(self, stage, work, cores=None):
+        """Return the (count, maxwalltime) strings for a 'stage' job that does 'work' units of work
+        on 'cores' cores, by default the number from cores(). Without a history the default
+        walltime is assumed to scale perfectly with the number of cores."""
+        work = float(work)
+        if cores is None:
+            cores = self.cores(stage)
+        if stage in self.models:
+            model = self.models[stage]
+            minutes = model.seconds_per_unit(cores) * work * self.safety / 60.0
+        else:
+            default_cores, walltime, reference = DEFAULTS[stage]
+            minutes = walltime * work / reference * default_cores / float(cores)
+        return str(cores), str(max(1, int(math.ceil(minutes))))
+
+def conf_value(path, name):
+    "Return the value of the NAMD option or Tcl variable 'name' from the config file at 'path'"
+    pattern = re.compile(r"^\s*(?:set\s+)?%s\s+(\S+)" % re.escape(name), re.IGNORECASE)
+    f = open(path)
+    try:
+        for line in f:
+            m = pattern.match(line)
+            if m:
+                return m.group(1)
+    finally:
+        f.close()
+    return None
+
+def replica_configs(path):
+    """Return the config files of the replicas if the NAMD config file at
+    'path' is a multi-copy launcher (see templates/multicopy.conf), or None"""
+    f = open(path)
+    try:
+        m = re.search(r"^set configs \{(.*?)^\}", f.read(), re.MULTILINE | re.DOTALL)
+    finally:
+        f.close()
+    if m is None:
+        return None
+    return m.group(1).split()
+
+def scan_points(path):
+    "Return the number of q points in the sassena config file at 'path'"
+    f = open(path)
+    try:
+        m = re.search(r"<points>\s*(\d+)\s*</points>", f.read())
+    finally:
+        f.close()
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def dax_jobs(workflowdir, dax="dax.xml"):
+    """Yield the id, the node label (or the name if it has none) and the
+    element of every job in the DAX file 'dax' in 'workflowdir'. The element
+    is cleared once the caller has moved on to the next job."""
+    for event, elem in ElementTree.iterparse(os.path.join(workflowdir, dax)):
+        if elem.tag == DAX_NS + "job":
+            yield elem.get("id"), elem.get("node-label") or elem.get("name"), elem
+            elem.clear()
+
+def kickstart_files(submitdir, jobs):
+    """Yield the job id and the path of every kickstart record in 'submitdir'
+    and its subdirectories of the jobs whose ids are in 'jobs'"""
+    paths = glob.glob(os.path.join(submitdir, "*", "*.out.*")) + glob.glob(os.path.join(submitdir, "*.out.*"))
+    for path in sorted(paths):
+        m = KICKSTART_FILE.search(path)
+        if m and m.group(1) in jobs:
+            yield m.group(1), path
+
+def kickstart_record(path):
+    """Return the wall time, the CPU time (user + system) and the sizes of the
+    output files of the main job in the kickstart record at 'path', or None
+    if it has no main job"""
+    wall_time = None
+    cpu_time = None
+    outputs = {}
+    for event, elem in ElementTree.iterparse(path):
+        tag = elem.tag.split("}")[-1]
+        if tag == "mainjob":
+            wall_time = float(elem.get("duration"))
+            for child in elem:
+                if child.tag.split("}")[-1] == "usage":
+                    cpu_time = float(child.get("utime", 0)) + float(child.get("stime", 0))
+        elif tag == "statcall" and elem.get("id") == "final":
+            name = size = None
+            for child in elem:
+                if child.tag.split("}")[-1] == "file":
+                    name = os.path.basename(child.get("name"))
+                elif child.tag.split("}")[-1] == "statinfo":
+                    size = float(child.get("size"))
+            if name is not None and size is not None:
+                outputs[name] = size
+    if wall_time is None:
+        return None
+    return {"wall_time": wall_time, "cpu_time": cpu_time, "outputs": outputs}
+
+def job_work(workflowdir, dax="dax.xml"):
+    """Return a dict of job id -> (stage, cores, work) of the jobs of the DAX
+    file 'dax' in 'workflowdir' whose amount of work is known. The node
+    labels and core counts come from the DAX, and the amount of work from the
+    NAMD config files that were generated next to it. The work of the
+    analysis jobs is the number of frames written by the production segment
+    they analyse, or by all the segments of the pipeline. The sassena jobs of
+    a sharded q scan only do the share of that work that their q points make
+    up. A multi-copy NAMD job counts as one replica of its longest run, on
+    the cores of one replica."""
+    jobs = {}
+    frames = {}
+    points = {}
+    ns = DAX_NS
+    for id, label, elem in dax_jobs(workflowdir, dax):
+        stage = label_stage(label)
+        if stage is None:
+            continue
+        cores = 1
+        for p in elem.findall(ns + "profile"):
+            if p.get("namespace") == "globus" and p.get("key") == "count":
+                cores = int(p.text)
+        part = label_part(label)
+        pipeline = part.split("_")[0]
+
+        # The shards of a q scan are named <part>_q<shard>
+        shard = re.search(r"_q\d+$", part)
+
+        # The NAMD jobs and the shards read the config file in their argument.
+        # The keg jobs of a --synthetic workflow do not have one.
+        argument = elem.find(ns + "argument/" + ns + "file")
+        if argument is None and (shard or stage in ("namd_eq", "namd_prod")):
+            continue
+
+        if shard:
+            part = part[:shard.start()]
+            conf = os.path.join(workflowdir, argument.get("name"))
+            n = scan_points(conf)
+            total = points.setdefault((stage, part), [0])
+            total[0] += n
+            shard = (n, total)
+
+        work = None
+        if stage in ("namd_eq", "namd_prod"):
+            # The NAMD config file is the argument of the job. A multi-copy job
+            # runs one config file per replica, each on an equal share of the
+            # cores, so it is recorded as one replica of the longest run.
+            conf = os.path.join(workflowdir, argument.get("name"))
+            replicas = replica_configs(conf)
+            work = 0.0
+            if replicas:
+                cores //= len(replicas)
+                confs = [(os.path.join(workflowdir, name), re.match(r"(?:production_)?(.*)\.conf$", name).group(1))
+                         for name in replicas]
+            else:
+                confs = [(conf, part)]
+            for conf, conf_part in confs:
+                steps = float(conf_value(conf, "timesteps"))
+                work = max(work, steps)
+                if stage == "namd_prod":
+                    conf_pipeline = conf_part.split("_")[0]
+                    dcdfreq = float(conf_value(conf, "dcdfreq") or DCD_FREQUENCY)
+                    frames[conf_pipeline] = frames.get(conf_pipeline, 0) + steps // dcdfreq
+                    if conf_part != conf_pipeline:
+                        frames[conf_part] = steps // dcdfreq
+        jobs[id] = (stage, cores, part, work, shard)
+
+    result = {}
+    for id, (stage, cores, part, work, shard) in jobs.items():
+        if work is None:
+            work = frames.get(part)
+        if not work:
+            continue
+        if shard:
+            n, total = shard
+            work = work * n / float(total[0])
+        result[id] = (stage, cores, work)
+    return result
+
+def ingest_kickstart(workflowdir, submitdir):
+    """Create runtime records from the kickstart output of a finished run of
+    a flat (not --block-size) workflow in 'workflowdir', with the amount of
+    work of each job from job_work()"""
+    jobs = job_work(workflowdir)
+    records = []
+    for id, path in kickstart_files(submitdir, jobs):
+        record = kickstart_record(path)
+        if record is None:
+            continue
+        stage, cores, work = jobs[id]
+        records.append({"stage": stage, "cores": cores, "work": work, "seconds": record["wall_time"]})
+
+    return records
+
+def main():
+    if len(sys.argv) != 4:
+        raise Exception("Usage: %s WORKFLOWDIR SUBMITDIR HISTORYFILE" % sys.argv[0])
+
+    workflowdir, submitdir, history = sys.argv[1:]
+
+    records = []
+    if os.path.isfile(history):
+        records = load_records(history)
+    new = ingest_kickstart(workflowdir, submitdir)
+    save_records(history, records + new)
+    print "Added %d records to %s" % (len(new), history)
+
+
+if __name__ == '__main__':
+    main()
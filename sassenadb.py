@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+
+def archive_checksum(path):
+    "Return the SHA-1 hex digest of the file at 'path'"
+    digest = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            block = f.read(1024*1024)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+class SassenaDBCache(object):
+    """A shared directory that holds extracted copies of the sassena database
+    archive, keyed by the checksum of the archive:
+
+        CACHEDIR/<sha1 of archive>/database/db-neutron-incoherent.xml
+        CACHEDIR/<sha1 of archive>/database/definitions/...
+
+    If the archive has already been extracted into the cache, the workflow
+    can use the files directly instead of running an untar job."""
+
+    def __init__(self, cachedir, archive):
+        "'cachedir' is the shared cache directory and 'archive' is the path of the sassena db .tar.gz"
+        self.cachedir = os.path.abspath(cachedir)
+        self.archive = archive
+        self.key = archive_checksum(archive)
+        self.dir = os.path.join(self.cachedir, self.key)
+
+    def is_populated(self):
+        "Return True if the archive has been extracted into the cache"
+        return os.path.isdir(self.dir)
+
+    def files(self):
+        "Return a sorted list of (logical name, path) for every file in the cached database"
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files.append((os.path.relpath(path, self.dir), path))
+        files.sort()
+        return files
+
+    def populate(self):
+        """Extract the archive into the cache if it is not there already. The
+        archive is extracted into a temporary directory that is renamed into
+        place, so concurrent users never see a partial database."""
+        if self.is_populated():
+            return self.dir
+
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+        tmpdir = tempfile.mkdtemp(prefix=".%s." % self.key, dir=self.cachedir)
+        try:
+            tar = tarfile.open(self.archive, "r:gz")
+            try:
+                for member in tar.getmembers():
+                    if member.name.startswith("/") or ".." in member.name.split("/"):
+                        raise Exception("Invalid path in archive: %s" % member.name)
+                tar.extractall(tmpdir)
+            finally:
+                tar.close()
+            os.rename(tmpdir, self.dir)
+        except OSError:
+            # Somebody else populated the cache first
+            if not self.is_populated():
+                raise
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+
+        return self.dir
+
+def main():
+    if len(sys.argv) != 3:
+        raise Exception("Usage: %s ARCHIVE CACHEDIR" % sys.argv[0])
+
+    archive = sys.argv[1]
+    cachedir = sys.argv[2]
+
+    if not os.path.isfile(archive):
+        raise Exception("No such file: %s" % archive)
+
+    cache = SassenaDBCache(cachedir, archive)
+    print cache.populate()
+
+
+if __name__ == '__main__':
+    main()
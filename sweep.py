@@ -0,0 +1,161 @@
+import hashlib
+import itertools
+from collections import OrderedDict
+
+# The simulation parameters that can be swept, and the option in the
+# [simulation] section of the config file that holds their default value
+PARAMETERS = OrderedDict([
+    ("epsilon", "epsilons"),
+    ("temperature", "temperature"),
+    ("equilibrate_steps", "equilibrate_steps"),
+    ("production_steps", "production_steps")
+])
+
+# Number of hex digits of the SHA-1 used for pipeline names
+ID_LENGTH = 10
+
+def split_values(value):
+    "Split a comma-separated config value into a list"
+    return [x.strip() for x in value.split(",") if x.strip()]
+
+def batches(iterable, size):
+    "Yield lists of up to 'size' items from 'iterable' without reading ahead any further"
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class Pipeline(object):
+    """One point in the parameter sweep. The values of all the parameters are
+    available as attributes (e.g. pipeline.epsilon), and 'id' is a short name
+    derived from the swept values that is used to name the pipeline's files
+    and jobs."""
+
+    def __init__(self, index, axes, params):
+        "'index' is the position in the sweep, 'axes' are the swept parameters and 'params' holds all values"
+        self.index = index
+        self.params = params
+        key = ",".join(["%s=%s" % (axis, params[axis]) for axis in axes])
+        self.id = hashlib.sha1(key).hexdigest()[:ID_LENGTH]
+
+        # The logical names of the files generated for this pipeline
+        self.artifacts = {}
+
+        # The pipeline whose equilibrated state this one starts from, if any
+        self.seed = None
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["params"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def describe(self):
+        "Return a string with the value of every parameter"
+        return " ".join(["%s=%s" % item for item in self.params.items()])
+
+class ParameterSweep(object):
+    """The set of pipelines described by the config file. By default only
+    'epsilons' from the [simulation] section is swept. An optional [sweep]
+    section can sweep any of the parameters in PARAMETERS:
+
+        [sweep]
+        axes = epsilon, temperature
+        mode = product
+        temperature = 290, 300, 310
+
+    Axes that do not have values in [sweep] take them from [simulation]. With
+    'mode = product' every combination of the axis values is generated, and
+    with 'mode = list' the axes must all have the same number of values and
+    the n-th pipeline uses the n-th value of every axis."""
+
+    def __init__(self, config):
+        "'config' is a ConfigParser object"
+        self.defaults = OrderedDict()
+        for param, option in PARAMETERS.items():
+            self.defaults[param] = config.get("simulation", option).strip()
+
+        if config.has_section("sweep"):
+            self.axes = split_values(config.get("sweep", "axes"))
+            self.mode = "product"
+            if config.has_option("sweep", "mode"):
+                self.mode = config.get("sweep", "mode").strip()
+        else:
+            self.axes = ["epsilon"]
+            self.mode = "product"
+
+        if self.mode not in ("product", "list"):
+            raise Exception("Invalid sweep mode: %s" % self.mode)
+
+        self.values = OrderedDict()
+        for axis in self.axes:
+            if axis not in PARAMETERS:
+                raise Exception("Unknown sweep axis: %s" % axis)
+            if config.has_section("sweep") and config.has_option("sweep", axis):
+                values = config.get("sweep", axis)
+            else:
+                values = config.get("simulation", PARAMETERS[axis])
+            self.values[axis] = split_values(values)
+            if len(self.values[axis]) == 0:
+                raise Exception("No values for sweep axis: %s" % axis)
+
+        # The epsilon default is a list, so it has to be an axis
+        if "epsilon" not in self.axes:
+            raise Exception("epsilon must be one of the sweep axes")
+
+        if self.mode == "list":
+            lengths = set(len(v) for v in self.values.values())
+            if len(lengths) != 1:
+                raise Exception("All sweep axes must have the same number of values in list mode")
+        else:
+            # A product only has duplicate points if an axis has duplicate
+            # values, so they are removed here instead of while iterating
+            for axis, values in self.values.items():
+                self.values[axis] = list(OrderedDict.fromkeys(values))
+
+    def __len__(self):
+        "The number of points in the sweep (before removing duplicates in list mode)"
+        if self.mode == "list":
+            return len(self.values[self.axes[0]])
+        n = 1
+        for values in self.values.values():
+            n *= len(values)
+        return n
+
+    def points(self):
+        "Yield the tuples of axis values in sweep order"
+        if self.mode == "list":
+            return itertools.izip(*self.values.values())
+        return itertools.product(*self.values.values())
+
+    def __iter__(self):
+        """Yield the pipelines of the sweep one at a time. Duplicate points are
+        skipped. In product mode nothing is kept between points, so memory does
+        not grow with the sweep; in list mode the ids of the pipelines that were
+        yielded are kept to find the duplicates."""
+        seen = None
+        if self.mode == "list":
+            seen = set()
+        for index, point in enumerate(self.points()):
+            params = self.defaults.copy()
+            params.update(zip(self.axes, point))
+            pipeline = Pipeline(index, self.axes, params)
+            if seen is not None:
+                if pipeline.id in seen:
+                    continue
+                seen.add(pipeline.id)
+            yield pipeline
+
+    def ordered(self, axis):
+        """Return the pipelines as a list in which 'axis' varies fastest and is
+        sorted by value, so that pipelines which only differ in 'axis' are
+        next to each other. The other axes keep their sweep order."""
+        others = [a for a in self.axes if a != axis]
+
+        def key(pipeline):
+            position = tuple(self.values[a].index(pipeline.params[a]) for a in others)
+            return position, float(pipeline.params[axis])
+
+        return sorted(self, key=key)
@@ -0,0 +1,105 @@
+import os
+import string
+import threading
+from collections import OrderedDict
+
+class Template(object):
+    "A template that has been parsed once into literal segments and replacement slots"
+
+    def __init__(self, path):
+        "'path' is the location of the template file"
+        self.path = path
+        self.formatter = string.Formatter()
+
+        # The template is compiled into a list of segments. Literal text is
+        # stored as a str, and each replacement field is stored as a tuple of
+        # (field_name, format_spec, conversion). Adjacent literals are merged
+        # so that rendering a template with one placeholder only touches
+        # three segments no matter how large the file is.
+        f = open(path)
+        try:
+            text = f.read()
+        finally:
+            f.close()
+
+        self.segments = []
+        self.slots = []
+        literal = []
+        for literal_text, field_name, format_spec, conversion in self.formatter.parse(text):
+            if literal_text:
+                literal.append(literal_text)
+            if field_name is None:
+                continue
+            if literal:
+                self.segments.append("".join(literal))
+                literal = []
+            self.slots.append(len(self.segments))
+            self.segments.append((field_name, format_spec, conversion))
+        if literal:
+            self.segments.append("".join(literal))
+
+    def render_field(self, field, kwargs):
+        "Render a single replacement field using the same rules as string.Formatter"
+        field_name, format_spec, conversion = field
+        obj, _ = self.formatter.get_field(field_name, (), kwargs)
+        obj = self.formatter.convert_field(obj, conversion)
+        if format_spec and "{" in format_spec:
+            format_spec = self.formatter.vformat(format_spec, (), kwargs)
+        return self.formatter.format_field(obj, format_spec)
+
+    def render(self, **kwargs):
+        "Return the list of chunks for the filled in template. The literal chunks are shared, not copied"
+        chunks = list(self.segments)
+        for i in self.slots:
+            chunks[i] = self.render_field(chunks[i], kwargs)
+        return chunks
+
+    def write(self, outfile, **kwargs):
+        "Fill in the template and write it to 'outfile'"
+        write_chunks(outfile, self.render(**kwargs))
+
+def write_chunks(outfile, chunks):
+    "Write rendered template chunks to 'outfile'"
+    f = open(outfile, "w")
+    try:
+        f.writelines(chunks)
+    finally:
+        f.close()
+
+class TemplateCache(object):
+    "An LRU cache of compiled templates keyed by path"
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        "Return the compiled template for 'path', loading it if it is not cached"
+        path = os.path.realpath(path)
+        self.lock.acquire()
+        try:
+            template = self.templates.pop(path, None)
+            if template is None:
+                template = Template(path)
+                while len(self.templates) >= self.maxsize:
+                    self.templates.popitem(last=False)
+            self.templates[path] = template
+            return template
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        "Drop all the compiled templates"
+        self.lock.acquire()
+        try:
+            self.templates.clear()
+        finally:
+            self.lock.release()
+
+# The templates used by this process. They are only compiled once.
+cache = TemplateCache()
+
+def get_template(path):
+    "Return the compiled template for 'path' from the process-wide cache"
+    return cache.get(path)
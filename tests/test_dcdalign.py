@@ -0,0 +1,100 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dcd
+from dcdalign import kabsch, align_trajectories
+
+NATOMS = 50
+NFRAMES = 10
+
+def random_rotations(random, n):
+    "Return 'n' random proper rotation matrices"
+    rotations = []
+    for i in range(n):
+        q, r = numpy.linalg.qr(random.normal(size=(3, 3)))
+        if numpy.linalg.det(q) < 0:
+            q[:, 0] *= -1
+        rotations.append(q)
+    return numpy.array(rotations)
+
+def write_dcd(path, xyz, cells):
+    "Write the (frames, atoms, 3) coordinates 'xyz' with the unit cells 'cells' to a DCD file"
+    nframes, natoms = xyz.shape[:2]
+    icntrl = [0] * 20
+    icntrl[0] = nframes
+    icntrl[10] = 1
+    control = "CORD" + struct.pack("<20i", *icntrl)
+    title = struct.pack("<i", 1) + "test".ljust(80)
+    frames = numpy.zeros(nframes, dtype=dcd.frame_dtype(natoms, True))
+    for name, size in dcd.record_sizes(frames.dtype):
+        frames[name + "_begin"] = size
+        frames[name + "_end"] = size
+    frames["cell"] = cells
+    frames["x"] = xyz[:, :, 0]
+    frames["y"] = xyz[:, :, 1]
+    frames["z"] = xyz[:, :, 2]
+    f = open(path, "wb")
+    try:
+        f.write(dcd.record("<", control) + dcd.record("<", title) + dcd.record("<", struct.pack("<i", natoms)))
+        frames.tofile(f)
+    finally:
+        f.close()
+
+class DCDAlignTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.random = numpy.random.RandomState(0)
+        self.reference = self.random.uniform(-5, 5, size=(NATOMS, 3))
+        self.reference -= self.reference.mean(axis=0)
+
+        # Rotate and move every frame but the first, which is the reference
+        rotations = random_rotations(self.random, NFRAMES)
+        rotations[0] = numpy.identity(3)
+        shifts = self.random.uniform(-10, 10, size=(NFRAMES, 1, 3))
+        shifts[0] = 0
+        xyz = numpy.einsum("aj,fij->fai", self.reference, rotations) + shifts
+        self.cells = self.random.uniform(20, 30, size=(NFRAMES, 6))
+        self.input = os.path.join(self.dir, "input.dcd")
+        write_dcd(self.input, xyz, self.cells)
+        self.output = os.path.join(self.dir, "output.dcd")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_align(self):
+        written = align_trajectories([self.input], self.output, "@1-%d" % NATOMS, chunk_size=3, jobs=2)
+        self.assertEqual(written, NFRAMES)
+        f = dcd.DCDFile(self.output)
+        try:
+            xyz = f.coordinates(0, len(f))
+        finally:
+            f.close()
+        for frame in xyz:
+            self.assertTrue(numpy.allclose(frame, self.reference, rtol=0, atol=1e-5))
+
+    def test_unit_cell(self):
+        align_trajectories([self.input], self.output, "@1-%d" % NATOMS, chunk_size=4)
+        f = dcd.DCDFile(self.output)
+        try:
+            self.assertTrue(f.has_unit_cell)
+            self.assertTrue(numpy.array_equal(f.frames["cell"], self.cells))
+        finally:
+            f.close()
+
+    def test_reflection(self):
+        # A mirror image is best fitted by a reflection, which must not be used
+        mirrored = self.reference * numpy.array([-1, 1, 1])
+        rotations, centers = kabsch(mirrored[numpy.newaxis], self.reference)
+        self.assertAlmostEqual(numpy.linalg.det(rotations[0]), 1.0)
+        self.assertTrue(numpy.allclose(rotations[0].dot(rotations[0].T), numpy.identity(3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dagsim import load_dax
+from localrun import LocalRun
+
+DAX = """<?xml version="1.0" encoding="UTF-8"?>
+<adag xmlns="http://pegasus.isi.edu/schema/DAX" version="3.6" name="test">
+	<job id="ID0000001" name="copy" node-label="copy_stdin">
+		<argument>-c "cat &gt; copied.txt"</argument>
+		<stdin name="script.conf" link="input"/>
+		<uses name="copied.txt" link="output" transfer="true"/>
+	</job>
+	<job id="ID0000002" name="%s" node-label="check">
+		<argument>-c "grep -q trajin copied.txt"</argument>
+		<uses name="copied.txt" link="input"/>
+		<uses name="checked.txt" link="output" transfer="true"/>
+	</job>
+	<child ref="ID0000002">
+		<parent ref="ID0000001"/>
+	</child>
+</adag>
+"""
+
+SUBDIR_DAX = """<?xml version="1.0" encoding="UTF-8"?>
+<adag xmlns="http://pegasus.isi.edu/schema/DAX" version="3.6" name="test">
+	<job id="ID0000001" name="copy" node-label="untar">
+		<argument>-c "echo neutron &gt; database/db-neutron.xml"</argument>
+		<uses name="database/db-neutron.xml" link="output" transfer="true"/>
+	</job>
+</adag>
+"""
+
+TC = """tr copy {
+    site local {
+        pfn "/bin/sh"
+    }
+}
+
+tr check {
+    site local {
+        pfn "./check.sh"
+    }
+}
+
+tr nooutput {
+    site local {
+        pfn "/bin/sh"
+    }
+}
+"""
+
+CHECK = """#!/bin/sh
+/bin/sh "$@" && touch checked.txt
+"""
+
+class LocalRunTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.inputs = os.path.join(self.dir, "inputs")
+        os.makedirs(self.inputs)
+        f = open(os.path.join(self.inputs, "script.conf"), "w")
+        f.write("trajin production.dcd\n")
+        f.close()
+        f = open(os.path.join(self.dir, "tc.txt"), "w")
+        f.write(TC)
+        f.close()
+        check = os.path.join(self.dir, "check.sh")
+        f = open(check, "w")
+        f.write(CHECK)
+        f.close()
+        os.chmod(check, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def workflow(self, transformation, dax=DAX):
+        workflowdir = os.path.join(self.dir, "workflow")
+        os.makedirs(workflowdir)
+        f = open(os.path.join(workflowdir, "dax.xml"), "w")
+        f.write(dax.replace("%s", transformation))
+        f.close()
+        return workflowdir
+
+    def test_load_stdin(self):
+        jobs = load_dax(os.path.join(self.workflow("check"), "dax.xml"))
+        self.assertEqual(jobs["ID0000001"].stdin, "script.conf")
+        self.assertEqual(jobs["ID0000001"].inputs, [("script.conf", True)])
+
+    def test_stdin(self):
+        run = LocalRun(self.workflow("check"), os.path.join(self.dir, "tc.txt"), input_dir=self.inputs)
+        records = run.run()
+        self.assertEqual([r["status"] for r in records], [0, 0])
+        f = open(os.path.join(run.workdir, "copied.txt"))
+        self.assertEqual(f.read(), "trajin production.dcd\n")
+        f.close()
+
+    def test_missing_output(self):
+        # The second job exits with 0 but does not write checked.txt
+        run = LocalRun(self.workflow("nooutput"), os.path.join(self.dir, "tc.txt"), retries=1,
+                       input_dir=self.inputs)
+        records = run.run()
+        self.assertEqual(records[0]["status"], 0)
+        self.assertNotEqual(records[1]["status"], 0)
+        self.assertTrue("checked.txt" in records[1]["error"])
+
+    def test_output_directory(self):
+        # The job writes its output into a directory that it does not create
+        run = LocalRun(self.workflow("copy", SUBDIR_DAX), os.path.join(self.dir, "tc.txt"),
+                       input_dir=self.inputs)
+        records = run.run()
+        self.assertEqual(records[0]["status"], 0)
+        self.assertTrue(os.path.isfile(os.path.join(run.workdir, "database", "db-neutron.xml")))
+
+
+if __name__ == '__main__':
+    unittest.main()
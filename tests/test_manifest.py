@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manifest import Manifest
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def generate(self, files):
+        "Generate the {name: (pipeline, content)} 'files' into the directory like one run of daxgen"
+        manifest = Manifest(self.dir)
+        for name, (pipeline, content) in sorted(files.items()):
+            manifest.write_chunks(pipeline, name, [content])
+        pruned = manifest.prune()
+        manifest.write()
+        return manifest, pruned
+
+    def test_regenerate(self):
+        manifest, pruned = self.generate({"a.conf": ("a", "1\n"), "b.conf": ("b", "1\n"), "c.conf": ("c", "1\n")})
+        self.assertEqual(manifest.new_pipelines(), set(["a", "b", "c"]))
+        self.assertEqual(manifest.changed, set(["a.conf", "b.conf", "c.conf"]))
+
+        # The same run again changes nothing
+        manifest, pruned = self.generate({"a.conf": ("a", "1\n"), "b.conf": ("b", "1\n"), "c.conf": ("c", "1\n")})
+        self.assertEqual(manifest.changed, set())
+        self.assertEqual(manifest.new_pipelines(), set())
+        self.assertEqual(manifest.stale_pipelines(), set())
+        self.assertEqual(manifest.removed_pipelines(), set())
+
+        # b changes, c is gone and d is new
+        os.utime(os.path.join(self.dir, "a.conf"), (0, 0))
+        manifest, pruned = self.generate({"a.conf": ("a", "1\n"), "b.conf": ("b", "2\n"), "d.conf": ("d", "1\n")})
+        self.assertEqual(manifest.changed, set(["b.conf", "d.conf"]))
+        self.assertEqual(manifest.new_pipelines(), set(["d"]))
+        self.assertEqual(manifest.stale_pipelines(), set(["b"]))
+        self.assertEqual(manifest.removed_pipelines(), set(["c"]))
+        self.assertEqual(pruned, ["c.conf"])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "c.conf")))
+        self.assertEqual(os.path.getmtime(os.path.join(self.dir, "a.conf")), 0)
+        f = open(os.path.join(self.dir, "b.conf"))
+        self.assertEqual(f.read(), "2\n")
+        f.close()
+
+    def test_missing_file(self):
+        # A file that was deleted since the last run is written again
+        self.generate({"a.conf": ("a", "1\n")})
+        os.unlink(os.path.join(self.dir, "a.conf"))
+        manifest, pruned = self.generate({"a.conf": ("a", "1\n")})
+        self.assertEqual(manifest.changed, set(["a.conf"]))
+        self.assertEqual(manifest.stale_pipelines(), set(["a"]))
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, "a.conf")))
+
+    def test_shared_file(self):
+        # A deduplicated file is written once and belongs to every pipeline that uses it
+        manifest = Manifest(self.dir)
+        manifest.write_chunks("a", "shared.conf", ["1\n"])
+        os.utime(os.path.join(self.dir, "shared.conf"), (0, 0))
+        manifest.write_chunks("b", "shared.conf", ["1\n"])
+        self.assertEqual(os.path.getmtime(os.path.join(self.dir, "shared.conf")), 0)
+        self.assertEqual(manifest.new_pipelines(), set(["a", "b"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
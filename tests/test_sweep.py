@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+from ConfigParser import ConfigParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sweep import ParameterSweep
+
+def make_config(epsilons, sweep=None):
+    "Return a config with 'epsilons' and the [sweep] options in the dict 'sweep'"
+    config = ConfigParser()
+    config.add_section("simulation")
+    config.set("simulation", "epsilons", epsilons)
+    config.set("simulation", "temperature", "290")
+    config.set("simulation", "equilibrate_steps", "1000")
+    config.set("simulation", "production_steps", "5000")
+    if sweep is not None:
+        config.add_section("sweep")
+        for option, value in sweep.items():
+            config.set("sweep", option, value)
+    return config
+
+class ParameterSweepTest(unittest.TestCase):
+    def test_stable_ids(self):
+        # The ids name the files of earlier runs, so they must never change
+        sweep = ParameterSweep(make_config("0.5"))
+        self.assertEqual([p.id for p in sweep], ["cc5cf74441"])
+        sweep = ParameterSweep(make_config("0.5", {"axes": "epsilon, temperature"}))
+        self.assertEqual([p.id for p in sweep], ["b7b041a458"])
+
+        # The order of the values does not change the id of a point
+        first = dict((p.epsilon, p.id) for p in ParameterSweep(make_config("0.5, 1.0, 1.5")))
+        second = dict((p.epsilon, p.id) for p in ParameterSweep(make_config("1.5, 0.5, 1.0")))
+        self.assertEqual(first, second)
+
+    def test_product_duplicates(self):
+        sweep = ParameterSweep(make_config("0.5, 1.0, 0.5", {"axes": "epsilon, temperature",
+                                                             "temperature": "290, 300, 290"}))
+        self.assertEqual(len(sweep), 4)
+        points = [(p.epsilon, p.temperature) for p in sweep]
+        self.assertEqual(points, [("0.5", "290"), ("0.5", "300"), ("1.0", "290"), ("1.0", "300")])
+
+    def test_list_duplicates(self):
+        sweep = ParameterSweep(make_config("0.5, 1.0, 0.5, 0.5", {"axes": "epsilon, temperature",
+                                                                  "mode": "list",
+                                                                  "temperature": "290, 300, 290, 310"}))
+        points = [(p.index, p.epsilon, p.temperature) for p in sweep]
+        self.assertEqual(points, [(0, "0.5", "290"), (1, "1.0", "300"), (3, "0.5", "310")])
+
+    def test_ordered(self):
+        sweep = ParameterSweep(make_config("1.5, 0.5, 1.0", {"axes": "epsilon, temperature",
+                                                             "temperature": "300, 290"}))
+        points = [(p.temperature, p.epsilon) for p in sweep.ordered("epsilon")]
+        self.assertEqual(points, [("300", "0.5"), ("300", "1.0"), ("300", "1.5"),
+                                  ("290", "0.5"), ("290", "1.0"), ("290", "1.5")])
+
+
+if __name__ == '__main__':
+    unittest.main()